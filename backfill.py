@@ -0,0 +1,583 @@
+import argparse
+import collections
+import csv
+import datetime
+import gzip
+import heapq
+import json
+import logging
+import math
+import operator
+import os
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import metrics
+import points
+import spool
+
+FORMAT = '[%(levelname)s | %(asctime)-15s | %(filename)s | %(funcName)s | %(module)s] %(message)s'
+
+# Records flowing through the pipeline are (time_ns, line, unit) tuples, line
+# being one line protocol line with its trailing newline and unit the input it
+# was read from (a file or a spool segment, as it was when read). Each unit is
+# read in a fixed order, the checkpoint stores how many of its records are written.
+
+# Bad lines are logged up to this many per input, then only counted
+MAX_LOGGED_SKIP = 10
+
+def _split_line(
+    line: bytes,
+) -> tuple:
+    # Series key, field set and timestamp of a line protocol line. Backslash
+    # escapes and quoted string fields may hide spaces, they are scanned for
+    # only when the line holds any.
+    body = line.rstrip(b"\r\n")
+    if b"\\" not in body and b'"' not in body:
+        list_part = body.split(b" ")
+    else:
+        list_part = []
+        start = 0
+        index = 0
+        quoted = False
+        while index < len(body):
+            character = body[index]
+            if character == 0x5C:
+                index += 2
+                continue
+            if character == 0x22 and len(list_part) == 1:
+                quoted = not quoted
+            elif character == 0x20 and not quoted:
+                list_part.append(body[start:index])
+                start = index + 1
+            index += 1
+        list_part.append(body[start:])
+
+    if len(list_part) != 3 or not list_part[0] or not list_part[1]:
+        raise ValueError("expected a series key, a field set and a timestamp")
+    return list_part[0], list_part[1], int(list_part[2])
+
+def _parse_time(
+    value: str,
+) -> int:
+    # Epoch integers in s, ms, us or ns by magnitude, otherwise ISO 8601 (UTC if naive)
+    if value.lstrip("-").isdigit():
+        number = int(value)
+        for limit, factor in ((10**11, 10**9), (10**14, 10**6), (10**17, 10**3)):
+            if abs(number) < limit:
+                return number * factor
+        return number
+    time_value = datetime.datetime.fromisoformat(value)
+    if time_value.tzinfo is None:
+        time_value = time_value.replace(tzinfo=datetime.timezone.utc)
+    return int(time_value.timestamp() * 1e6) * 1000
+
+def _get_unit(
+    path: str,
+) -> str:
+    # A file that changed since it was checkpointed is a new unit, read again from the start
+    stat = os.stat(path)
+    return f"{os.path.abspath(path)}:{stat.st_size}:{stat.st_mtime_ns}"
+
+def _skip(
+    path: str,
+    line_number: int,
+    error: Exception,
+    skipped: int,
+) -> int:
+    metrics.REGISTRY.inc("backfill_lines_skipped_total")
+    if skipped < MAX_LOGGED_SKIP:
+        logging.warning(f"Skipping line {line_number} of {path}: {error}")
+    return skipped + 1
+
+def _read_lines(
+    path: str,
+    offset: int = 0,
+) -> iter:
+    # Plain or gzipped line protocol, read line by line
+    skipped = 0
+    with (gzip.open(path, "rb") if path.endswith(".gz") else open(path, "rb")) as file:
+        file.seek(offset)
+        for line_number, line in enumerate(file, 1):
+            if not line.endswith(b"\n"):
+                logging.warning(f"Skipping incomplete last line of {path}")
+                break
+            if not line.strip():
+                continue
+            try:
+                time_ns = _split_line(line)[2]
+            except ValueError as e:
+                skipped = _skip(path, line_number, e, skipped)
+                continue
+            yield time_ns, line
+    if skipped:
+        logging.warning(f"Skipped {skipped} bad lines of {path}")
+
+def read_line_protocol(
+    path: str,
+) -> iter:
+    unit = _get_unit(path)
+    for time_ns, line in _read_lines(path):
+        yield time_ns, line, unit
+
+def read_spool(
+    directory: str,
+) -> iter:
+    # Only what the drainer hasn't acknowledged yet, the rest is already in InfluxDB.
+    # Segments hold batches in arrival order, not time order (sources lag each
+    # other, the writer flushes on size), so each one is sorted in memory, it is
+    # at most segment_max_bytes. Consecutive segments only overlap at their edges.
+    dict_offset = {}
+    path_offset = os.path.join(directory, spool.OFFSET_FILENAME)
+    if os.path.exists(path_offset):
+        with open(path_offset) as file:
+            dict_offset = {int(seq): offset for seq, offset in json.load(file).items()}
+
+    for filename in sorted(os.listdir(directory)):
+        if filename.endswith(spool.SEGMENT_SUFFIX):
+            seq = int(filename[:-len(spool.SEGMENT_SUFFIX)])
+            path = os.path.join(directory, filename)
+            # A segment the drainer has moved through since is a new unit too
+            unit = f"{_get_unit(path)}@{dict_offset.get(seq, 0)}"
+            list_record = list(_read_lines(path, dict_offset.get(seq, 0)))
+            list_record.sort(key=lambda record: record[0])
+            for time_ns, line in list_record:
+                yield time_ns, line, unit
+
+def read_csv(
+    path: str,
+    list_tag_column: list = [],
+    time_column: str = "time",
+) -> iter:
+    # Long format (a "measurement" and a "value" column) or wide format (one
+    # column per measurement), the tag columns are the same in both.
+    unit = _get_unit(path)
+    skipped = 0
+    with open(path, newline="") as file:
+        reader = csv.DictReader(file)
+        list_field = reader.fieldnames
+        long_format = "measurement" in list_field and "value" in list_field
+        list_measurement = [field for field in list_field if field not in list_tag_column and field != time_column]
+
+        for row in reader:
+            try:
+                time_ns = _parse_time(row[time_column] or "")
+            except (ValueError, TypeError) as e:
+                skipped = _skip(path, reader.line_num, f"bad time {row.get(time_column)!r}: {e}", skipped)
+                continue
+            tag_set = points.tag_set({column: row[column] for column in list_tag_column if row.get(column)})
+            if long_format:
+                list_item = [(row['measurement'], row['value'])]
+            else:
+                list_item = [(measurement, row[measurement]) for measurement in list_measurement]
+            for measurement, value in list_item:
+                if value in ("", None):
+                    continue
+                try:
+                    value = float(value)
+                except ValueError:
+                    skipped = _skip(path, reader.line_num, f"{measurement} value {value!r} is not a number", skipped)
+                    continue
+                if not math.isfinite(value) or not measurement:
+                    continue
+                yield time_ns, points.series_key(measurement, tag_set) + b"%r %d\n" % (value, time_ns), unit
+    if skipped:
+        logging.warning(f"Skipped {skipped} bad values of {path}")
+
+def read_huawei_pv(
+    huawei_pv: object,
+    start_date: datetime.date,
+    end_date: datetime.date,
+) -> iter:
+    day = start_date
+    while day <= end_date:
+        batch = huawei_pv.get_history_batch(day)
+        logging.info(f"FusionSolar history of {day}: {len(batch)} points")
+        # Today's history still grows, its unit changes with its length
+        unit = f"huawei_pv:{huawei_pv.subdomain}:{day}:{len(batch)}"
+        buffer = batch.encode()
+        for line in bytes(buffer).splitlines(keepends=True):
+            yield _split_line(line)[2], line, unit
+        day += datetime.timedelta(days=1)
+
+def merge(
+    *list_iterator: iter,
+) -> iter:
+    # Sources that are each in time order come out in time order together
+    return heapq.merge(*list_iterator, key=lambda record: record[0])
+
+def chunk(
+    records: iter,
+    max_points: int = 5000,
+) -> iter:
+    # At most max_points lines per chunk, time ordered within the chunk, so
+    # InfluxDB gets compact, mostly sequential writes.
+    list_record = []
+    for record in records:
+        list_record.append(record)
+        if len(list_record) >= max_points:
+            list_record.sort(key=lambda record: record[0])
+            yield list_record
+            list_record = []
+    if list_record:
+        list_record.sort(key=lambda record: record[0])
+        yield list_record
+
+def dedupe(
+    list_record: list,
+    set_existing: set = None,
+) -> list:
+    # One line per (series, field keys, timestamp), the last one wins like it
+    # would in InfluxDB. Points already stored are dropped too, only "value"
+    # field lines are compared, those are what the existing query returns.
+    # Single field lines of a chunk without escapes or quoted strings are keyed
+    # by slicing, readers only pass on lines _split_line accepts.
+    data = b"".join([line for _, line, _ in list_record])
+    plain = b"\\" not in data and b'"' not in data
+    dict_line = {}
+    for time_ns, line, _ in list_record:
+        equal = line.find(b"=", line.find(b" "))
+        if not plain or line.find(b",", equal) >= 0:
+            series, field_set, _ = _split_line(line)
+            key = series + b" " + b",".join(field.split(b"=", 1)[0] for field in field_set.split(b","))
+        else:
+            key = line[:equal]
+        dict_line[(key, time_ns)] = line
+    if set_existing:
+        return [
+            line for (key, time_ns), line in dict_line.items()
+            if not key.endswith(b" value") or (key[:-len(b" value")], time_ns // 1000) not in set_existing
+        ]
+    return list(dict_line.values())
+
+class Checkpoint:
+
+    def __init__(self,
+        path: str,
+    ) -> None:
+
+        logging.info(f"Initializing {self.__class__.__name__} class...")
+
+        # Written records per unit, counted over the chunks completed without a
+        # gap. Chunks finishing out of order are counted once the ones before
+        # them are done, so a resumed run may rewrite some points, never skip one.
+        self.path = path
+        self._lock = threading.Lock()
+        self._dict_done = {}
+
+        if os.path.exists(path):
+            try:
+                with open(path) as file:
+                    self._dict_done = json.load(file)
+                logging.info(f"Checkpoint {path} holds {sum(self._dict_done.values())} written points of {len(self._dict_done)} inputs")
+            except (ValueError, AttributeError) as e:
+                logging.error(f"Couldn't load checkpoint {path}, starting from the beginning: {e}")
+                self._dict_done = {}
+
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+
+        return None
+
+    def get_all(self) -> dict:
+        with self._lock:
+            return dict(self._dict_done)
+
+    def add(self,
+        dict_count: dict,
+    ) -> None:
+        with self._lock:
+            for unit, count in dict_count.items():
+                self._dict_done[unit] = self._dict_done.get(unit, 0) + count
+            data = json.dumps(self._dict_done)
+            path_tmp = f"{self.path}.tmp"
+            with open(path_tmp, "w") as file:
+                file.write(data)
+            os.replace(path_tmp, self.path)
+        return None
+
+    def close(self) -> None:
+        return None
+
+class Backfill:
+
+    def __init__(self,
+        write_function: callable,
+        number_of_workers: int = 4,
+        max_points: int = 5000,
+        checkpoint: Checkpoint = None,
+        existing_function: callable = None,
+        compress: bool = True,
+        max_attempts: int = 5,
+        backoff_initial_second: float = 1.0,
+        backoff_max_second: float = 60.0,
+    ) -> None:
+
+        logging.info(f"Initializing {self.__class__.__name__} class...")
+
+        # write_function(data, compressed) writes one chunk of line protocol.
+        # existing_function(start_ns, stop_ns) returns the (series key, time in
+        # us) pairs InfluxDB already holds in that range.
+        self.write_function = write_function
+        self.number_of_workers = number_of_workers
+        self.max_points = max_points
+        self.checkpoint = checkpoint
+        self.existing_function = existing_function
+        self.compress = compress
+        self.max_attempts = max_attempts
+        self.backoff_initial_second = backoff_initial_second
+        self.backoff_max_second = backoff_max_second
+
+        self._lock = threading.Lock()
+        self._dict_stats = {
+            'chunks_written': 0,
+            'chunks_failed': 0,
+            'points_read': 0,
+            'points_resumed': 0,
+            'points_written': 0,
+            'points_duplicate': 0,
+            'bytes_written': 0,
+            'retries': 0,
+        }
+
+        return None
+
+    def _count(self,
+        **dict_increment,
+    ) -> None:
+        with self._lock:
+            for key, value in dict_increment.items():
+                self._dict_stats[key] += value
+        return None
+
+    def _write_chunk(self,
+        list_record: list,
+    ) -> None:
+
+        set_existing = None
+        if self.existing_function is not None:
+            set_existing = self.existing_function(list_record[0][0], list_record[-1][0])
+        list_line = dedupe(list_record, set_existing)
+
+        if list_line:
+            # Compressed in the worker thread, zlib releases the GIL
+            data = b"".join(list_line)
+            if self.compress:
+                data = gzip.compress(data, compresslevel=1)
+
+            backoff = 0.0
+            for attempt in range(1, self.max_attempts + 1):
+                try:
+                    self.write_function(data, self.compress)
+                    break
+                except Exception as e:
+                    if attempt == self.max_attempts:
+                        raise
+                    backoff = min(max(backoff * 2, self.backoff_initial_second), self.backoff_max_second)
+                    logging.warning(f"Chunk write failed (attempt {attempt} of {self.max_attempts}), retrying in up to {backoff:.1f} s: {e}")
+                    self._count(retries=1)
+                    time.sleep(random.uniform(backoff / 2, backoff))
+            self._count(bytes_written=len(data))
+
+        self._count(chunks_written=1, points_written=len(list_line), points_duplicate=len(list_record) - len(list_line))
+        metrics.REGISTRY.inc("backfill_points_total", len(list_line))
+
+        return None
+
+    def _resume(self,
+        records: iter,
+    ) -> iter:
+
+        # Records of a unit come in the same order every run, its first
+        # checkpointed ones were written by an earlier run. Once they are all
+        # skipped records pass straight through.
+        dict_remaining = self.checkpoint.get_all() if self.checkpoint is not None else {}
+        resumed = 0
+        try:
+            for record in records:
+                if dict_remaining:
+                    unit = record[2]
+                    remaining = dict_remaining.get(unit)
+                    if remaining:
+                        if remaining == 1:
+                            del dict_remaining[unit]
+                        else:
+                            dict_remaining[unit] = remaining - 1
+                        resumed += 1
+                        continue
+                yield record
+        finally:
+            self._count(points_resumed=resumed)
+
+    def run(self,
+        records: iter,
+        progress_second: float = 10.0,
+    ) -> dict:
+
+        # At most two chunks per worker are in memory at any time, however
+        # large the input is.
+        semaphore = threading.Semaphore(2 * self.number_of_workers)
+        lock = threading.Lock()
+        dict_chunk_count = {}
+        set_chunk_done = set()
+        next_chunk = [0]
+
+        def done(future, chunk_index: int, list_record_size: int) -> None:
+            semaphore.release()
+            error = future.exception()
+            if error is not None:
+                self._count(chunks_failed=1)
+                metrics.REGISTRY.inc("backfill_chunks_total", result="failed")
+                logging.error(f"Chunk of {list_record_size} points failed, it will be retried on the next run: {error}")
+                return None
+            metrics.REGISTRY.inc("backfill_chunks_total", result="written")
+
+            if self.checkpoint is None:
+                return None
+            # Checkpointed up to the first chunk not written yet
+            dict_count = {}
+            with lock:
+                set_chunk_done.add(chunk_index)
+                while next_chunk[0] in set_chunk_done:
+                    set_chunk_done.remove(next_chunk[0])
+                    for unit, count in dict_chunk_count.pop(next_chunk[0]).items():
+                        dict_count[unit] = dict_count.get(unit, 0) + count
+                    next_chunk[0] += 1
+                if dict_count:
+                    self.checkpoint.add(dict_count)
+            return None
+
+        start = time.monotonic()
+        progress_at = start + progress_second
+        with ThreadPoolExecutor(max_workers=self.number_of_workers, thread_name_prefix="backfill") as executor:
+            for chunk_index, list_record in enumerate(chunk(self._resume(records), self.max_points)):
+                self._count(points_read=len(list_record))
+                with lock:
+                    dict_chunk_count[chunk_index] = collections.Counter(map(operator.itemgetter(2), list_record))
+
+                semaphore.acquire()
+                future = executor.submit(self._write_chunk, list_record)
+                future.add_done_callback(lambda future, chunk_index=chunk_index, size=len(list_record): done(future, chunk_index, size))
+
+                if time.monotonic() >= progress_at:
+                    progress_at += progress_second
+                    dict_stats = self.get_stats()
+                    logging.info(f"Backfill: {dict_stats['points_read']} points read, {dict_stats['points_written']} written ({dict_stats['points_written'] / (time.monotonic() - start):.0f} points/s)")
+
+        dict_stats = self.get_stats()
+        dict_stats['elapsed_second'] = time.monotonic() - start
+        logging.info(f"Backfill done in {dict_stats['elapsed_second']:.1f} s: {dict_stats}")
+
+        return dict_stats
+
+    def get_stats(self) -> dict:
+        with self._lock:
+            return dict(self._dict_stats)
+
+def get_existing_influxdb(
+    query_api: object,
+    bucket: str,
+    start_ns: int,
+    stop_ns: int,
+) -> set:
+    # The client parses timestamps to datetime, so keys are compared in us
+    flux = f'''from(bucket: "{bucket}")
+  |> range(start: time(v: {start_ns}), stop: time(v: {stop_ns + 1}))
+  |> filter(fn: (r) => r._field == "value")'''
+    set_existing = set()
+    for record in query_api.query_stream(flux):
+        dict_tag = {key: value for key, value in record.values.items() if not key.startswith("_") and key not in ("result", "table")}
+        series = points.series_key(record.get_measurement(), points.tag_set(dict_tag))[:-len(b" value=")]
+        time_value = record.get_time()
+        set_existing.add((series, int(time_value.timestamp()) * 10**6 + time_value.microsecond))
+    return set_existing
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Load historical data into InfluxDB in parallel, chunked, resumable writes.")
+    parser.add_argument("--spool", nargs="*", default=[], help="Spool directories, only their unacknowledged part is loaded")
+    parser.add_argument("--line-protocol", nargs="*", default=[], help="Line protocol files, optionally gzipped")
+    parser.add_argument("--csv", nargs="*", default=[], help="CSV files in long or wide format")
+    parser.add_argument("--csv-tags", default="location,phase,category", help="Columns of the CSV files used as tags")
+    parser.add_argument("--csv-time", default="time", help="Time column of the CSV files")
+    parser.add_argument("--huawei-pv", nargs=2, metavar=("START", "END"), help="FusionSolar history between two dates (YYYY-MM-DD)")
+    parser.add_argument("--workers", type=int, default=4)
+    parser.add_argument("--chunk-points", type=int, default=5000)
+    parser.add_argument("--checkpoint", default=os.path.join(os.getcwd(), "backfill_checkpoint.json"), help="Written points per input, a changed input is read again from its start")
+    parser.add_argument("--dedupe", action="store_true", help="Query InfluxDB and skip points it already holds")
+    parser.add_argument("--no-gzip", action="store_true")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format=FORMAT)
+
+    try:
+        from dotenv import load_dotenv
+        load_dotenv()
+    except ModuleNotFoundError:
+        logging.warning("dotenv module not found")
+
+    # Each source is read lazily and merged by time. The merge only orders
+    # sources that are themselves sorted: spool segments are sorted one at a
+    # time, line protocol and CSV files are taken as they are. Out of order
+    # input is still written, chunks are sorted on their own, just less compact.
+    list_iterator = [read_spool(directory) for directory in args.spool]
+    list_iterator += [read_line_protocol(path) for path in args.line_protocol]
+    list_iterator += [read_csv(path, args.csv_tags.split(","), args.csv_time) for path in args.csv]
+    if args.huawei_pv:
+        import classes
+        huawei_pv = classes.HuaweiPv(
+            username=os.getenv("HUAWEI_PV-USERNAME"),
+            password=os.getenv("HUAWEI_PV-PASSWORD"),
+            subdomain=os.getenv("HUAWEI_PV-SUBDOMAIN"),
+            captcha_model_path=os.path.join(os.getcwd(), "utils", "captcha_huawei.onnx"),
+            session_path=os.getenv("HUAWEI_PV-SESSION_PATH", os.path.join(os.getcwd(), "huawei_pv_session.json")),
+        )
+        list_date = [datetime.date.fromisoformat(value) for value in args.huawei_pv]
+        list_iterator.append(read_huawei_pv(huawei_pv, *list_date))
+    if not list_iterator:
+        parser.error("No input given")
+
+    import requests
+
+    # Chunks are posted as they are, already gzipped, on a pooled session
+    session = requests.Session()
+    session.mount("http", requests.adapters.HTTPAdapter(pool_maxsize=args.workers))
+    url = f"{os.getenv('INFLUXDB-URL').rstrip('/')}/api/v2/write"
+    dict_params = {'org': os.getenv("INFLUXDB-ORG"), 'bucket': os.getenv("INFLUXDB-BUCKET"), 'precision': "ns"}
+
+    def write_influxdb(data: bytes, compressed: bool) -> None:
+        dict_header = {'Authorization': f"Token {os.getenv('INFLUXDB-TOKEN')}", 'Content-Type': "text/plain; charset=utf-8"}
+        if compressed:
+            dict_header['Content-Encoding'] = "gzip"
+        response = session.post(url, params=dict_params, data=data, headers=dict_header, timeout=(3.05, 60.0))
+        response.raise_for_status()
+
+    client_influxdb = None
+    existing_function = None
+    if args.dedupe:
+        from influxdb_client import InfluxDBClient
+        client_influxdb = InfluxDBClient(url=os.getenv("INFLUXDB-URL"), token=os.getenv("INFLUXDB-TOKEN"), org=os.getenv("INFLUXDB-ORG"))
+        query_api = client_influxdb.query_api()
+        existing_function = lambda start_ns, stop_ns: get_existing_influxdb(query_api, os.getenv("INFLUXDB-BUCKET"), start_ns, stop_ns)
+
+    checkpoint = Checkpoint(args.checkpoint)
+    backfill = Backfill(
+        write_function=write_influxdb,
+        number_of_workers=args.workers,
+        max_points=args.chunk_points,
+        checkpoint=checkpoint,
+        existing_function=existing_function,
+        compress=not args.no_gzip,
+    )
+    try:
+        dict_stats = backfill.run(merge(*list_iterator))
+    finally:
+        checkpoint.close()
+        if client_influxdb is not None:
+            client_influxdb.close()
+
+    if dict_stats['chunks_failed']:
+        raise SystemExit(f"{dict_stats['chunks_failed']} chunks failed, run the same command again to retry them")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,77 @@
+import argparse
+import logging
+import os
+import tempfile
+import time
+
+import backfill
+import points
+import requests
+from benchmarks.simulators import HttpSimulator
+
+def generate_records(
+    number_of_points: int,
+    number_of_series: int = 60,
+) -> iter:
+    # 1 Hz history of number_of_series series, in time order
+    list_tag_set = [points.tag_set({'location': f"location{series // 3}", 'phase': f"L{series % 3 + 1}"}) for series in range(number_of_series)]
+    start_ns = 1_700_000_000 * 10**9
+    for index in range(number_of_points):
+        time_ns = start_ns + (index // number_of_series) * 10**9
+        line = points.series_key("active_power", list_tag_set[index % number_of_series]) + b"%r %d\n" % (1000.0 + index % 997, time_ns)
+        yield time_ns, line, "generated"
+
+def make_write_function(
+    url: str,
+) -> callable:
+    session = requests.Session()
+    session.mount("http", requests.adapters.HTTPAdapter(pool_maxsize=32))
+
+    def write(data: bytes, compressed: bool) -> None:
+        response = session.post(f"{url}/api/v2/write", data=data, headers={'Content-Encoding': "gzip"} if compressed else {})
+        response.raise_for_status()
+
+    return write
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Backfill throughput against the local InfluxDB stand-in: one point per request against chunked, parallel, gzipped writes.")
+    parser.add_argument("--points", type=int, default=1_000_000)
+    parser.add_argument("--single-points", type=int, default=2000, help="Points written one request at a time for the baseline")
+    parser.add_argument("--write-latency-second", type=float, default=0.02)
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, 4, 8])
+    parser.add_argument("--chunk-points", type=int, default=5000)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING)
+
+    simulator = HttpSimulator(write_latency_second=args.write_latency_second)
+    simulator.start()
+    write = make_write_function(simulator.url)
+
+    print(f"{'mode':<24} {'points':>10} {'pts/s':>10} {'requests':>9}")
+    try:
+        # Baseline: what an ad-hoc script does, one write call per point
+        start = time.perf_counter()
+        for _, line, _ in generate_records(args.single_points):
+            write(line, False)
+        rate = args.single_points / (time.perf_counter() - start)
+        print(f"{'one point per request':<24} {args.single_points:>10} {rate:>10.0f} {args.single_points:>9}")
+
+        for number_of_workers in args.workers:
+            with tempfile.TemporaryDirectory() as directory:
+                writes_before = simulator.writes
+                runner = backfill.Backfill(
+                    write_function=write,
+                    number_of_workers=number_of_workers,
+                    max_points=args.chunk_points,
+                    checkpoint=backfill.Checkpoint(os.path.join(directory, "checkpoint.json")),
+                )
+                dict_stats = runner.run(generate_records(args.points))
+                runner.checkpoint.close()
+            rate = dict_stats['points_written'] / dict_stats['elapsed_second']
+            print(f"{f'chunked, {number_of_workers} workers':<24} {dict_stats['points_written']:>10} {rate:>10.0f} {simulator.writes - writes_before:>9}")
+    finally:
+        simulator.stop()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,60 @@
+import argparse
+import logging
+import time
+
+import derived
+import points
+
+# Same shape as the rules in main.py
+LIST_DERIVED = [
+    {"type": "sum", "input": {"measurement": "active_power", "tags": {"category": "load"}}, "group_by": ["location", "category"], "output": {"measurement": "active_power", "tags": {"phase": "total"}}, "min_count": 3},
+    {"type": "difference", "left": {"measurement": "active_power", "tags": {"location": "Laboratory", "phase": "total"}}, "right": {"measurement": "active_power", "tags": {"location": "Laboratory", "category": "pv"}}, "output": {"measurement": "net_power", "tags": {"location": "Laboratory"}}, "max_age_second": 120},
+    {"type": "integral", "input": {"measurement": "active_power", "tags": {"phase": "total"}}, "output": {"measurement": "active_energy_integrated"}, "max_gap_second": 10},
+]
+
+def make_batches(
+    number_of_meters: int,
+    number_of_batches: int,
+) -> list:
+    # One 1 Hz batch per second: three phases of power per load meter plus PV
+    list_tag_set = [
+        points.tag_set({'location': "Laboratory" if meter == 0 else f"location{meter}", 'phase': f"L{phase+1}", 'category': "load"})
+        for meter in range(number_of_meters)
+        for phase in range(3)
+    ]
+    tag_set_pv = points.tag_set({'location': "Laboratory", 'category': "pv"})
+    start_ns = 1_700_000_000 * 10**9
+    list_batch = []
+    for second in range(number_of_batches):
+        batch = points.PointBatch()
+        time_ns = start_ns + second * 10**9
+        for index, tag_set in enumerate(list_tag_set):
+            batch.append("active_power", tag_set, 1000.0 + (second + index) % 100, time_ns)
+            batch.append("voltage", tag_set, 230.0, time_ns)
+        if second % 60 == 0:
+            batch.append("active_power", tag_set_pv, 800.0, time_ns)
+        list_batch.append(batch)
+    return list_batch
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Cost of the derived metrics stage (LIST_DERIVED) per 1 Hz batch.")
+    parser.add_argument("--meters", type=int, nargs="+", default=[1, 10, 100, 500])
+    parser.add_argument("--batches", type=int, default=300)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING)
+
+    print(f"{'meters':>8} {'points/batch':>13} {'derived/batch':>14} {'us/batch':>10} {'ns/point':>10}")
+    for number_of_meters in args.meters:
+        list_batch = make_batches(number_of_meters, args.batches)
+        obj_derived = derived.DerivedMetrics(LIST_DERIVED)
+        number_of_derived = 0
+        start = time.perf_counter()
+        for batch in list_batch:
+            number_of_derived += len(obj_derived.process(batch))
+        elapsed = time.perf_counter() - start
+        number_of_points = sum(len(batch) for batch in list_batch)
+        print(f"{number_of_meters:>8} {number_of_points // args.batches:>13} {number_of_derived // args.batches:>14} {elapsed / args.batches * 1e6:>10.0f} {elapsed / number_of_points * 1e9:>10.0f}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,47 @@
+import argparse
+import logging
+import time
+
+import modbus_tcp
+from benchmarks.simulators import ModbusTcpSimulator
+
+def measure(function: callable, repeat: int) -> float:
+    start = time.perf_counter()
+    for _ in range(repeat):
+        function()
+    return (time.perf_counter() - start) / repeat
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Compare serial and pipelined polling of meters behind a Modbus TCP gateway.")
+    parser.add_argument("--meters", type=int, nargs="+", default=[1, 4, 16, 32])
+    parser.add_argument("--latency-second", type=float, default=0.01)
+    parser.add_argument("--max-outstanding", type=int, default=16)
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING)
+
+    simulator = ModbusTcpSimulator(latency_second=args.latency_second)
+    simulator.start()
+    host, port = simulator.address
+
+    print(f"{'meters':>8} {'requests':>9} {'serial ms':>10} {'pipelined ms':>13} {'speedup':>8}")
+    try:
+        for number_of_meters in args.meters:
+            gateway = modbus_tcp.ModbusTcpGateway(host, port, max_outstanding=args.max_outstanding, timeout_second=5.0)
+            panel = modbus_tcp.ModbusTcpPanel(gateway)
+            for unit_id in range(1, number_of_meters + 1):
+                panel.add_device(unit_id, f"meter{unit_id}")
+
+            # Serial: the same persistent connection, one block read at a time
+            serial_second = measure(lambda: [device.get_all_points_influxdb() for device in panel.list_device], args.repeat)
+            pipelined_second = measure(panel.poll, args.repeat)
+            requests = sum(len(device.list_block_read) for device in panel.list_device)
+
+            print(f"{number_of_meters:>8} {requests:>9} {serial_second * 1e3:>10.1f} {pipelined_second * 1e3:>13.1f} {serial_second / pipelined_second:>7.1f}x")
+            gateway.close()
+    finally:
+        simulator.stop()
+
+if __name__ == "__main__":
+    main()
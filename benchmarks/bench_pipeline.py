@@ -0,0 +1,207 @@
+import argparse
+import logging
+import resource
+import shutil
+import tempfile
+import threading
+import time
+
+import numpy as np
+from influxdb_client import InfluxDBClient, WritePrecision
+from influxdb_client.client.write_api import SYNCHRONOUS
+
+import classes
+import modbus_device
+import points
+import scheduler
+import spool
+import writer
+from benchmarks import simulators
+
+DICT_SCENARIO = {
+    "baseline": {},
+    "devices-10": {"shelly_devices": 10},
+    "devices-100": {"shelly_devices": 100},
+    "devices-500": {"shelly_devices": 500},
+    "modbus-4": {"modbus_meters": 4},
+    "slow-devices": {"shelly_devices": 50, "slow_devices": 5, "slow_device_latency_second": 3.0},
+    "slow-co2signal": {"co2signal_latency_second": 5.0},
+    "write-failures": {"shelly_devices": 50, "write_failure_rate": 0.3},
+    "shelly-local": {"shelly_devices": 50, "shelly_local": True},
+    "shelly-local-fallback": {"shelly_devices": 50, "shelly_local": True, "offline_devices": 5},
+}
+
+DICT_SCENARIO_DEFAULT = {
+    "shelly_devices": 2,
+    "modbus_meters": 1,
+    "slow_devices": 0,
+    "slow_device_latency_second": 0.0,
+    "shelly_local": False,
+    "offline_devices": 0,
+    "shelly_latency_second": 0.05,
+    "co2signal_latency_second": 0.2,
+    "write_latency_second": 0.01,
+    "write_failure_rate": 0.0,
+    "co2signal_frequency_second": 5.0,
+    "writer_max_age_second": 1.0,
+}
+
+class SourceTimer:
+
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self.dict_duration = {}
+
+    def wrap(self,
+        name: str,
+        function: callable,
+    ) -> callable:
+        def timed():
+            start = time.perf_counter()
+            try:
+                return function()
+            finally:
+                with self._lock:
+                    self.dict_duration.setdefault(name, []).append(time.perf_counter() - start)
+        return timed
+
+    def get_percentile_second(self,
+        name: str,
+        list_percentile: list = [50, 99],
+    ) -> list:
+        with self._lock:
+            list_duration = self.dict_duration.get(name)
+            if not list_duration:
+                return [float("nan")] * len(list_percentile)
+            return np.percentile(np.array(list_duration), list_percentile).tolist()
+
+def run_scenario(
+    name: str,
+    duration_second: float,
+    seed: int,
+) -> dict:
+
+    config = {**DICT_SCENARIO_DEFAULT, **DICT_SCENARIO[name]}
+
+    dict_location_id = {f"location{i}": f"device{i}" for i in range(config["shelly_devices"])}
+    dict_slow_device = {f"device{i}": config["slow_device_latency_second"] for i in range(config["slow_devices"])}
+
+    simulator = simulators.HttpSimulator(
+        shelly_latency_second=config["shelly_latency_second"],
+        co2signal_latency_second=config["co2signal_latency_second"],
+        write_latency_second=config["write_latency_second"],
+        write_failure_rate=config["write_failure_rate"],
+        dict_slow_device=dict_slow_device,
+        set_offline_device={f"device{i}" for i in range(config["offline_devices"])},
+        seed=seed,
+    )
+    simulator.start()
+
+    dict_id_host = {}
+    if config["shelly_local"]:
+        dict_id_host = {id: f"{simulator.url[len('http://'):]}/local/{id}" for id in dict_location_id.values()}
+
+    obj_shelly = classes.Shelly3Em(url=f"{simulator.url}/shelly", token="benchmark", max_concurrency=64, dict_id_host=dict_id_host)
+    obj_co2signal = classes.Co2Signal(url=f"{simulator.url}/co2", auth="benchmark")
+    list_modbus = [
+        modbus_device.ModbusRtuF4N200(port=f"simulated{i}", instrument=simulators.FakeF4N200Instrument(seed=seed + i))
+        for i in range(config["modbus_meters"])
+    ]
+
+    directory = tempfile.mkdtemp(prefix="bench_spool_")
+    client_influxdb = InfluxDBClient(url=simulator.url, token="benchmark", org="benchmark", enable_gzip=True)
+    write_api = client_influxdb.write_api(write_options=SYNCHRONOUS)
+
+    def write_influxdb(data: bytes) -> None:
+        write_api.write(bucket="benchmark", record=data, write_precision=WritePrecision.NS)
+
+    obj_spool = spool.Spool(directory)
+    obj_spool_drainer = spool.SpoolDrainer(obj_spool, write_influxdb, backoff_initial_second=0.2, backoff_max_second=2.0)
+    obj_batch_writer = writer.BatchWriter(
+        write_function=obj_spool.append,
+        max_age_second=config["writer_max_age_second"],
+        queue_full_policy="spill",
+        spill_function=obj_spool.append,
+    )
+
+    def get_points_modbus() -> points.PointBatch:
+        batch = points.PointBatch()
+        for obj_modbus in list_modbus:
+            batch.extend(obj_modbus.get_all_points_influxdb())
+        return batch
+
+    def get_points_co2signal() -> points.PointBatch:
+        batch = points.PointBatch()
+        for zone_code in ["IT-NO", "IT-CSO"]:
+            batch.extend(obj_co2signal.get_point_influxdb(zone_code))
+        return batch
+
+    timer = SourceTimer()
+    obj_scheduler = scheduler.Scheduler()
+    obj_scheduler.add_job("shelly", timer.wrap("shelly", lambda: obj_shelly.get_points_influxdb(dict_location_id)), 1.0, callback=obj_batch_writer.put)
+    obj_scheduler.add_job("modbus", timer.wrap("modbus", get_points_modbus), 1.0, callback=obj_batch_writer.put)
+    obj_scheduler.add_job("co2signal", timer.wrap("co2signal", get_points_co2signal), config["co2signal_frequency_second"], callback=obj_batch_writer.put)
+
+    obj_spool_drainer.start()
+    obj_batch_writer.start()
+
+    rss_start = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    cpu_start = time.process_time()
+    wall_start = time.perf_counter()
+
+    threading.Timer(duration_second, obj_scheduler.stop).start()
+    obj_scheduler.run()
+
+    obj_batch_writer.stop()
+    # Give the drainer time to replay what failed writes left in the spool
+    deadline = time.monotonic() + 10.0
+    while obj_spool.get_backlog_bytes() and time.monotonic() < deadline:
+        time.sleep(0.1)
+    obj_spool_drainer.stop()
+
+    wall_second = time.perf_counter() - wall_start
+    cpu_second = time.process_time() - cpu_start
+    rss_peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    obj_spool.close()
+    client_influxdb.close()
+    simulator.stop()
+    shutil.rmtree(directory, ignore_errors=True)
+
+    latency_p50, latency_p99 = simulator.get_latency_percentile_second()
+    return {
+        'scenario': name,
+        'points': simulator.points_captured,
+        'points_per_second': simulator.points_captured / wall_second,
+        'cpu_us_per_point': cpu_second / simulator.points_captured * 1e6 if simulator.points_captured else float("nan"),
+        'rss_peak_mib': rss_peak / 1024,
+        'rss_growth_mib': (rss_peak - rss_start) / 1024,
+        'latency_p50_second': latency_p50,
+        'latency_p99_second': latency_p99,
+        'writes': simulator.writes,
+        'writes_failed': simulator.writes_failed,
+        'dict_poll_second': {source: timer.get_percentile_second(source) for source in ["shelly", "modbus", "co2signal"]},
+    }
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Run the acquisition pipeline against simulated Modbus, Shelly, CO2Signal and InfluxDB.")
+    parser.add_argument("--scenario", nargs="+", default=list(DICT_SCENARIO), choices=list(DICT_SCENARIO))
+    parser.add_argument("--duration", type=float, default=10.0, help="Seconds per scenario")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--log-level", default="WARNING")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=args.log_level)
+
+    print(f"{'scenario':<16} {'points':>8} {'pts/s':>9} {'cpu us/pt':>10} {'rss MiB':>8} {'p50 s':>7} {'p99 s':>7} {'writes':>7} {'failed':>7}  poll p50/p99 s (shelly | modbus | co2signal)")
+    for name in args.scenario:
+        result = run_scenario(name, args.duration, args.seed)
+        poll = " | ".join(f"{p50:.3f}/{p99:.3f}" for p50, p99 in result['dict_poll_second'].values())
+        print(
+            f"{result['scenario']:<16} {result['points']:>8} {result['points_per_second']:>9.1f} {result['cpu_us_per_point']:>10.1f} "
+            f"{result['rss_peak_mib']:>8.1f} {result['latency_p50_second']:>7.3f} {result['latency_p99_second']:>7.3f} "
+            f"{result['writes']:>7} {result['writes_failed']:>7}  {poll}"
+        )
+
+if __name__ == "__main__":
+    main()
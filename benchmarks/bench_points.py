@@ -0,0 +1,90 @@
+import argparse
+import datetime
+import gc
+import time
+import tracemalloc
+
+from influxdb_client import WritePrecision
+from influxdb_client.client.write.point import Point
+
+import points
+
+LIST_MEASUREMENT = [
+    "voltage",
+    "active_power",
+    "power_factor",
+    "active_energy",
+]
+
+EMETER = {"voltage": 230.12, "power": 1234.5, "pf": 0.93, "total": 123456.7}
+DICT_MEASUREMENT_TO_FIELD = {"voltage": "voltage", "active_power": "power", "power_factor": "pf", "active_energy": "total"}
+
+def build_dict(number_of_devices: int) -> list:
+    # Same shape as the Shelly3Em path before PointBatch: one dict and one
+    # isoformat() timestamp per point, serialized by the Influx client.
+    list_point = []
+    for device in range(number_of_devices):
+        for phase in range(3):
+            for measurement in LIST_MEASUREMENT:
+                list_point.append({
+                    'measurement': measurement,
+                    'tags': {
+                        'location': f"location{device}",
+                        'phase': f"L{phase+1}",
+                        "category": "load"
+                    },
+                    'fields': {
+                        'value': float(EMETER[DICT_MEASUREMENT_TO_FIELD[measurement]]),
+                    },
+                    'time': datetime.datetime.utcnow().isoformat(),
+                })
+    return list_point
+
+def encode_dict(list_point: list) -> bytes:
+    return "\n".join(Point.from_dict(point, WritePrecision.NS).to_line_protocol() for point in list_point).encode()
+
+def build_batch(number_of_devices: int, list_tag_set: list) -> points.PointBatch:
+    time_ns = points.now_ns()
+    batch = points.PointBatch()
+    for device in range(number_of_devices):
+        for phase in range(3):
+            tag_set = list_tag_set[device][phase]
+            for measurement in LIST_MEASUREMENT:
+                batch.append(measurement, tag_set, float(EMETER[DICT_MEASUREMENT_TO_FIELD[measurement]]), time_ns)
+    return batch
+
+def measure(function: callable, repeat: int) -> tuple:
+    gc.collect()
+    start = time.perf_counter()
+    for _ in range(repeat):
+        function()
+    elapsed = (time.perf_counter() - start) / repeat
+
+    tracemalloc.start()
+    function()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    return elapsed, peak
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Compare the dict point path with PointBatch line protocol encoding.")
+    parser.add_argument("--devices", type=int, nargs="+", default=[1, 10, 100, 500])
+    parser.add_argument("--repeat", type=int, default=20)
+    args = parser.parse_args()
+
+    print(f"{'devices':>8} {'points':>8} {'dict ms':>10} {'batch ms':>10} {'speedup':>8} {'dict KiB':>10} {'batch KiB':>10}")
+    for number_of_devices in args.devices:
+        list_tag_set = [
+            [points.tag_set({'location': f"location{device}", 'phase': f"L{phase+1}", "category": "load"}) for phase in range(3)]
+            for device in range(number_of_devices)
+        ]
+        buffer = bytearray()
+
+        dict_second, dict_peak = measure(lambda: encode_dict(build_dict(number_of_devices)), args.repeat)
+        batch_second, batch_peak = measure(lambda: build_batch(number_of_devices, list_tag_set).encode(buffer), args.repeat)
+
+        print(f"{number_of_devices:>8} {number_of_devices * 12:>8} {dict_second * 1e3:>10.3f} {batch_second * 1e3:>10.3f} {dict_second / batch_second:>7.1f}x {dict_peak / 1024:>10.1f} {batch_peak / 1024:>10.1f}")
+
+if __name__ == "__main__":
+    main()
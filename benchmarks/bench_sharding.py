@@ -0,0 +1,115 @@
+import argparse
+import json
+import logging
+import os
+import threading
+import time
+
+import points
+import sharding
+
+# Same shape as a Shelly cloud response for one 3EM
+PAYLOAD = json.dumps({
+    'isok': True,
+    'data': {'device_status': {'emeters': [
+        {'power': 1234.5, 'pf': 0.93, 'current': 5.4, 'voltage': 230.1, 'is_valid': True, 'total': 123456.7, 'total_returned': 0.0}
+        for _ in range(3)
+    ]}},
+}).encode()
+
+DICT_MEASUREMENT_TO_FIELD = {"voltage": "voltage", "active_power": "power", "power_factor": "pf", "active_energy": "total"}
+
+def poll_devices(
+    send: callable,
+    number_of_devices: int,
+    shard_index: int,
+    shard_count: int,
+    duration_second: float,
+) -> None:
+
+    # CPU-bound part of a Shelly cycle: parse each device's JSON and build its points
+    list_tag_set = [
+        [points.tag_set({'location': f"location{device}", 'phase': f"L{phase+1}", "category": "load"}) for phase in range(3)]
+        for device in range(shard_index, number_of_devices, shard_count)
+    ]
+    deadline = time.monotonic() + duration_second
+    while time.monotonic() < deadline:
+        time_ns = points.now_ns()
+        batch = points.PointBatch()
+        for list_device_tag_set in list_tag_set:
+            list_emeter = json.loads(PAYLOAD)['data']['device_status']['emeters']
+            for tag_set, emeter in zip(list_device_tag_set, list_emeter):
+                for measurement, field in DICT_MEASUREMENT_TO_FIELD.items():
+                    batch.append(measurement, tag_set, float(emeter[field]), time_ns)
+        send(batch)
+
+def poll_devices_worker(
+    send: callable,
+    *args,
+) -> None:
+    poll_devices(send, *args)
+    # A worker that returns is restarted, this one idles until it's stopped
+    while True:
+        time.sleep(1)
+
+class Counter:
+
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self.points = 0
+        self.encoded_bytes = 0
+        self._buffer = bytearray()
+
+    def add(self,
+        batch: points.PointBatch,
+    ) -> None:
+        # The writer side still encodes every batch to line protocol
+        with self._lock:
+            self.points += len(batch)
+            self.encoded_bytes += len(batch.encode(self._buffer))
+
+def run(
+    number_of_workers: int,
+    number_of_devices: int,
+    duration_second: float,
+) -> float:
+
+    counter = Counter()
+    if number_of_workers == 0:
+        start = time.perf_counter()
+        poll_devices(counter.add, number_of_devices, 0, 1, duration_second)
+        return counter.points / (time.perf_counter() - start)
+
+    supervisor = sharding.ShardSupervisor(counter.add)
+    for shard_index in range(number_of_workers):
+        supervisor.add_worker(f"shard{shard_index}", poll_devices_worker, (number_of_devices, shard_index, number_of_workers, duration_second))
+    start = time.perf_counter()
+    supervisor.start()
+    time.sleep(duration_second)
+    # Let the writer side catch up with what the workers sent
+    while True:
+        points_before = counter.points
+        time.sleep(0.2)
+        if counter.points == points_before:
+            break
+    elapsed = time.perf_counter() - start - 0.2
+    supervisor.stop()
+    return counter.points / elapsed
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Points/s of the Shelly decode path in-process and sharded across worker processes.")
+    parser.add_argument("--workers", type=int, nargs="+", default=[0, 1, 2, 4])
+    parser.add_argument("--devices", type=int, default=500)
+    parser.add_argument("--duration", type=float, default=5.0)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING)
+
+    print(f"{os.cpu_count()} CPUs")
+    print(f"{'workers':>8} {'pts/s':>12}")
+    for number_of_workers in args.workers:
+        rate = run(number_of_workers, args.devices, args.duration)
+        print(f"{number_of_workers or 'inline':>8} {rate:>12.0f}")
+
+if __name__ == "__main__":
+    main()
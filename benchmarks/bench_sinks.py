@@ -0,0 +1,102 @@
+import argparse
+import gzip
+import logging
+import os
+import random
+import tempfile
+import time
+
+import points
+import sinks
+
+DICT_MEASUREMENT = {
+    "voltage": 230.0,
+    "current": 5.0,
+    "active_power": 1150.0,
+    "power_factor": 0.93,
+}
+
+def make_batches(
+    number_of_meters: int,
+    duration_second: int,
+) -> list:
+
+    # One batch per second of 1 Hz three-phase meter data, noisy like real readings
+    rng = random.Random(0)
+    list_tag_set = [
+        points.tag_set({'location': f"location{meter}", 'phase': f"L{phase+1}", 'category': "load"})
+        for meter in range(number_of_meters)
+        for phase in range(3)
+    ]
+    start_ns = 1_700_000_000 * 10**9
+    list_batch = []
+    for second in range(duration_second):
+        batch = points.PointBatch()
+        time_ns = start_ns + second * 10**9
+        for index, tag_set in enumerate(list_tag_set):
+            for measurement, base in DICT_MEASUREMENT.items():
+                batch.append(measurement, tag_set, round(base * rng.uniform(0.95, 1.05), 3), time_ns)
+        list_batch.append(batch)
+    return list_batch
+
+def get_size(
+    path: str,
+) -> int:
+    if os.path.isfile(path):
+        return os.path.getsize(path)
+    return sum(os.path.getsize(os.path.join(root, name)) for root, _, list_name in os.walk(path) for name in list_name)
+
+def run_line_protocol(
+    list_batch: list,
+    directory: str,
+    compress: bool,
+) -> str:
+    path = os.path.join(directory, "data.lp.gz" if compress else "data.lp")
+    buffer = bytearray()
+    with (gzip.open(path, "wb") if compress else open(path, "wb")) as file:
+        for batch in list_batch:
+            file.write(batch.encode(buffer))
+    return path
+
+def run_sink(
+    sink: sinks.Sink,
+    list_batch: list,
+    max_points: int,
+) -> None:
+    for batch in list_batch:
+        sink.write(batch)
+        if sink.buffered_points >= max_points:
+            sink.flush()
+    sink.close()
+    return None
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Disk usage and CPU time of line protocol files against the Parquet and SQLite sinks.")
+    parser.add_argument("--meters", type=int, default=20)
+    parser.add_argument("--duration", type=int, default=3600)
+    parser.add_argument("--max-points", type=int, default=100_000)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING)
+
+    list_batch = make_batches(args.meters, args.duration)
+    number_of_points = sum(len(batch) for batch in list_batch)
+    print(f"{number_of_points} points ({args.meters} meters, {args.duration} s at 1 Hz)")
+    print(f"{'output':<16} {'MiB':>8} {'B/point':>8} {'CPU s':>8} {'ns/point':>9}")
+
+    with tempfile.TemporaryDirectory() as directory:
+        dict_run = {
+            "line-protocol": lambda: run_line_protocol(list_batch, directory, False),
+            "line-proto-gzip": lambda: run_line_protocol(list_batch, directory, True),
+            "parquet": lambda: run_sink(sinks.ParquetSink(os.path.join(directory, "parquet")), list_batch, args.max_points) or os.path.join(directory, "parquet"),
+            "sqlite": lambda: run_sink(sinks.SqliteSink(os.path.join(directory, "data.sqlite")), list_batch, args.max_points) or os.path.join(directory, "data.sqlite"),
+        }
+        for name, function in dict_run.items():
+            start = time.process_time()
+            path = function()
+            cpu_second = time.process_time() - start
+            size = get_size(path)
+            print(f"{name:<16} {size / 2**20:>8.2f} {size / number_of_points:>8.1f} {cpu_second:>8.2f} {cpu_second / number_of_points * 1e9:>9.0f}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,75 @@
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+
+# Each scenario runs in a fresh interpreter, the child reports its own wall time
+# from interpreter start and its peak RSS.
+CODE_TEMPLATE = """
+import resource, time
+start = time.perf_counter()
+{code}
+elapsed = time.perf_counter() - start
+import json, sys
+print(json.dumps({{
+    'second': elapsed,
+    'rss_kib': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+    'modules': len(sys.modules),
+    'heavy': sorted(name for name in ('influxdb_client', 'fusion_solar_py', 'minimalmodbus', 'numpy', 'requests') if name in sys.modules),
+}}))
+"""
+
+DICT_SCENARIO = {
+    "python": "pass",
+    "import-shelly.py": "import shelly",
+    "import-main.py": "import main",
+    "main-shelly-loaded": "import main; main.obj_source_registry.get('shelly')",
+    "main-all-stacks": "import main, classes, modbus_bus, rollup, cache, influxdb_client, fusion_solar_py.client, minimalmodbus",
+}
+
+def run(
+    code: str,
+    env: dict,
+) -> dict:
+    output = subprocess.run(
+        [sys.executable, "-c", CODE_TEMPLATE.format(code=code)],
+        env=env,
+        capture_output=True,
+        check=True,
+        text=True,
+    ).stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Measure cold import time and memory of the entry points in fresh interpreters.")
+    parser.add_argument("--scenario", nargs="+", choices=list(DICT_SCENARIO), default=list(DICT_SCENARIO))
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        env = {
+            **os.environ,
+            "PYTHONPATH": os.getcwd(),
+            "PYTHONDONTWRITEBYTECODE": "",
+            "SPOOL-DIRECTORY": directory,
+            "INFLUXDB-URL": "http://127.0.0.1:9",
+            "SHELLY-URL": "http://127.0.0.1:9/shelly",
+            "SHELLY-TOKEN": "benchmark",
+            "SOURCES": "shelly",
+            "METRICS-ENABLED": "false",
+        }
+
+        print(f"{'scenario':<20} {'ms':>8} {'rss MiB':>8} {'modules':>8}  heavy modules loaded")
+        for name in args.scenario:
+            # First run warms the bytecode cache, it isn't counted
+            run(DICT_SCENARIO[name], env)
+            list_result = [run(DICT_SCENARIO[name], env) for _ in range(args.repeat)]
+            second = statistics.median(result['second'] for result in list_result)
+            rss_kib = statistics.median(result['rss_kib'] for result in list_result)
+            print(f"{name:<20} {second * 1e3:>8.1f} {rss_kib / 1024:>8.1f} {list_result[-1]['modules']:>8}  {', '.join(list_result[-1]['heavy']) or '-'}")
+
+if __name__ == "__main__":
+    main()
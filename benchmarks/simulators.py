@@ -0,0 +1,370 @@
+import gzip
+import json
+import random
+import socket
+import socketserver
+import struct
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+import numpy as np
+
+# Register contents of a F4N200 under a typical three phase load, longs span two words
+DICT_F4N200_LONG = {
+    4096: 230_000, 4098: 231_000, 4100: 229_000,
+    4140: 150_000, 4142: 120_000, 4144: 90_000,
+    4688: 12_345_678, 4690: 1_234_567, 4692: 345_678, 4694: 34_567,
+}
+DICT_F4N200_REGISTER = {
+    4146: 0, 4147: 0, 4148: 1,
+    4164: 95, 4165: 93, 4166: 0xFFA6,
+}
+
+class FakeSerial:
+
+    def __init__(self) -> None:
+        self.baudrate = 19200
+        self.parity = 'E'
+        self.port = "simulated"
+
+class FakeF4N200Instrument:
+
+    def __init__(self,
+        baudrate: int = 19200,
+        turnaround_second: float = 0.005,
+        failure_rate: float = 0.0,
+        seed: int = 0,
+    ) -> None:
+
+        self.serial = FakeSerial()
+        self.serial.baudrate = baudrate
+        self.turnaround_second = turnaround_second
+        self.failure_rate = failure_rate
+        self.transactions = 0
+
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self._dict_word = {}
+        for register_address, value in DICT_F4N200_LONG.items():
+            self._dict_word[register_address] = value >> 16
+            self._dict_word[register_address + 1] = value & 0xFFFF
+        self._dict_word.update(DICT_F4N200_REGISTER)
+
+    def _transaction(self,
+        number_of_registers: int,
+    ) -> None:
+
+        # RTU frame time: 11 bits per character, 8 byte request, 5 + 2n byte
+        # response, 3.5 character silent interval after each frame.
+        character_second = 11 / self.serial.baudrate
+        time.sleep((8 + 5 + 2 * number_of_registers + 7) * character_second + self.turnaround_second)
+
+        with self._lock:
+            self.transactions += 1
+            if self._random.random() < self.failure_rate:
+                raise IOError("No communication with the instrument (no answer)")
+
+    def read_registers(self,
+        registeraddress: int,
+        number_of_registers: int,
+        functioncode: int = 3,
+    ) -> list:
+        self._transaction(number_of_registers)
+        return [self._dict_word.get(registeraddress + i, 0) for i in range(number_of_registers)]
+
+    def read_long(self,
+        registeraddress: int,
+        functioncode: int = 3,
+        signed: bool = False,
+        byteorder: int = 0,
+        number_of_registers: int = 2,
+    ) -> int:
+        self._transaction(2)
+        return (self._dict_word.get(registeraddress, 0) << 16) | self._dict_word.get(registeraddress + 1, 0)
+
+    def read_register(self,
+        registeraddress: int,
+        number_of_decimals: int = 0,
+        functioncode: int = 3,
+        signed: bool = False,
+    ) -> int:
+        self._transaction(1)
+        value = self._dict_word.get(registeraddress, 0)
+        if signed and value >= 0x8000:
+            value -= 0x10000
+        return value
+
+class _SimulatorRequestHandler(BaseHTTPRequestHandler):
+
+    protocol_version = "HTTP/1.1"
+    # Headers and body go out in separate writes, with Nagle on the body would
+    # wait for the client's delayed ACK and add ~40 ms to every response.
+    disable_nagle_algorithm = True
+
+    def _send(self,
+        status: int,
+        body: bytes = b"",
+        content_type: str = "application/json",
+    ) -> None:
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _read_body(self) -> bytes:
+        body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        if self.headers.get("Content-Encoding") == "gzip":
+            body = gzip.decompress(body)
+        return body
+
+    def do_GET(self) -> None:
+        simulator = self.server.simulator
+        url = urlparse(self.path)
+        if url.path == "/co2":
+            simulator.sleep(simulator.co2signal_latency_second)
+            zone_code = parse_qs(url.query).get("countryCode", ["XX"])[0]
+            with simulator._lock:
+                simulator.co2signal_requests += 1
+            # Data only changes on the hour, so the hour is a valid ETag
+            etag = f'"{zone_code}-{int(time.time() // 3600)}"'
+            if self.headers.get("If-None-Match") == etag:
+                self.send_response(304)
+                self.send_header("ETag", etag)
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+                return
+            body = json.dumps({
+                'countryCode': zone_code,
+                'data': {'carbonIntensity': 250.0, 'fossilFuelPercentage': 40.0},
+            }).encode()
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.send_header("ETag", etag)
+            self.end_headers()
+            self.wfile.write(body)
+        elif url.path.startswith("/local/") and url.path.endswith("/status"):
+            # Local 3EM status endpoint, one path prefix per simulated device
+            id = url.path.split("/")[2]
+            if id in simulator.set_offline_device:
+                self._send(503)
+                return
+            simulator.sleep(simulator.shelly_local_latency_second)
+            self._send(200, json.dumps({'emeters': simulator.get_emeters()}).encode())
+        else:
+            self._send(404)
+
+    def do_POST(self) -> None:
+        simulator = self.server.simulator
+        url = urlparse(self.path)
+        body = self._read_body()
+
+        if url.path == "/shelly":
+            id = parse_qs(body.decode()).get("id", [""])[0]
+            simulator.sleep(simulator.shelly_latency_second + simulator.dict_slow_device.get(id, 0.0))
+            self._send(200, json.dumps({
+                'isok': True,
+                'data': {'device_status': {'emeters': simulator.get_emeters()}},
+            }).encode())
+
+        elif url.path == "/api/v2/write":
+            if simulator.write_failure():
+                self._send(503, b'{"code":"unavailable","message":"simulated outage"}')
+                return
+            simulator.sleep(simulator.write_latency_second)
+            simulator.capture(body)
+            self._send(204)
+
+        else:
+            self._send(404)
+
+    def log_message(self, format, *args) -> None:
+        pass
+
+class HttpSimulator:
+
+    def __init__(self,
+        shelly_latency_second: float = 0.05,
+        co2signal_latency_second: float = 0.2,
+        write_latency_second: float = 0.01,
+        write_failure_rate: float = 0.0,
+        dict_slow_device: dict = {},
+        shelly_local_latency_second: float = 0.003,
+        set_offline_device: set = set(),
+        jitter: float = 0.2,
+        seed: int = 0,
+    ) -> None:
+
+        self.shelly_latency_second = shelly_latency_second
+        self.shelly_local_latency_second = shelly_local_latency_second
+        self.set_offline_device = set_offline_device
+        self.co2signal_latency_second = co2signal_latency_second
+        self.write_latency_second = write_latency_second
+        self.write_failure_rate = write_failure_rate
+        self.dict_slow_device = dict_slow_device
+        self.jitter = jitter
+
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self._list_latency_ns = []
+        self.points_captured = 0
+        self.co2signal_requests = 0
+        self.writes = 0
+        self.writes_failed = 0
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), _SimulatorRequestHandler)
+        self.server.daemon_threads = True
+        self.server.request_queue_size = 1024
+        self.server.simulator = self
+        self._thread = None
+
+    @property
+    def url(self) -> str:
+        return f"http://127.0.0.1:{self.server.server_address[1]}"
+
+    def sleep(self,
+        seconds: float,
+    ) -> None:
+        if seconds > 0:
+            with self._lock:
+                factor = 1.0 + self._random.uniform(-self.jitter, self.jitter)
+            time.sleep(seconds * factor)
+
+    def get_emeters(self) -> list:
+        with self._lock:
+            return [
+                {
+                    'power': round(self._random.uniform(0, 3000), 2),
+                    'pf': round(self._random.uniform(0.8, 1.0), 2),
+                    'current': round(self._random.uniform(0, 13), 2),
+                    'voltage': round(self._random.uniform(225, 235), 2),
+                    'is_valid': True,
+                    'total': 123456.7,
+                    'total_returned': 0.0,
+                }
+                for _ in range(3)
+            ]
+
+    def write_failure(self) -> bool:
+        with self._lock:
+            failed = self._random.random() < self.write_failure_rate
+            if failed:
+                self.writes_failed += 1
+            return failed
+
+    def capture(self,
+        body: bytes,
+    ) -> None:
+        # Poll-to-write latency of each point: arrival time minus its timestamp
+        arrival_ns = time.time_ns()
+        list_time_ns = [int(line.rsplit(b" ", 1)[1]) for line in body.split(b"\n") if line]
+        with self._lock:
+            self.writes += 1
+            self.points_captured += len(list_time_ns)
+            self._list_latency_ns.extend(arrival_ns - time_ns for time_ns in list_time_ns)
+
+    def get_latency_percentile_second(self,
+        list_percentile: list = [50, 99],
+    ) -> list:
+        with self._lock:
+            if not self._list_latency_ns:
+                return [float("nan")] * len(list_percentile)
+            return (np.percentile(np.array(self._list_latency_ns), list_percentile) / 1e9).tolist()
+
+    def start(self) -> None:
+        self._thread = threading.Thread(target=self.server.serve_forever, name="simulator", daemon=True)
+        self._thread.start()
+
+    def stop(self) -> None:
+        self.server.shutdown()
+        self.server.server_close()
+
+class _ModbusTcpRequestHandler(socketserver.BaseRequestHandler):
+
+    def handle(self) -> None:
+        self.request.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        lock = threading.Lock()
+        file = self.request.makefile("rb")
+        while True:
+            header = file.read(7)
+            if len(header) < 7:
+                return
+            transaction_id, _, length, unit_id = struct.unpack(">HHHB", header)
+            pdu = file.read(length - 1)
+            # Each request is answered on its own thread, so pipelined requests
+            # overlap and may come back out of order like on a real gateway.
+            threading.Thread(target=self._answer, args=(lock, transaction_id, unit_id, pdu), daemon=True).start()
+
+    def _answer(self,
+        lock: threading.Lock,
+        transaction_id: int,
+        unit_id: int,
+        pdu: bytes,
+    ) -> None:
+        simulator = self.server.simulator
+        function_code, register_address, number_of_registers = struct.unpack(">BHH", pdu[:5])
+        simulator.sleep(simulator.latency_second)
+        if unit_id in simulator.set_dead_unit:
+            return
+        if function_code not in (3, 4):
+            response = struct.pack(">BB", function_code | 0x80, 1)
+        else:
+            list_word = [simulator.dict_word.get(register_address + i, 0) for i in range(number_of_registers)]
+            response = struct.pack(f">BB{number_of_registers}H", function_code, 2 * number_of_registers, *list_word)
+        with lock:
+            simulator.transactions += 1
+            try:
+                self.request.sendall(struct.pack(">HHHB", transaction_id, 0, len(response) + 1, unit_id) + response)
+            except OSError:
+                pass
+
+class ModbusTcpSimulator:
+
+    def __init__(self,
+        latency_second: float = 0.01,
+        set_dead_unit: set = set(),
+        jitter: float = 0.2,
+        seed: int = 0,
+    ) -> None:
+
+        # Every unit id answers with the same F4N200 register contents
+        self.latency_second = latency_second
+        self.set_dead_unit = set_dead_unit
+        self.jitter = jitter
+        self.transactions = 0
+
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self.dict_word = {}
+        for register_address, value in DICT_F4N200_LONG.items():
+            self.dict_word[register_address] = value >> 16
+            self.dict_word[register_address + 1] = value & 0xFFFF
+        self.dict_word.update(DICT_F4N200_REGISTER)
+
+        self.server = socketserver.ThreadingTCPServer(("127.0.0.1", 0), _ModbusTcpRequestHandler)
+        self.server.daemon_threads = True
+        self.server.simulator = self
+        self._thread = None
+
+    @property
+    def address(self) -> tuple:
+        return self.server.server_address
+
+    def sleep(self,
+        seconds: float,
+    ) -> None:
+        if seconds > 0:
+            with self._lock:
+                factor = 1.0 + self._random.uniform(-self.jitter, self.jitter)
+            time.sleep(seconds * factor)
+
+    def start(self) -> None:
+        self._thread = threading.Thread(target=self.server.serve_forever, name="modbus-tcp-simulator", daemon=True)
+        self._thread.start()
+
+    def stop(self) -> None:
+        self.server.shutdown()
+        self.server.server_close()
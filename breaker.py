@@ -0,0 +1,180 @@
+import logging
+import queue
+import random
+import threading
+import time
+from concurrent.futures import Future, TimeoutError
+
+import metrics
+
+STATE_CLOSED = "closed"
+STATE_OPEN = "open"
+STATE_HALF_OPEN = "half_open"
+
+DICT_STATE_VALUE = {
+    STATE_CLOSED: 0,
+    STATE_OPEN: 1,
+    STATE_HALF_OPEN: 2,
+}
+
+class CircuitBreaker:
+
+    def __init__(self,
+        name: str,
+        failure_threshold: int = 3,
+        backoff_initial_second: float = 5.0,
+        backoff_max_second: float = 300.0,
+        jitter: float = 0.5,
+    ) -> None:
+
+        logging.info(f"Initializing {self.__class__.__name__} class...")
+
+        # Opens after failure_threshold consecutive failures. Once the open
+        # period is over a single probe call is let through (half open), its
+        # success closes the breaker and its failure opens it again for twice
+        # as long. Open periods are shortened by up to jitter so sources that
+        # failed together don't all probe at the same time.
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.backoff_initial_second = backoff_initial_second
+        self.backoff_max_second = backoff_max_second
+        self.jitter = jitter
+
+        self._lock = threading.Lock()
+        self._state = STATE_CLOSED
+        self._consecutive_failures = 0
+        self._backoff_second = 0.0
+        self._retry_at = 0.0
+        self._opened_at = 0.0
+
+        metrics.REGISTRY.set("breaker_state", DICT_STATE_VALUE[self._state], source=self.name)
+
+        return None
+
+    def _set_state(self,
+        state: str,
+    ) -> None:
+        self._state = state
+        metrics.REGISTRY.set("breaker_state", DICT_STATE_VALUE[state], source=self.name)
+        metrics.REGISTRY.inc("breaker_transitions_total", source=self.name, state=state)
+        return None
+
+    def allow(self) -> bool:
+        with self._lock:
+            if self._state == STATE_CLOSED:
+                return True
+            if self._state == STATE_OPEN and time.monotonic() >= self._retry_at:
+                self._set_state(STATE_HALF_OPEN)
+                return True
+            return False
+
+    def record_success(self) -> None:
+        with self._lock:
+            if self._state != STATE_CLOSED:
+                logging.info(f"Source {self.name} recovered after {self._consecutive_failures} failures and {time.monotonic() - self._opened_at:.0f} s, circuit closed")
+                self._set_state(STATE_CLOSED)
+            self._consecutive_failures = 0
+            self._backoff_second = 0.0
+        return None
+
+    def record_failure(self,
+        reason: str,
+    ) -> None:
+        with self._lock:
+            self._consecutive_failures += 1
+            if self._state == STATE_HALF_OPEN or (self._state == STATE_CLOSED and self._consecutive_failures >= self.failure_threshold):
+                if self._state == STATE_CLOSED:
+                    self._opened_at = time.monotonic()
+                self._backoff_second = min(max(self._backoff_second * 2, self.backoff_initial_second), self.backoff_max_second)
+                open_second = self._backoff_second * random.uniform(1.0 - self.jitter, 1.0)
+                self._retry_at = time.monotonic() + open_second
+                # One line per opening, nothing while open
+                logging.error(f"Source {self.name} failed {self._consecutive_failures} times in a row ({reason}), circuit open for {open_second:.1f} s")
+                self._set_state(STATE_OPEN)
+        return None
+
+    def get_stats(self) -> dict:
+        with self._lock:
+            return {
+                'state': self._state,
+                'consecutive_failures': self._consecutive_failures,
+                'backoff_second': self._backoff_second,
+            }
+
+class GuardedSource:
+
+    def __init__(self,
+        name: str,
+        function: callable,
+        deadline_second: float,
+        breaker: CircuitBreaker = None,
+    ) -> None:
+
+        logging.info(f"Initializing {self.__class__.__name__} class...")
+
+        # Calls run on one daemon thread per source and the caller waits at
+        # most deadline_second for them. A call that overruns is abandoned:
+        # it keeps the thread until the transport's own timeout ends it, and
+        # calls arriving meanwhile fail at once instead of piling up threads.
+        self.name = name
+        self.function = function
+        self.deadline_second = deadline_second
+        self.breaker = breaker
+
+        self._queue = queue.SimpleQueue()
+        self._thread = None
+        self._future = None
+
+        return None
+
+    def _run(self) -> None:
+        while True:
+            future = self._queue.get()
+            if not future.set_running_or_notify_cancel():
+                continue
+            try:
+                future.set_result(self.function())
+            except BaseException as e:
+                future.set_exception(e)
+
+    def _fail(self,
+        result: str,
+        reason: str,
+    ) -> None:
+        metrics.REGISTRY.inc("source_calls_total", source=self.name, result=result)
+        if self.breaker is not None:
+            self.breaker.record_failure(reason)
+        return None
+
+    def __call__(self) -> object:
+
+        if self.breaker is not None and not self.breaker.allow():
+            metrics.REGISTRY.inc("source_calls_total", source=self.name, result="rejected")
+            return None
+
+        if self._future is not None and not self._future.done():
+            self._fail("busy", "previous call still running")
+            return None
+
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name=f"source-{self.name}", daemon=True)
+            self._thread.start()
+
+        self._future = Future()
+        self._queue.put(self._future)
+        try:
+            result = self._future.result(timeout=self.deadline_second)
+        except TimeoutError:
+            self._fail("deadline", f"no result within {self.deadline_second:.1f} s")
+            return None
+        except Exception as e:
+            self._fail("error", str(e))
+            raise
+
+        # An empty result is not a failure, a source can have nothing due this
+        # cycle (Modbus slaves on longer intervals). Sources signal failure by raising.
+        metrics.REGISTRY.inc("source_calls_total", source=self.name, result="success")
+        if self.breaker is not None:
+            self.breaker.record_success()
+
+        return result
@@ -0,0 +1,208 @@
+import json
+import logging
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+import numpy as np
+
+import points
+
+# Series read per lock hold by a query, add() waits for at most one slice
+SERIES_PER_LOCK = 256
+
+class RecentCache:
+
+    def __init__(self,
+        samples_per_series: int = 600,
+        max_series: int = 10000,
+    ) -> None:
+
+        logging.info(f"Initializing {self.__class__.__name__} class...")
+
+        self.samples_per_series = samples_per_series
+        self.max_series = max_series
+
+        # Fixed memory: one ring of samples_per_series (time, value) per series
+        self._lock = threading.Lock()
+        self._dict_ring = {}
+
+        return None
+
+    def add(self,
+        batch: points.PointBatch,
+    ) -> None:
+
+        if not batch:
+            return None
+
+        with self._lock:
+            for measurement, tag_set, value, time_ns in batch:
+                ring = self._dict_ring.get((measurement, tag_set))
+                if ring is None:
+                    if len(self._dict_ring) >= self.max_series:
+                        continue
+                    # The tags as a dict are built once here, queries match on them
+                    ring = self._dict_ring[(measurement, tag_set)] = [
+                        np.zeros(self.samples_per_series, dtype=np.int64),
+                        np.zeros(self.samples_per_series, dtype=np.float64),
+                        0,
+                        dict(tag_set),
+                    ]
+                position = ring[2] % self.samples_per_series
+                ring[0][position] = time_ns
+                ring[1][position] = value
+                ring[2] += 1
+
+        return None
+
+    def _match(self,
+        measurement: str,
+        dict_tag: dict,
+    ) -> list:
+
+        # Only the list of rings is copied under the lock, acquisition calls
+        # add() with it, matching and serialising a large query happen outside
+        with self._lock:
+            list_item = list(self._dict_ring.items())
+
+        return [
+            (key, ring) for key, ring in list_item
+            if (measurement is None or key[0] == measurement)
+            and all(ring[3].get(tag) == value for tag, value in dict_tag.items())
+        ]
+
+    def list_series(self) -> list:
+        with self._lock:
+            list_item = list(self._dict_ring.items())
+        return [{'measurement': measurement, 'tags': ring[3]} for (measurement, _), ring in list_item]
+
+    def latest(self,
+        measurement: str = None,
+        dict_tag: dict = {},
+    ) -> list:
+
+        list_match = self._match(measurement, dict_tag)
+
+        list_sample = []
+        for index in range(0, len(list_match), SERIES_PER_LOCK):
+            with self._lock:
+                for key, ring in list_match[index:index + SERIES_PER_LOCK]:
+                    position = (ring[2] - 1) % self.samples_per_series
+                    list_sample.append((key, ring[3], int(ring[0][position]), float(ring[1][position])))
+
+        return [
+            {'measurement': key[0], 'tags': tags, 'time': time_ns, 'value': value}
+            for key, tags, time_ns, value in list_sample
+        ]
+
+    def range(self,
+        measurement: str = None,
+        dict_tag: dict = {},
+        start_ns: int = None,
+        end_ns: int = None,
+    ) -> list:
+
+        list_match = self._match(measurement, dict_tag)
+
+        list_copy = []
+        for index in range(0, len(list_match), SERIES_PER_LOCK):
+            with self._lock:
+                for key, ring in list_match[index:index + SERIES_PER_LOCK]:
+                    list_copy.append((key, ring[3], ring[0].copy(), ring[1].copy(), ring[2]))
+
+        # Ordering and filtering happen on copies, outside the lock
+        list_range = []
+        for key, tags, times, values, count in list_copy:
+            if count > self.samples_per_series:
+                roll = count % self.samples_per_series
+                times, values = np.roll(times, -roll), np.roll(values, -roll)
+            else:
+                times, values = times[:count], values[:count]
+            mask = np.ones(len(times), dtype=bool)
+            if start_ns is not None:
+                mask &= times >= start_ns
+            if end_ns is not None:
+                mask &= times <= end_ns
+            list_range.append({
+                'measurement': key[0],
+                'tags': tags,
+                'time': times[mask].tolist(),
+                'value': values[mask].tolist(),
+            })
+
+        return list_range
+
+class _CacheRequestHandler(BaseHTTPRequestHandler):
+
+    protocol_version = "HTTP/1.1"
+
+    def _send_json(self,
+        status: int,
+        data,
+    ) -> None:
+        body = json.dumps(data).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+        return None
+
+    def do_GET(self) -> None:
+
+        url = urlparse(self.path)
+        dict_query = {key: value[-1] for key, value in parse_qs(url.query).items()}
+        measurement = dict_query.pop('measurement', None)
+
+        try:
+            if url.path == "/series":
+                self._send_json(200, self.server.cache.list_series())
+            elif url.path == "/latest":
+                self._send_json(200, self.server.cache.latest(measurement, dict_query))
+            elif url.path == "/range":
+                start = dict_query.pop('start', None)
+                end = dict_query.pop('end', None)
+                self._send_json(200, self.server.cache.range(
+                    measurement,
+                    dict_query,
+                    int(start) if start is not None else None,
+                    int(end) if end is not None else None,
+                ))
+            else:
+                self._send_json(404, {'error': f"Unknown path {url.path}, use /series, /latest or /range"})
+        except ValueError as e:
+            self._send_json(400, {'error': str(e)})
+
+        return None
+
+    def log_message(self, format, *args) -> None:
+        logging.debug(f"Cache endpoint | {self.address_string()} | {format % args}")
+
+class CacheServer:
+
+    def __init__(self,
+        cache: RecentCache,
+        host: str = "127.0.0.1",
+        port: int = 8080,
+    ) -> None:
+
+        logging.info(f"Initializing {self.__class__.__name__} class...")
+
+        self.server = ThreadingHTTPServer((host, port), _CacheRequestHandler)
+        self.server.daemon_threads = True
+        self.server.cache = cache
+        self._thread = None
+
+        return None
+
+    def start(self) -> None:
+        self._thread = threading.Thread(target=self.server.serve_forever, name="cache-server", daemon=True)
+        self._thread.start()
+        logging.info(f"Recent samples endpoint listening on http://{self.server.server_address[0]}:{self.server.server_address[1]}")
+        return None
+
+    def stop(self) -> None:
+        self.server.shutdown()
+        self.server.server_close()
+        return None
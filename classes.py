@@ -1,14 +1,150 @@
 import requests
-import logging
-import minimalmodbus
 import datetime
-from fusion_solar_py.client import FusionSolarClient
+import json
+import logging
+import os
+import threading
+import time
+import zoneinfo
+from concurrent.futures import ThreadPoolExecutor
+import metrics
+import points
+import response_cache
+# Lives in modbus_device so Modbus only setups don't import requests
+from modbus_device import ModbusRtuF4N200
 
+class HttpSession:
+    
+    def __init__(self,
+        timeout_connect: float = 3.05,
+        timeout_read: float = 10.0,
+        pool_connections: int = 4,
+        pool_maxsize: int = 16,
+    ) -> None:
+        
+        logging.info(f"Initializing {self.__class__.__name__} class...")
+        
+        self.timeout = (timeout_connect, timeout_read)
+        
+        self.adapter = requests.adapters.HTTPAdapter(
+            pool_connections=pool_connections,
+            pool_maxsize=pool_maxsize,
+            pool_block=False,
+        )
+        self.session = requests.Session()
+        self.session.mount("http://", self.adapter)
+        self.session.mount("https://", self.adapter)
+        
+        self._lock = threading.Lock()
+        self._dict_stats = {
+            'requests': 0,
+            'errors': 0,
+            'latency_total_second': 0.0,
+            'latency_max_second': 0.0,
+            'latency_last_second': 0.0,
+        }
+        
+        return None
+    
+    def request(self,
+        method: str,
+        url: str,
+        **kwargs,
+    ) -> requests.Response:
+        
+        kwargs.setdefault('timeout', self.timeout)
+        
+        start = time.perf_counter()
+        try:
+            return self.session.request(method, url, **kwargs)
+        except requests.RequestException:
+            with self._lock:
+                self._dict_stats['errors'] += 1
+            raise
+        finally:
+            latency = time.perf_counter() - start
+            with self._lock:
+                self._dict_stats['requests'] += 1
+                self._dict_stats['latency_total_second'] += latency
+                self._dict_stats['latency_last_second'] = latency
+                self._dict_stats['latency_max_second'] = max(self._dict_stats['latency_max_second'], latency)
+    
+    def get_stats(self) -> dict:
+        
+        # Each new connection in a urllib3 pool is a TCP (and TLS) handshake,
+        # everything else was served over a kept-alive connection.
+        pools = self.adapter.poolmanager.pools
+        handshakes = sum(pools[key].num_connections for key in pools.keys())
+        
+        with self._lock:
+            dict_stats = dict(self._dict_stats)
+            
+        dict_stats['handshakes'] = handshakes
+        dict_stats['reused'] = max(dict_stats['requests'] - dict_stats['errors'] - handshakes, 0)
+        dict_stats['latency_mean_second'] = dict_stats['latency_total_second'] / dict_stats['requests'] if dict_stats['requests'] else 0.0
+        
+        return dict_stats
+    
+    def close(self) -> None:
+        self.session.close()
+        return None
+        
+class RateLimiter:
+    
+    def __init__(self,
+        rate_per_second: float = None,
+        burst: int = 1,
+    ) -> None:
+        
+        logging.info(f"Initializing {self.__class__.__name__} class...")
+        
+        self.rate_per_second = rate_per_second
+        self.burst = burst
+        
+        self._lock = threading.Lock()
+        self._tokens = float(burst)
+        self._last = time.monotonic()
+        self._paused_until = 0.0
+        
+        return None
+    
+    def pause(self,
+        seconds: float,
+    ) -> None:
+        with self._lock:
+            self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+        return None
+    
+    def acquire(self) -> float:
+        
+        # Token bucket: reserve a token under the lock and sleep outside it,
+        # so concurrent callers queue up in order without holding the lock.
+        with self._lock:
+            now = time.monotonic()
+            wait = max(self._paused_until - now, 0.0)
+            
+            if self.rate_per_second:
+                self._tokens = min(self._tokens + (now - self._last) * self.rate_per_second, self.burst)
+                self._last = now
+                self._tokens -= 1
+                if self._tokens < 0:
+                    wait = max(wait, -self._tokens / self.rate_per_second)
+        
+        if wait > 0:
+            time.sleep(wait)
+        
+        return wait
+        
 class Co2Signal:
     
     def __init__(self,
         url: str,
         auth: str,
+        timeout_connect: float = 3.05,
+        timeout_read: float = 10.0,
+        pool_maxsize: int = 4,
+        cache: response_cache.ResponseCache = None,
+        cache_ttl_second: float = 3240.0,
     ) -> None:
         
         INFLUXDB_MEASUREMENT = 'co2'
@@ -17,6 +153,15 @@ class Co2Signal:
         
         self.url = url
         self.auth = auth
+        self.cache = cache
+        self.cache_ttl_second = cache_ttl_second
+        
+        self.http = HttpSession(
+            timeout_connect=timeout_connect,
+            timeout_read=timeout_read,
+            pool_connections=1,
+            pool_maxsize=pool_maxsize,
+        )
         
         self.influxdb_measurement = INFLUXDB_MEASUREMENT
         
@@ -25,325 +170,79 @@ class Co2Signal:
     def get_data(self,
         zone_code: str,
     ) -> dict:
+        if self.cache is not None:
+            return self.cache.get(zone_code, lambda validator: self.fetch_data(zone_code, validator), self.cache_ttl_second)
+        
+        result = self.fetch_data(zone_code)
+        return result[0] if result is not None else None
+    
+    def fetch_data(self,
+        zone_code: str,
+        validator: dict = None,
+    ) -> tuple:
         url = f"{self.url}?countryCode={zone_code}"
-        response = requests.get(url, headers={'auth-token': self.auth})
+        dict_header = {'auth-token': self.auth}
+        if validator:
+            # Conditional request, answered with 304 if the data hasn't changed
+            if validator.get('etag'):
+                dict_header['If-None-Match'] = validator['etag']
+            if validator.get('last_modified'):
+                dict_header['If-Modified-Since'] = validator['last_modified']
+        
+        start = time.perf_counter()
+        try:
+            response = self.http.request('GET', url, headers=dict_header)
+        except requests.RequestException as e:
+            metrics.observe_request("co2signal", zone_code, start, False)
+            logging.error(f"API call failed for zone code {zone_code}: {e}")
+            return None
         
+        metrics.observe_request("co2signal", zone_code, start, response.status_code in (200, 304))
         if response.status_code == 200:
-            return response.json()['data']
+            # The fetch time goes with the data, a cached value is written again
+            # with the time it was sampled, not as a new sample
+            return {**response.json()['data'], 'fetched_ns': points.now_ns()}, {
+                'etag': response.headers.get('ETag'),
+                'last_modified': response.headers.get('Last-Modified'),
+            }
+        elif response.status_code == 304 and validator:
+            return response_cache.NOT_MODIFIED
         else:
             logging.error(f"API call not successful. Status code: {response.status_code}, reason: {response.reason}. Full response: {response.json()}")
             return None
         
     def get_point_influxdb(self,
         zone_code: str,
-    ) -> list:
+    ) -> points.PointBatch:
         data = self.get_data(zone_code)
         
         if data:
-            return [
-                {
-                    'measurement': "carbon_intensity",
-                    'tags': {
-                        'zone_code': zone_code,
-                    },
-                    'fields': {
-                        'value': float(data['carbonIntensity']),
-                    },
-                    'time': datetime.datetime.utcnow().isoformat(),
-                },
-                {
-                    'measurement': "fossil_fuel_percentage",
-                    'tags': {
-                        'zone_code': zone_code,
-                    },
-                    'fields': {
-                        'value': float(data['fossilFuelPercentage']),
-                    },
-                    'time': datetime.datetime.utcnow().isoformat(),
-                }
-            ]
-        else:
-            logging.error(f"Coudn't get data for zone code {zone_code}")
-            return None
-        
-class ModbusRtuF4N200:
-    
-    def __init__(self,
-        port: str,
-    ) -> None:
-                
-        BAUDRATE = 19200
-        PARITY = 'E' # Even
-        SLAVE_ADDRESS = 5
-        
-        LOCATION = "Laboratory"
-        
-        DICT_MODBUS_DATA = {
-            "voltage-L1" : {
-                "type": "long",
-                "register_address": 4096,
-                "scale": 0.001,
-                "signed": False,
-                "measurement": "voltage",
-                "tags": {
-                    "phase": "L1",
-                    "category": "load"
-                }
-            },
-            "voltage-L2" : {
-                "type": "long",
-                "register_address": 4098,
-                "scale": 0.001,
-                "signed": False,
-                "measurement": "voltage",
-                "tags": {
-                    "phase": "L2",
-                    "category": "load"
-                }
-            },
-            "voltage-L3" : {
-                "type": "long",
-                "register_address": 4100,
-                "scale": 0.001,
-                "signed": False,
-                "measurement": "voltage",
-                "tags": {
-                    "phase": "L3",
-                    "category": "load"
-                }
-            },
-            "active_power-L1" : {
-                "type": "long",
-                "register_address": 4140,
-                "scale": 0.01,
-                "signed": False,
-                "measurement": "active_power",
-                "tags": {
-                    "phase": "L1",
-                    "category": "load"
-                }
-            },
-            "active_power-L2" : {
-                "type": "long",
-                "register_address": 4142,
-                "scale": 0.01,
-                "signed": False,
-                "measurement": "active_power",
-                "tags": {
-                    "phase": "L2",
-                    "category": "load"
-                }
-            },
-            "active_power-L3" : {
-                "type": "long",
-                "register_address": 4144,
-                "scale": 0.01,
-                "signed": False,
-                "measurement": "active_power",
-                "tags": {
-                    "phase": "L3",
-                    "category": "load"
-                }
-            },
-            "active_power-L1-sign" : {
-                "type": "register",
-                "register_address": 4146,
-                "scale": 1.0,
-                "signed": True,
-                "measurement": "sign_active_power",
-                "tags": {
-                    "phase": "L1",
-                    "category": "load"
-                }
-            },
-            "active_power-L2-sign" : {
-                "type": "register",
-                "register_address": 4147,
-                "scale": 1.0,
-                "signed": True,
-                "measurement": "sign_active_power",
-                "tags": {
-                    "phase": "L2",
-                    "category": "load"
-                }
-            },
-            "active_power-L3-sign" : {
-                "type": "register",
-                "register_address": 4148,
-                "scale": 1.0,
-                "signed": True,
-                "measurement": "sign_active_power",
-                "tags": {
-                    "phase": "L3",
-                    "category": "load"
-                }
-            },
-            "power_factor-L1" : {
-                "type": "register",
-                "register_address": 4164,
-                "scale": 0.01,
-                "signed": True,
-                "measurement": "power_factor",
-                "tags": {
-                    "phase": "L1",
-                    "category": "load"
-                }
-            },
-            "power_factor-L2" : {
-                "type": "register",
-                "register_address": 4165,
-                "scale": 0.01,
-                "signed": True,
-                "measurement": "power_factor",
-                "tags": {
-                    "phase": "L2",
-                    "category": "load"
-                }
-            },
-            "power_factor-L3" : {
-                "type": "register",
-                "register_address": 4166,
-                "scale": 0.01,
-                "signed": True,
-                "measurement": "power_factor",
-                "tags": {
-                    "phase": "L3",
-                    "category": "load"
-                }
-            },
-            "active_energy-positive" : {
-                "type": "long",
-                "register_address": 4688,
-                "scale": 1.0,
-                "signed": False,
-                "measurement": "active_energy",
-                "tags": {
-                    "category": "load"
-                }
-            },
-            "reactive_energy-positive" : {
-                "type": "long",
-                "register_address": 4690,
-                "scale": 1.0,
-                "signed": False,
-                "measurement": "reactive_energy",
-                "tags": {
-                    "category": "load"
-                }
-            },
-            "active_energy-negative" : {
-                "type": "long",
-                "register_address": 4692,
-                "scale": 1.0,
-                "signed": False,
-                "measurement": "active_energy",
-                "tags": {
-                    "category": "load"
-                }
-            },
-            "reactive_energy-negative" : {
-                "type": "long",
-                "register_address": 4694,
-                "scale": 1.0,
-                "signed": False,
-                "measurement": "reactive_energy",
-                "tags": {
-                    "category": "load"
-                }
-            },
-        }
-              
-        logging.info(f"Initializing {self.__class__.__name__} class...")
-        
-        self.instrument = minimalmodbus.Instrument(port, SLAVE_ADDRESS, mode=minimalmodbus.MODE_RTU)
-        self.instrument.serial.baudrate = BAUDRATE
-        self.instrument.serial.parity = PARITY
-        
-        self.dict_modbus_data = DICT_MODBUS_DATA
-        
-        self.location = LOCATION
-        
-        return None
-    
-    def read_data(self,
-        type: str,
-        register_address: int,
-        scale: float = 1.0,
-        signed: bool = True,
-    ) -> float:
-        
-        if type == 'long':
-            data = self.instrument.read_long(register_address) * scale
-        elif type == 'register':
-            data = self.instrument.read_register(register_address, signed=signed) * scale
-        else:
-            logging.error(f"Type {type} not recognized")
-            return None
-        
-        logging.debug(f"Register {register_address} | Type {type} | Scale {scale} | Signed {signed} | Data = {data}")
-        return data
-    
-    def get_point_influxdb(self,
-        measurement: str = None
-    ) -> dict:
-        
-        assert measurement in self.dict_modbus_data.keys(), f"Measurement {measurement} not recognized among {self.dict_modbus_data.keys()}"
-        
-        type = self.dict_modbus_data[measurement]['type']
-        register_address = self.dict_modbus_data[measurement]['register_address']
-        scale = self.dict_modbus_data[measurement]['scale']
-        signed = self.dict_modbus_data[measurement]['signed']
+            time_ns = data.get('fetched_ns') or points.now_ns()
+            tag_set = points.tag_set({'zone_code': zone_code})
             
-        data = self.read_data(type, register_address, scale, signed)
-        
-        if data is not None:
-            return {
-                'measurement': self.dict_modbus_data[measurement]['measurement'],
-                'tags': {   
-                    'location': self.location,
-                    **self.dict_modbus_data[measurement]['tags']
-                },
-                'fields': {
-                    'value': float(data),
-                },
-                'time': datetime.datetime.utcnow().isoformat(),
-            }
+            batch = points.PointBatch()
+            batch.append("carbon_intensity", tag_set, float(data['carbonIntensity']), time_ns)
+            batch.append("fossil_fuel_percentage", tag_set, float(data['fossilFuelPercentage']), time_ns)
+            return batch
         else:
-            logging.error(f"Coudn't get data for register {register_address}")
+            logging.error(f"Coudn't get data for zone code {zone_code}")
             return None
         
-    def get_all_points_influxdb(self) -> list:
-        
-        list_point = []
-        for measurement in self.dict_modbus_data.keys():
-            if "active_power" in measurement and "sign" not in measurement:
-                sign = self.get_point_influxdb(f"{measurement}-sign")
-                value = self.get_point_influxdb(measurement)
-                if sign and value:
-                    value['fields']['value'] = value['fields']['value'] * (-2*sign['fields']['value'] + 1)
-                    list_point.append(value)
-                    
-            elif measurement == "active_energy-positive" or measurement == "reactive_energy-positive":
-                positive = self.get_point_influxdb(f"{measurement}")
-                negative = self.get_point_influxdb(f"{measurement.replace('positive', 'negative')}")
-                if positive and negative:
-                    positive['fields']['value'] = positive['fields']['value'] - negative['fields']['value']
-                    list_point.append(positive)
-                    
-            elif "voltage" in measurement or "power_factor" in measurement:
-                list_point.append(self.get_point_influxdb(measurement))
-                
-            else:
-                if "sign" not in measurement and "energy" not in measurement:
-                    logging.warning(f"Measurement {measurement} not supported.")
-            
-        return list_point
-        
 class Shelly3Em:
     
     def __init__(self,
         url: str,
         token: str,
+        timeout_connect: float = 3.05,
+        timeout_read: float = 5.0,
+        max_concurrency: int = 16,
+        rate_limit_per_second: float = None,
+        rate_limit_burst: int = 1,
+        dict_id_host: dict = {},
+        local_auth: tuple = None,
+        local_timeout_connect: float = 0.5,
+        local_timeout_read: float = 1.0,
+        local_retry_second: float = 30.0,
     ) -> None:
         
         LIST_MESUREMENT = [
@@ -365,52 +264,167 @@ class Shelly3Em:
         self.url = url
         self.token = token
         
+        self.http = HttpSession(
+            timeout_connect=timeout_connect,
+            timeout_read=timeout_read,
+            pool_connections=1,
+            pool_maxsize=max_concurrency,
+        )
+        
+        # Devices listed in dict_id_host are read over the LAN from their local
+        # /status endpoint, with a kept-alive connection pool per host, and only
+        # go through the cloud while they can't be reached.
+        self.dict_id_host = dict_id_host
+        self.local_auth = local_auth
+        self.local_retry_second = local_retry_second
+        self.http_local = HttpSession(
+            timeout_connect=local_timeout_connect,
+            timeout_read=local_timeout_read,
+            pool_connections=max(len(dict_id_host), 1),
+            pool_maxsize=max_concurrency,
+        )
+        self._dict_local_retry_at = {}
+        
+        self.max_concurrency = max_concurrency
+        self.rate_limiter = RateLimiter(rate_limit_per_second, rate_limit_burst)
+        self._executor = None
+        
         self._list_measurement = LIST_MESUREMENT
         self._dict_measurement_to_field = DICT_MEASUREMENT_TO_FIELD
+        self._dict_tag_set = {}
         
         return None
     
     def get_data(self,
         id:str  
     ) -> dict:
-        response = requests.post(
-            self.url, 
-            data={
-                'auth_key': self.token, 
-                'id': id
-            }
-        )
+        host = self.dict_id_host.get(id)
+        if host is not None and time.monotonic() >= self._dict_local_retry_at.get(id, 0.0):
+            data = self.get_data_local(id, host)
+            if data is not None:
+                if self._dict_local_retry_at.pop(id, None) is not None:
+                    logging.info(f"Device {id} reachable again at {host}")
+                return data
+            if id not in self._dict_local_retry_at:
+                logging.warning(f"Device {id} not reachable at {host}, falling back to the cloud")
+            self._dict_local_retry_at[id] = time.monotonic() + self.local_retry_second
+            metrics.REGISTRY.inc("shelly_cloud_fallback_total", device=id)
+        
+        return self.get_data_cloud(id)
+    
+    def get_data_local(self,
+        id: str,
+        host: str,
+    ) -> list:
+        start = time.perf_counter()
+        try:
+            response = self.http_local.request('GET', f"http://{host}/status", auth=self.local_auth)
+        except requests.RequestException as e:
+            metrics.observe_request("shelly_local", id, start, False)
+            logging.debug(f"Local call failed for device {id}: {e}")
+            return None
         
+        metrics.observe_request("shelly_local", id, start, response.status_code == 200)
+        if response.status_code != 200:
+            logging.debug(f"Local call not successful for device {id}. Status code: {response.status_code}")
+            return None
+        
+        # Same emeters list the cloud returns under data.device_status
+        return response.json().get('emeters')
+    
+    def get_data_cloud(self,
+        id:str  
+    ) -> list:
+        self.rate_limiter.acquire()
+        
+        start = time.perf_counter()
+        try:
+            response = self.http.request(
+                'POST',
+                self.url, 
+                data={
+                    'auth_key': self.token, 
+                    'id': id
+                }
+            )
+        except requests.RequestException as e:
+            metrics.observe_request("shelly", id, start, False)
+            logging.error(f"API call failed for device {id}: {e}")
+            return None
+        
+        metrics.observe_request("shelly", id, start, response.status_code == 200)
         if response.status_code == 200:
             return response.json()['data']['device_status']['emeters']
+        elif response.status_code == 429:
+            try:
+                retry_after = float(response.headers.get('Retry-After', 1.0))
+            except ValueError:
+                retry_after = 1.0
+            self.rate_limiter.pause(retry_after)
+            logging.warning(f"Rate limited by Shelly cloud for device {id}, pausing requests for {retry_after} s")
+            return None
         else:
             logging.error(f"API call not successful. Status code: {response.status_code}, reason: {response.reason}. Full response: {response.json()}")
             return None
 
+    def get_tag_set(self,
+        location: str,
+        phase: int,
+    ) -> tuple:
+        key = (location, phase)
+        tag_set = self._dict_tag_set.get(key)
+        if tag_set is None:
+            tag_set = points.tag_set({
+                'location': location,
+                'phase': f"L{phase+1}",
+                "category": "load"
+            })
+            self._dict_tag_set[key] = tag_set
+        return tag_set
+
     def get_point_influxdb(self,
         id:str,
         location: str,
-    ) -> list:
+    ) -> points.PointBatch:
         data = self.get_data(id)
+        time_ns = points.now_ns()
         
-        list_point = []
+        batch = points.PointBatch()
         if data:
             for phase, emeter in enumerate(data):
+                tag_set = self.get_tag_set(location, phase)
                 for measurement in self._list_measurement:
-                    list_point.append({
-                        'measurement': measurement,
-                        'tags': {
-                            'location': location,
-                            'phase': f"L{phase+1}",
-                            "category": "load"
-                        },
-                        'fields': {
-                            'value': float(emeter[self._dict_measurement_to_field[measurement]]),
-                        },
-                        'time': datetime.datetime.utcnow().isoformat(),
-                    })
+                    batch.append(
+                        measurement,
+                        tag_set,
+                        float(emeter[self._dict_measurement_to_field[measurement]]),
+                        time_ns,
+                    )
                     
-        return list_point
+        return batch
+    
+    def get_points_influxdb(self,
+        dict_location_id: dict,
+    ) -> points.PointBatch:
+        
+        # Devices are polled in parallel (at most max_concurrency in flight), so a
+        # cycle takes about as long as the slowest device rather than the sum.
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(max_workers=self.max_concurrency, thread_name_prefix="shelly")
+        
+        dict_future = {
+            location: self._executor.submit(self.get_point_influxdb, id, location)
+            for location, id in dict_location_id.items()
+        }
+        
+        batch = points.PointBatch()
+        for location, future in dict_future.items():
+            try:
+                batch.extend(future.result())
+            except Exception as e:
+                logging.error(f"Coudn't get data for location {location}: {e}")
+                
+        return batch
                 
 class HuaweiPv:
     
@@ -419,6 +433,11 @@ class HuaweiPv:
         password: str,
         subdomain: str,
         captcha_model_path: str,
+        session_path: str = None,
+        cache: response_cache.ResponseCache = None,
+        cache_ttl_second: float = 270.0,
+        login_backoff_initial_second: float = 60.0,
+        login_backoff_max_second: float = 3600.0,
     ) -> None:
         
         LOCATION = "Laboratory"
@@ -429,57 +448,182 @@ class HuaweiPv:
         self.password = password
         self.subdomain = subdomain
         self.captcha_model_path = captcha_model_path
-        
-        self.client = FusionSolarClient(
-            self.username,
-            self.password,
-            self.subdomain,
-            captcha_model_path=self.captcha_model_path)
+        self.session_path = session_path
+        self.cache = cache
+        self.cache_ttl_second = cache_ttl_second
+        self.login_backoff_initial_second = login_backoff_initial_second
+        self.login_backoff_max_second = login_backoff_max_second
+        
+        # The client is only built on the first request. FusionSolarClient itself
+        # loads the captcha model only when the login page presents a captcha.
+        self.client = None
+        self._company_id = None
+        self._session_fingerprint = None
+        self._login_backoff_second = 0.0
+        self._login_retry_at = 0.0
         
         self.location = LOCATION
+        self.tag_set = points.tag_set({
+            'location': self.location,
+            "category": "pv"
+        })
+        
+        return None
+    
+    def load_session(self) -> requests.Session:
+        
+        if self.session_path is None or not os.path.exists(self.session_path):
+            return None
+        
+        try:
+            with open(self.session_path) as file:
+                dict_session = json.load(file)
+            assert dict_session['username'] == self.username and dict_session['subdomain'] == self.subdomain, "session belongs to another account"
+        except Exception as e:
+            logging.warning(f"Couldn't load FusionSolar session from {self.session_path}: {e}")
+            return None
+        
+        session = requests.Session()
+        for cookie in dict_session['cookies']:
+            session.cookies.set(cookie['name'], cookie['value'], domain=cookie['domain'], path=cookie['path'])
+        if dict_session.get('roarand'):
+            session.headers["roarand"] = dict_session['roarand']
+        self._company_id = dict_session.get('company_id')
+        
+        logging.info(f"FusionSolar session loaded from {self.session_path}, saved at {dict_session['saved_at']}")
+        
+        return session
+    
+    def save_session(self) -> None:
+        
+        if self.session_path is None or self.client is None:
+            return None
+        
+        session = self.client._session
+        list_cookie = sorted(
+            ({'name': cookie.name, 'value': cookie.value, 'domain': cookie.domain, 'path': cookie.path} for cookie in session.cookies),
+            key=lambda cookie: (cookie['domain'], cookie['path'], cookie['name']),
+        )
+        fingerprint = (json.dumps(list_cookie), session.headers.get("roarand"))
+        if fingerprint == self._session_fingerprint:
+            return None
+        
+        dict_session = {
+            'username': self.username,
+            'subdomain': self.subdomain,
+            'saved_at': time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+            'cookies': list_cookie,
+            'roarand': session.headers.get("roarand"),
+            'company_id': self.client._company_id,
+        }
+        
+        # Cookies are credentials: written owner-only, atomically
+        path_tmp = f"{self.session_path}.tmp"
+        with open(os.open(path_tmp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600), "w") as file:
+            json.dump(dict_session, file)
+        os.replace(path_tmp, self.session_path)
+        self._session_fingerprint = fingerprint
+        
+        logging.info(f"FusionSolar session saved to {self.session_path}")
         
         return None
     
+    def get_client(self) -> "FusionSolarClient":
+        
+        if self.client is not None:
+            return self.client
+        
+        if time.monotonic() < self._login_retry_at:
+            raise RuntimeError(f"FusionSolar login failed recently, next attempt in {self._login_retry_at - time.monotonic():.0f} s")
+        
+        # With a cached session the client doesn't log in, it only does so once
+        # a request finds the session expired.
+        session = self.load_session()
+        try:
+            from fusion_solar_py.client import FusionSolarClient
+            self.client = FusionSolarClient(
+                self.username,
+                self.password,
+                self.subdomain,
+                session=session,
+                captcha_model_path=self.captcha_model_path)
+        except Exception:
+            metrics.REGISTRY.inc("huawei_pv_logins_total", result="failure")
+            self._login_backoff_second = min(max(self._login_backoff_second * 2, self.login_backoff_initial_second), self.login_backoff_max_second)
+            self._login_retry_at = time.monotonic() + self._login_backoff_second
+            raise
+        
+        if session is None:
+            metrics.REGISTRY.inc("huawei_pv_logins_total", result="success")
+        else:
+            self.client._company_id = self._company_id
+        self._login_backoff_second = 0.0
+        
+        return self.client
+    
     def get_data(self) -> dict:
+        if self.cache is not None:
+            # FusionSolar only refreshes its KPIs every few minutes
+            return self.cache.get(self.subdomain, lambda validator: self.fetch_data(), self.cache_ttl_second)
+        
+        result = self.fetch_data()
+        return result[0] if result is not None else None
+    
+    def fetch_data(self) -> tuple:
        
+        start = time.perf_counter()
         try:
-            stats = self.client.get_power_status()
+            stats = self.get_client().get_power_status()
+            metrics.observe_request("huawei_pv", self.subdomain, start, True)
+            self.save_session()
             return {
                 'current_power': stats.current_power_kw * 1000.0,
                 'total_energy': stats.energy_kwh * 1000.0,
-            }
+                'fetched_ns': points.now_ns(),
+            }, None
         except Exception as e:
+            metrics.observe_request("huawei_pv", self.subdomain, start, False)
             logging.error(f"API call not working!: {e}")
             return None
         
-    def get_point_influxdb(self) -> list:
+    def get_history_batch(self,
+        day: datetime.date,
+        timezone: str = "Europe/Rome",
+    ) -> points.PointBatch:
+        
+        # Five minute PV power of one day from the energy balance chart, summed
+        # over the plants of the account like the live power status. Chart
+        # times are station local.
+        client = self.get_client()
+        tzinfo = zoneinfo.ZoneInfo(timezone)
+        day_start = datetime.datetime.combine(day, datetime.time(), tzinfo=tzinfo)
+        
+        dict_time_power = {}
+        for plant_id in client.get_plant_ids():
+            data = client.get_plant_stats(plant_id, query_time=int(day_start.timestamp() * 1000))
+            for time_string, value in zip(data['xAxis'], data.get('productPower', [])):
+                if value == "--":
+                    continue
+                time_ns = int(datetime.datetime.strptime(time_string, "%Y-%m-%d %H:%M").replace(tzinfo=tzinfo).timestamp()) * 10**9
+                dict_time_power[time_ns] = dict_time_power.get(time_ns, 0.0) + float(value) * 1000.0
+        self.save_session()
+        
+        batch = points.PointBatch()
+        for time_ns in sorted(dict_time_power):
+            batch.append('active_power', self.tag_set, dict_time_power[time_ns], time_ns)
+        
+        return batch
+    
+    def get_point_influxdb(self) -> points.PointBatch:
         data = self.get_data()
         
         if data:
-            return [
-                {
-                    'measurement': 'active_power',
-                    'tags': {
-                        'location': self.location,
-                        "category": "pv"
-                    },
-                    'fields': {
-                        'value': float(data['current_power']),
-                    },
-                    'time': datetime.datetime.utcnow().isoformat(),
-                },
-                {
-                    'measurement': 'active_energy',
-                    'tags': {
-                        'location': self.location,
-                        "category": "pv"
-                    },
-                    'fields': {
-                        'value': float(data['total_energy']),
-                    },
-                    'time': datetime.datetime.utcnow().isoformat(),
-                },
-            ]
+            time_ns = data.get('fetched_ns') or points.now_ns()
+            
+            batch = points.PointBatch()
+            batch.append('active_power', self.tag_set, float(data['current_power']), time_ns)
+            batch.append('active_energy', self.tag_set, float(data['total_energy']), time_ns)
+            return batch
         else:
             logging.error(f"Coudn't get data for Huawei PV")
             return None
\ No newline at end of file
@@ -0,0 +1,96 @@
+import logging
+import threading
+
+import points
+
+class DeadbandFilter:
+
+    def __init__(self,
+        dict_deadband: dict,
+    ) -> None:
+
+        logging.info(f"Initializing {self.__class__.__name__} class...")
+
+        for measurement, deadband in dict_deadband.items():
+            assert set(deadband) <= {'absolute', 'relative', 'heartbeat_second'}, f"Deadband of {measurement} has unknown keys {set(deadband)}"
+
+        # Series not listed in dict_deadband always pass through unfiltered
+        self.dict_deadband = {
+            measurement: (
+                float(deadband.get('absolute', 0.0)),
+                float(deadband.get('relative', 0.0)),
+                int(deadband.get('heartbeat_second', 0) * 1e9),
+            )
+            for measurement, deadband in dict_deadband.items()
+        }
+
+        self._lock = threading.Lock()
+        self._dict_last = {}
+        self._dict_count = {}
+
+        return None
+
+    def filter(self,
+        batch: points.PointBatch,
+    ) -> points.PointBatch:
+
+        if not batch:
+            return batch
+
+        output = points.PointBatch()
+        with self._lock:
+            for measurement, tag_set, value, time_ns in batch:
+                count = self._dict_count.get(measurement)
+                if count is None:
+                    count = self._dict_count[measurement] = [0, 0]
+                count[0] += 1
+
+                deadband = self.dict_deadband.get(measurement)
+                if deadband is not None:
+                    absolute, relative, heartbeat_ns = deadband
+                    last = self._dict_last.get((measurement, tag_set))
+                    if last is not None:
+                        last_value, last_time_ns = last
+                        band = max(absolute, relative * abs(last_value))
+                        if abs(value - last_value) <= band and (not heartbeat_ns or time_ns - last_time_ns < heartbeat_ns):
+                            continue
+                    self._dict_last[(measurement, tag_set)] = (value, time_ns)
+
+                count[1] += 1
+                output.append(measurement, tag_set, value, time_ns)
+
+        return output
+
+    def reset(self) -> None:
+        with self._lock:
+            self._dict_last.clear()
+        return None
+
+    def get_report(self) -> dict:
+
+        with self._lock:
+            dict_count = {measurement: tuple(count) for measurement, count in self._dict_count.items()}
+
+        points_in = sum(count[0] for count in dict_count.values())
+        points_out = sum(count[1] for count in dict_count.values())
+
+        return {
+            'points_in': points_in,
+            'points_out': points_out,
+            'compression_ratio': points_in / points_out if points_out else 0.0,
+            'measurements': {
+                measurement: {
+                    'points_in': count[0],
+                    'points_out': count[1],
+                    'compression_ratio': count[0] / count[1] if count[1] else 0.0,
+                }
+                for measurement, count in dict_count.items()
+            },
+        }
+
+    def log_report(self) -> None:
+        dict_report = self.get_report()
+        logging.info(f"Deadband filter kept {dict_report['points_out']} of {dict_report['points_in']} points, compression ratio {dict_report['compression_ratio']:.1f}")
+        for measurement, dict_count in dict_report['measurements'].items():
+            logging.info(f"Deadband filter | {measurement} | {dict_count['points_out']}/{dict_count['points_in']} points | ratio {dict_count['compression_ratio']:.1f}")
+        return None
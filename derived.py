@@ -0,0 +1,311 @@
+import ast
+import logging
+import os
+import threading
+
+import numpy as np
+
+import points
+
+LIST_RULE_TYPE = [
+    "sum",
+    "difference",
+    "integral",
+]
+
+def _matches(
+    selector: dict,
+    measurement: str,
+    tag_set: tuple,
+) -> bool:
+    # A selector matches every series of its measurement carrying all its tags
+    if measurement != selector['measurement']:
+        return False
+    dict_tag = dict(tag_set)
+    return all(dict_tag.get(key) == value for key, value in selector.get('tags', {}).items())
+
+class DerivedMetrics:
+
+    def __init__(self,
+        list_rule: list,
+        state_path: str = None,
+    ) -> None:
+
+        logging.info(f"Initializing {self.__class__.__name__} class...")
+
+        # Rules run in order on every batch, each one sees the batch and the
+        # points derived by the rules before it, so a difference can use a sum.
+        for rule in list_rule:
+            assert rule['type'] in LIST_RULE_TYPE, f"Derived rule type {rule['type']} not recognized, known types are {LIST_RULE_TYPE}"
+        self.list_rule = list_rule
+        self.state_path = state_path
+
+        self._lock = threading.Lock()
+        # Per rule: series to group (sum), side (difference) or slot (integral), None if not matched
+        self._list_dict_series = [{} for _ in list_rule]
+        # Difference: last (time, value) of each side. Integral: last time, value and running total per series.
+        self._list_hold = [{} for _ in list_rule]
+        self._list_integral = [
+            {'series': [], 'time': np.zeros(0, dtype=np.int64), 'value': np.zeros(0), 'total': np.zeros(0)}
+            for _ in list_rule
+        ]
+
+        if self.state_path is not None and os.path.exists(self.state_path):
+            self.load_state()
+
+        return None
+
+    def _select(self,
+        rule_index: int,
+        batch: points.PointBatch,
+        get_key: callable,
+    ) -> tuple:
+
+        # Series are matched once, then looked up
+        dict_series = self._list_dict_series[rule_index]
+        list_key = []
+        list_position = []
+        for position, series in enumerate(zip(batch.measurements, batch.tag_sets)):
+            if series in dict_series:
+                key = dict_series[series]
+            else:
+                key = dict_series[series] = get_key(*series)
+            if key is not None:
+                list_key.append(key)
+                list_position.append(position)
+
+        array_position = np.array(list_position, dtype=np.int64)
+        array_value = np.frombuffer(batch.values, dtype=np.float64)[array_position]
+        array_time = np.frombuffer(batch.times, dtype=np.int64)[array_position]
+
+        # A NaN or inf sample would stick in a held value or a running total
+        # (and in the saved state), they are dropped like the encoder does
+        finite = np.isfinite(array_value)
+        if not finite.all():
+            list_key = [key for key, keep in zip(list_key, finite.tolist()) if keep]
+            array_value, array_time = array_value[finite], array_time[finite]
+
+        return list_key, array_value, array_time
+
+    def _process_sum(self,
+        rule_index: int,
+        rule: dict,
+        batch: points.PointBatch,
+        output: points.PointBatch,
+    ) -> None:
+
+        # Samples of a group sharing a timestamp are added up, e.g. the three
+        # phases of a meter read in the same request.
+        list_group_by = rule.get('group_by', [])
+        dict_output_tag = rule['output'].get('tags', {})
+
+        def get_key(measurement: str, tag_set: tuple) -> tuple:
+            if not _matches(rule['input'], measurement, tag_set):
+                return None
+            dict_tag = dict(tag_set)
+            return points.tag_set({**{key: dict_tag.get(key, "") for key in list_group_by}, **dict_output_tag})
+
+        list_key, array_value, array_time = self._select(rule_index, batch, get_key)
+        if not list_key:
+            return None
+
+        list_tag_set = list(dict.fromkeys(list_key))
+        dict_group = {tag_set: group for group, tag_set in enumerate(list_tag_set)}
+        array_group = np.fromiter((dict_group[key] for key in list_key), dtype=np.int64, count=len(list_key))
+
+        array_slot, array_inverse = np.unique(np.stack([array_group, array_time]), axis=1, return_inverse=True)
+        array_inverse = array_inverse.reshape(-1)
+        array_sum = np.bincount(array_inverse, weights=array_value)
+        array_count = np.bincount(array_inverse)
+
+        measurement = rule['output']['measurement']
+        for group, time_ns, total, count in zip(array_slot[0].tolist(), array_slot[1].tolist(), array_sum.tolist(), array_count.tolist()):
+            # A group missing members at this timestamp would give a partial total
+            if count >= rule.get('min_count', 1):
+                output.append(measurement, list_tag_set[group], total, time_ns)
+
+        return None
+
+    def _process_difference(self,
+        rule_index: int,
+        rule: dict,
+        batch: points.PointBatch,
+        output: points.PointBatch,
+    ) -> None:
+
+        # left - right at every left sample, with the latest right sample no
+        # older than max_age_second, so sources polled at different rates
+        # (load every second, PV every minute) still combine.
+        def get_key(measurement: str, tag_set: tuple) -> str:
+            if _matches(rule['left'], measurement, tag_set):
+                return "left"
+            if _matches(rule['right'], measurement, tag_set):
+                return "right"
+            return None
+
+        list_key, array_value, array_time = self._select(rule_index, batch, get_key)
+        if not list_key:
+            return None
+
+        array_left = np.array(list_key) == "left"
+        dict_hold = self._list_hold[rule_index]
+
+        right_time = array_time[~array_left]
+        right_value = array_value[~array_left]
+        if "right" in dict_hold:
+            right_time = np.concatenate(([dict_hold['right'][0]], right_time))
+            right_value = np.concatenate(([dict_hold['right'][1]], right_value))
+        order = np.argsort(right_time, kind='stable')
+        right_time, right_value = right_time[order], right_value[order]
+
+        left_time = array_time[array_left]
+        left_value = array_value[array_left]
+        if len(left_time) and len(right_time):
+            array_index = np.searchsorted(right_time, left_time, side='right') - 1
+            valid = array_index >= 0
+            array_index = np.maximum(array_index, 0)
+            valid &= left_time - right_time[array_index] <= rule.get('max_age_second', 60) * 1_000_000_000
+            array_result = left_value - right_value[array_index]
+
+            measurement = rule['output']['measurement']
+            tag_set = points.tag_set(rule['output'].get('tags', {}))
+            for time_ns, value in zip(left_time[valid].tolist(), array_result[valid].tolist()):
+                output.append(measurement, tag_set, value, time_ns)
+
+        if len(right_time):
+            dict_hold['right'] = (int(right_time[-1]), float(right_value[-1]))
+
+        return None
+
+    def _process_integral(self,
+        rule_index: int,
+        rule: dict,
+        batch: points.PointBatch,
+        output: points.PointBatch,
+    ) -> None:
+
+        # Trapezoidal integral of each matched series as a running total, by
+        # default W to Wh. Intervals longer than max_gap_second add nothing,
+        # the total resumes from the next pair of samples.
+        state = self._list_integral[rule_index]
+        dict_output_tag = rule['output'].get('tags', {})
+
+        def get_key(measurement: str, tag_set: tuple) -> int:
+            if not _matches(rule['input'], measurement, tag_set):
+                return None
+            slot = len(state['series'])
+            state['series'].append((measurement, tag_set))
+            for key, fill in (('time', -1), ('value', 0.0), ('total', 0.0)):
+                state[key] = np.append(state[key], fill).astype(state[key].dtype)
+            return slot
+
+        list_key, array_value, array_time = self._select(rule_index, batch, get_key)
+        if not list_key:
+            return None
+
+        array_slot = np.array(list_key, dtype=np.int64)
+        # Late samples (at or before the last one integrated) are dropped
+        keep = array_time > state['time'][array_slot]
+        array_slot, array_value, array_time = array_slot[keep], array_value[keep], array_time[keep]
+        if not len(array_slot):
+            return None
+
+        order = np.lexsort((array_time, array_slot))
+        array_slot, array_value, array_time = array_slot[order], array_value[order], array_time[order]
+
+        # Previous sample of each sample: the one before it in the batch, or the
+        # last one of an earlier batch for the first sample of each series
+        first = np.ones(len(array_slot), dtype=bool)
+        first[1:] = array_slot[1:] != array_slot[:-1]
+        previous_time = np.empty_like(array_time)
+        previous_value = np.empty_like(array_value)
+        previous_time[1:], previous_value[1:] = array_time[:-1], array_value[:-1]
+        previous_time[first] = state['time'][array_slot[first]]
+        previous_value[first] = state['value'][array_slot[first]]
+
+        dt_second = (array_time - previous_time) / 1e9
+        valid = (previous_time >= 0) & (dt_second <= rule.get('max_gap_second', 60))
+        increment = np.where(valid, (array_value + previous_value) / 2 * dt_second * rule.get('scale', 1 / 3600), 0.0)
+
+        # Running sum restarting at each series, on top of its stored total
+        cumulative = np.cumsum(increment)
+        offset = (cumulative - increment)[first]
+        array_total = state['total'][array_slot] + cumulative - np.repeat(offset, np.diff(np.append(np.flatnonzero(first), len(first))))
+
+        for slot, time_ns, total in zip(array_slot.tolist(), array_time.tolist(), array_total.tolist()):
+            measurement, tag_set = state['series'][slot]
+            output.append(rule['output']['measurement'], points.tag_set({**dict(tag_set), **dict_output_tag}), total, time_ns)
+
+        last = np.append(np.flatnonzero(first)[1:] - 1, len(first) - 1)
+        state['time'][array_slot[last]] = array_time[last]
+        state['value'][array_slot[last]] = array_value[last]
+        state['total'][array_slot[last]] = array_total[last]
+
+        return None
+
+    def process(self,
+        batch: points.PointBatch,
+    ) -> points.PointBatch:
+
+        output = points.PointBatch()
+        if not batch:
+            return output
+
+        with self._lock:
+            batch_input = points.PointBatch()
+            batch_input.extend(batch)
+            for rule_index, rule in enumerate(self.list_rule):
+                batch_rule = points.PointBatch()
+                getattr(self, f"_process_{rule['type']}")(rule_index, rule, batch_input, batch_rule)
+                batch_input.extend(batch_rule)
+                output.extend(batch_rule)
+
+        return output
+
+    def save_state(self) -> None:
+
+        # Only the running totals of the integrals are worth keeping across restarts
+        if self.state_path is None:
+            return None
+
+        with self._lock:
+            dict_array = {}
+            for rule_index, state in enumerate(self._list_integral):
+                if state['series']:
+                    dict_array[f"{rule_index}-series"] = np.array([repr(series) for series in state['series']], dtype=str)
+                    for key in ('time', 'value', 'total'):
+                        dict_array[f"{rule_index}-{key}"] = state[key].copy()
+
+        path_tmp = f"{self.state_path}.tmp.npz"
+        np.savez(path_tmp, **dict_array)
+        os.replace(path_tmp, self.state_path)
+
+        return None
+
+    def load_state(self) -> None:
+
+        try:
+            with np.load(self.state_path) as data:
+                dict_array = {key: data[key] for key in data.files}
+        except Exception as e:
+            logging.error(f"Couldn't load derived metrics state from {self.state_path}, starting empty: {e}")
+            return None
+
+        with self._lock:
+            for rule_index, rule in enumerate(self.list_rule):
+                if rule['type'] != "integral" or f"{rule_index}-series" not in dict_array:
+                    continue
+                state = self._list_integral[rule_index]
+                for slot, series in enumerate(dict_array[f"{rule_index}-series"].tolist()):
+                    measurement, tag_set = ast.literal_eval(series)
+                    series = (measurement, points.tag_set(dict(tag_set)))
+                    if not _matches(rule['input'], *series):
+                        continue
+                    self._list_dict_series[rule_index][series] = len(state['series'])
+                    state['series'].append(series)
+                    for key in ('time', 'value', 'total'):
+                        state[key] = np.append(state[key], dict_array[f"{rule_index}-{key}"][slot]).astype(state[key].dtype)
+
+        logging.info(f"Derived metrics state loaded from {self.state_path}")
+
+        return None
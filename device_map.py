@@ -0,0 +1,162 @@
+import json
+import logging
+import os
+
+import points
+
+DEVICE_MAP_DIRECTORY = os.path.join(os.path.dirname(os.path.abspath(__file__)), "device_maps")
+
+DICT_REGISTER_SIZE = {
+    "long": 2,
+    "register": 1,
+}
+
+def load_device_map(
+    path: str,
+) -> dict:
+
+    if not os.path.isabs(path) and not os.path.exists(path):
+        path = os.path.join(DEVICE_MAP_DIRECTORY, path)
+
+    with open(path) as file:
+        if path.endswith((".yaml", ".yml")):
+            try:
+                import yaml
+            except ModuleNotFoundError:
+                logging.error(f"PyYAML module not found, can't load device map {path}")
+                raise
+            dict_device_map = yaml.safe_load(file)
+        else:
+            dict_device_map = json.load(file)
+
+    logging.info(f"Device map {dict_device_map.get('model', path)} loaded from {path}")
+
+    return dict_device_map
+
+def plan_block_reads(
+    dict_register: dict,
+    max_gap: int = 0,
+    max_number_of_registers: int = 125,
+) -> list:
+
+    list_register = sorted(
+        (
+            data['register_address'],
+            DICT_REGISTER_SIZE[data['type']],
+            name,
+        )
+        for name, data in dict_register.items()
+    )
+
+    list_block_read = []
+    for register_address, number_of_registers, name in list_register:
+        if list_block_read:
+            block = list_block_read[-1]
+            block_end = block['start_address'] + block['number_of_registers']
+            new_end = max(block_end, register_address + number_of_registers)
+            if register_address - block_end <= max_gap and new_end - block['start_address'] <= max_number_of_registers:
+                block['number_of_registers'] = new_end - block['start_address']
+                block['list_register'].append(name)
+                continue
+
+        list_block_read.append({
+            'start_address': register_address,
+            'number_of_registers': number_of_registers,
+            'list_register': [name],
+        })
+
+    return list_block_read
+
+class DecodePlan:
+
+    def __init__(self,
+        dict_device_map: dict,
+        dict_tag: dict = {},
+    ) -> None:
+
+        dict_register = dict_device_map['registers']
+        for name, data in dict_register.items():
+            assert data['type'] in DICT_REGISTER_SIZE, f"Register {name} has type {data['type']}, not among {list(DICT_REGISTER_SIZE)}"
+
+        self.model = dict_device_map.get('model', "unknown")
+        self.list_block_read = plan_block_reads(dict_register)
+
+        # Everything below is resolved once: register names become indexes into
+        # a flat value list, tag sets are interned, so a cycle only runs the plan.
+        self.list_register = [name for block in self.list_block_read for name in block['list_register']]
+        dict_index = {name: index for index, name in enumerate(self.list_register)}
+
+        self.list_block_op = []
+        for block in self.list_block_read:
+            list_op = []
+            for name in block['list_register']:
+                data = dict_register[name]
+                list_op.append((
+                    dict_index[name],
+                    data['register_address'] - block['start_address'],
+                    data['type'] == 'long',
+                    bool(data.get('signed', False)),
+                    float(data.get('scale', 1.0)),
+                ))
+            self.list_block_op.append(list_op)
+
+        self.list_point_op = []
+        for point in dict_device_map['points']:
+            for key in ('register', 'sign', 'subtract'):
+                assert point.get(key) is None or point[key] in dict_index, f"Point {point['measurement']} refers to unknown register {point[key]}"
+            self.list_point_op.append((
+                point['measurement'],
+                points.tag_set({**dict_tag, **point.get('tags', {})}),
+                dict_index[point['register']],
+                dict_index[point['sign']] if point.get('sign') else -1,
+                dict_index[point['subtract']] if point.get('subtract') else -1,
+            ))
+
+        return None
+
+    def decode(self,
+        list_list_word: list,
+    ) -> list:
+
+        # list_list_word holds the words of each block read, None if it failed
+        list_value = [None] * len(self.list_register)
+        for list_word, list_op in zip(list_list_word, self.list_block_op):
+            if list_word is None:
+                continue
+            for index, offset, is_long, signed, scale in list_op:
+                if is_long:
+                    # Big-endian word order, same as minimalmodbus.Instrument.read_long default
+                    data = (list_word[offset] << 16) | list_word[offset + 1]
+                    if signed and data >= 0x80000000:
+                        data -= 0x100000000
+                else:
+                    data = list_word[offset]
+                    if signed and data >= 0x8000:
+                        data -= 0x10000
+                list_value[index] = data * scale
+
+        return list_value
+
+    def execute(self,
+        list_value: list,
+        time_ns: int,
+        batch: points.PointBatch,
+    ) -> points.PointBatch:
+
+        for measurement, tag_set, index, sign_index, subtract_index in self.list_point_op:
+            value = list_value[index]
+            if value is None:
+                continue
+            if sign_index >= 0:
+                sign = list_value[sign_index]
+                if sign is None:
+                    continue
+                value = value * (-2*sign + 1)
+            if subtract_index >= 0:
+                subtract = list_value[subtract_index]
+                if subtract is None:
+                    continue
+                value = value - subtract
+            batch.append(measurement, tag_set, float(value), time_ns)
+
+        return batch
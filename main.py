@@ -1,10 +1,17 @@
-import classes
+import breaker
+import deadband
+import metrics
+import points
+import response_cache
+import scheduler
+import sharding
+import sinks
+import sources
+import spool
+import writer
 import os
 import logging
 from pprint import pformat
-import datetime
-from influxdb_client import InfluxDBClient, Point, WritePrecision
-from influxdb_client.client.write_api import ASYNCHRONOUS
 
 FORMAT = '[%(levelname)s | %(asctime)-15s | %(filename)s | %(funcName)s | %(module)s] %(message)s'
 logging.basicConfig(level=logging.INFO, format=FORMAT)
@@ -13,7 +20,8 @@ DICT_DATA_LOGGING_FREQUENCY_SECOND = {
     "co2signal": 3600,
     "shelly": 1,
     "huawei_pv": 60,
-    "modbusrtuf4n200": 1
+    "modbusrtuf4n200": 1,
+    "modbustcp": 1,
 }
 
 try:
@@ -30,96 +38,496 @@ DICT_SHELLY_LOCATION_ID = {
     "Wagner": "c45bbe78ad66"
 }
 
+# Per measurement deadband, a point is only written when it moves out of the
+# band around the last written value or when heartbeat_second has elapsed
+DICT_DEADBAND = {
+    "voltage": {"absolute": 0.5, "heartbeat_second": 60},
+    "active_power": {"absolute": 5.0, "relative": 0.01, "heartbeat_second": 60},
+    "power_factor": {"absolute": 0.01, "heartbeat_second": 60},
+    "active_energy": {"absolute": 1.0, "heartbeat_second": 300},
+    "reactive_energy": {"absolute": 1.0, "heartbeat_second": 300},
+}
+
+DEADBAND_REPORT_FREQUENCY_SECOND = 3600
+
+METRICS_INFLUXDB_FREQUENCY_SECOND = 60
+
+DERIVED_STATE_FREQUENCY_SECOND = 60
+
+# Rollups (min, max, mean, last, count) are written to "<measurement>_<label>"
+DICT_ROLLUP_INTERVAL_SECOND = {
+    "10s": 10,
+    "1m": 60,
+    "15m": 900,
+}
+
+# Derived series computed on every batch in this order and written as ordinary
+# points, so dashboards don't have to join raw series at query time
+LIST_DERIVED = [
+    # Three phase totals of every load meter
+    {
+        "type": "sum",
+        "input": {"measurement": "active_power", "tags": {"category": "load"}},
+        "group_by": ["location", "category"],
+        "output": {"measurement": "active_power", "tags": {"phase": "total"}},
+        "min_count": 3,
+    },
+    # Laboratory consumption net of PV production, PV being polled every minute
+    {
+        "type": "difference",
+        "left": {"measurement": "active_power", "tags": {"location": "Laboratory", "category": "load", "phase": "total"}},
+        "right": {"measurement": "active_power", "tags": {"location": "Laboratory", "category": "pv"}},
+        "output": {"measurement": "net_power", "tags": {"location": "Laboratory"}},
+        "max_age_second": 120,
+    },
+    # Energy in Wh from power where the energy counters are coarse
+    {
+        "type": "integral",
+        "input": {"measurement": "active_power", "tags": {"phase": "total"}},
+        "output": {"measurement": "active_energy_integrated"},
+        "max_gap_second": 10,
+    },
+    {
+        "type": "integral",
+        "input": {"measurement": "active_power", "tags": {"category": "pv"}},
+        "output": {"measurement": "active_energy_integrated"},
+        "max_gap_second": 300,
+    },
+]
+
+# Meters daisy-chained on the MODBUS_RTU_F4N200-PORT bus, by slave address
+DICT_MODBUS_RTU_SLAVE = {
+    5: {
+        "location": "Laboratory",
+        "device_map_path": os.getenv("MODBUS_RTU_F4N200-DEVICE_MAP", "f4n200.json"),
+        "interval_second": 1,
+    },
+}
+
+# Meters behind the MODBUS_TCP-HOST gateway, by unit id
+DICT_MODBUS_TCP_UNIT = {
+    5: {
+        "location": "Laboratory",
+        "device_map_path": os.getenv("MODBUS_TCP-DEVICE_MAP", "f4n200.json"),
+    },
+}
+
 LIST_CO2SIGNAL_ZONE_CODES = [
     "IT-NO",
     "IT-CSO"
 ]
 
-obj_co2signal = classes.Co2Signal(
-    url=os.getenv("CO2SIGNAL-URL"),
-    auth=os.getenv("CO2SIGNAL-AUTH"),
+# Shelly devices reachable on the LAN, as "<id>=<host>,<id>=<host>"
+DICT_SHELLY_ID_HOST = dict(
+    item.split("=", 1) for item in os.getenv("SHELLY-LOCAL_HOSTS", "").split(",") if item
 )
 
-obj_shelly = classes.Shelly3Em(
-    url=os.getenv("SHELLY-URL"),
-    token=os.getenv("SHELLY-TOKEN")
-)
+# With ACQUISITION-WORKERS > 0 sources run in worker processes: the sources in
+# LIST_SHARDED_SOURCE are split by device across all workers, the others are
+# assigned to one worker each. SHARD_INDEX and SHARD_COUNT are set in the worker.
+LIST_SHARDED_SOURCE = ["shelly"]
+SHARD_INDEX = 0
+SHARD_COUNT = 1
 
-obj_huawei_pv = classes.HuaweiPv(
-    username=os.getenv("HUAWEI_PV-USERNAME"),
-    password=os.getenv("HUAWEI_PV-PASSWORD"),
-    subdomain=os.getenv("HUAWEI_PV-SUBDOMAIN"),
-    captcha_model_path=os.path.join(os.getcwd(), "utils/captcha_huawei.onnx")
-)
+# Responses of slow sources are cached per source, snapshotted to disk so a
+# restart within their TTL makes no upstream call. Stale responses are served
+# for up to RESPONSE_CACHE-MAX_STALE_SECOND while the upstream fails.
+def get_response_cache(name: str) -> response_cache.ResponseCache:
+    if os.getenv("RESPONSE_CACHE-ENABLED", "true").lower() != "true":
+        return None
+    return response_cache.ResponseCache(
+        name,
+        snapshot_path=os.path.join(os.getenv("RESPONSE_CACHE-DIRECTORY", os.path.join(os.getcwd(), "response_cache")), f"{name}.json"),
+        max_stale_second=float(os.getenv("RESPONSE_CACHE-MAX_STALE_SECOND", 0)),
+        wait_timeout_second=float(os.getenv("RESPONSE_CACHE-WAIT_TIMEOUT_SECOND", 10)),
+    )
+
+# Each factory imports what its source needs, so sources that aren't enabled
+# (SOURCES, default all the configured ones) cost neither import time nor memory.
+def load_co2signal() -> tuple:
+    import classes
+    obj_co2signal = classes.Co2Signal(
+        url=os.getenv("CO2SIGNAL-URL"),
+        auth=os.getenv("CO2SIGNAL-AUTH"),
+        cache=get_response_cache("co2signal"),
+        # Clearly below the poll interval, so every poll refetches despite jitter
+        cache_ttl_second=float(os.getenv("CO2SIGNAL-CACHE_TTL_SECOND", 0.9 * DICT_DATA_LOGGING_FREQUENCY_SECOND["co2signal"])),
+    )
+    
+    def get_points_co2signal() -> points.PointBatch:
+        batch = points.PointBatch()
+        for zone_code in LIST_CO2SIGNAL_ZONE_CODES:
+            point = obj_co2signal.get_point_influxdb(zone_code)
+            batch.extend(point)
+            logging.debug(f"Point: {point}")
+        # The client logs and swallows errors, the circuit breaker needs an exception
+        if not batch:
+            raise RuntimeError("No data for any zone code")
+        return batch
+    
+    return obj_co2signal, get_points_co2signal
+
+def load_shelly() -> tuple:
+    import classes
+    dict_location_id = dict(list(DICT_SHELLY_LOCATION_ID.items())[SHARD_INDEX::SHARD_COUNT])
+    obj_shelly = classes.Shelly3Em(
+        url=os.getenv("SHELLY-URL"),
+        token=os.getenv("SHELLY-TOKEN"),
+        dict_id_host=DICT_SHELLY_ID_HOST,
+        local_auth=(os.getenv("SHELLY-LOCAL_USERNAME"), os.getenv("SHELLY-LOCAL_PASSWORD")) if os.getenv("SHELLY-LOCAL_USERNAME") else None,
+    )
+    
+    def get_points_shelly() -> points.PointBatch:
+        point = obj_shelly.get_points_influxdb(dict_location_id)
+        logging.debug(f"Point: {point}")
+        if not point:
+            raise RuntimeError("No data from any Shelly device")
+        return point
+    
+    return obj_shelly, get_points_shelly
+
+def load_huawei_pv() -> tuple:
+    import classes
+    obj_huawei_pv = classes.HuaweiPv(
+        username=os.getenv("HUAWEI_PV-USERNAME"),
+        password=os.getenv("HUAWEI_PV-PASSWORD"),
+        subdomain=os.getenv("HUAWEI_PV-SUBDOMAIN"),
+        captcha_model_path=os.path.join(os.getcwd(), "utils/captcha_huawei.onnx"),
+        session_path=os.getenv("HUAWEI_PV-SESSION_PATH", os.path.join(os.getcwd(), "huawei_pv_session.json")),
+        cache=get_response_cache("huawei_pv"),
+        # Refetched every fifth poll, FusionSolar only refreshes every few minutes
+        cache_ttl_second=float(os.getenv("HUAWEI_PV-CACHE_TTL_SECOND", 0.9 * 5 * DICT_DATA_LOGGING_FREQUENCY_SECOND["huawei_pv"])),
+    )
+    
+    def get_points_huawei_pv() -> points.PointBatch:
+        point = obj_huawei_pv.get_point_influxdb()
+        logging.debug(f"Point: {point}")
+        if not point:
+            raise RuntimeError("No data from FusionSolar")
+        return point
+    
+    return obj_huawei_pv, get_points_huawei_pv
 
-obj_modbusrtuf4n200 = classes.ModbusRtuF4N200(
-    port=os.getenv("MODBUS_RTU_F4N200-PORT")
+def load_modbusrtuf4n200() -> tuple:
+    import modbus_bus
+    obj_modbusrtuf4n200 = modbus_bus.ModbusRtuBus(
+        port=os.getenv("MODBUS_RTU_F4N200-PORT"),
+        cycle_budget_second=0.9 * DICT_DATA_LOGGING_FREQUENCY_SECOND["modbusrtuf4n200"],
+    )
+    for slave_address, dict_slave in DICT_MODBUS_RTU_SLAVE.items():
+        obj_modbusrtuf4n200.add_device(slave_address, **dict_slave)
+    metrics.REGISTRY.register_collector(obj_modbusrtuf4n200.collect_metrics)
+        
+    def get_points_modbusrtuf4n200() -> points.PointBatch:
+        point = obj_modbusrtuf4n200.poll()
+        logging.debug(f"Point: {point}")
+        return point
+    
+    return obj_modbusrtuf4n200, get_points_modbusrtuf4n200
+
+def load_modbustcp() -> tuple:
+    import modbus_tcp
+    obj_modbustcp = modbus_tcp.ModbusTcpPanel(modbus_tcp.ModbusTcpGateway(
+        host=os.getenv("MODBUS_TCP-HOST"),
+        port=int(os.getenv("MODBUS_TCP-PORT", 502)),
+        max_outstanding=int(os.getenv("MODBUS_TCP-MAX_OUTSTANDING", 8)),
+        timeout_second=0.9 * DICT_DATA_LOGGING_FREQUENCY_SECOND["modbustcp"],
+    ))
+    for unit_id, dict_unit in DICT_MODBUS_TCP_UNIT.items():
+        obj_modbustcp.add_device(unit_id, **dict_unit)
+    
+    def get_points_modbustcp() -> points.PointBatch:
+        point = obj_modbustcp.poll()
+        logging.debug(f"Point: {point}")
+        return point
+    
+    return obj_modbustcp, get_points_modbustcp
+
+obj_source_registry = sources.SourceRegistry(
+    list_enabled=os.getenv("SOURCES").split(",") if os.getenv("SOURCES") else None,
 )
+obj_source_registry.register("co2signal", load_co2signal, DICT_DATA_LOGGING_FREQUENCY_SECOND["co2signal"], ["CO2SIGNAL-URL", "CO2SIGNAL-AUTH"])
+obj_source_registry.register("shelly", load_shelly, DICT_DATA_LOGGING_FREQUENCY_SECOND["shelly"], ["SHELLY-URL", "SHELLY-TOKEN"])
+obj_source_registry.register("huawei_pv", load_huawei_pv, DICT_DATA_LOGGING_FREQUENCY_SECOND["huawei_pv"], ["HUAWEI_PV-USERNAME", "HUAWEI_PV-PASSWORD", "HUAWEI_PV-SUBDOMAIN"])
+obj_source_registry.register("modbusrtuf4n200", load_modbusrtuf4n200, DICT_DATA_LOGGING_FREQUENCY_SECOND["modbusrtuf4n200"], ["MODBUS_RTU_F4N200-PORT"])
+obj_source_registry.register("modbustcp", load_modbustcp, DICT_DATA_LOGGING_FREQUENCY_SECOND["modbustcp"], ["MODBUS_TCP-HOST"])
+
+# Every source call gets a deadline within its slot (capped for the slow
+# sources) and a circuit breaker, so a dead upstream is probed with backoff
+# instead of being waited on every cycle.
+SOURCE_DEADLINE_MAX_SECOND = float(os.getenv("SOURCE-DEADLINE_MAX_SECOND", 30.0))
+
+# Aligned acquisition triggers every source on a shared grid (whole multiples
+# of its interval) and stamps its samples with the grid slot, so samples of the
+# same second from different sources have the same timestamp.
+ACQUISITION_ALIGNED = os.getenv("ACQUISITION-ALIGNED", "false").lower() == "true"
+ACQUISITION_DIAGNOSTICS = os.getenv("ACQUISITION-DIAGNOSTICS", "false").lower() == "true"
 
-client_influxdb = InfluxDBClient(
-    url=os.getenv("INFLUXDB-URL"),
-    token=os.getenv("INFLUXDB-TOKEN"),
-    org=os.getenv("INFLUXDB-ORG")
-)    
-write_api = client_influxdb.write_api(write_options=ASYNCHRONOUS)
+def get_guarded_function(
+    name: str,
+    frequency_second: float,
+) -> breaker.GuardedSource:
+    return breaker.GuardedSource(
+        name,
+        obj_source_registry.get_function(name),
+        deadline_second=min(0.9 * frequency_second, SOURCE_DEADLINE_MAX_SECOND),
+        breaker=breaker.CircuitBreaker(
+            name,
+            failure_threshold=int(os.getenv("BREAKER-FAILURE_THRESHOLD", 3)),
+            backoff_initial_second=float(os.getenv("BREAKER-BACKOFF_INITIAL_SECOND", 5.0)),
+            backoff_max_second=float(os.getenv("BREAKER-BACKOFF_MAX_SECOND", 300.0)),
+        ),
+    )
+
+# The InfluxDB client is the heaviest import of all, it's only needed once the
+# spool drainer writes, so it's created on the drainer's first write.
+client_influxdb = None
+write_api = None
+
+def get_write_api() -> object:
+    global client_influxdb, write_api
+    if write_api is None:
+        from influxdb_client import InfluxDBClient
+        from influxdb_client.client.write_api import SYNCHRONOUS
+        client_influxdb = InfluxDBClient(
+            url=os.getenv("INFLUXDB-URL"),
+            token=os.getenv("INFLUXDB-TOKEN"),
+            org=os.getenv("INFLUXDB-ORG"),
+            enable_gzip=os.getenv("INFLUXDB-GZIP", "true").lower() == "true",
+        )
+        write_api = client_influxdb.write_api(write_options=SYNCHRONOUS)
+    return write_api
+
+# Outputs every batch is written to, "influxdb", "parquet" and/or "sqlite"
+LIST_SINK = [sink for sink in os.getenv("SINKS", "influxdb").split(",") if sink]
+
+obj_spool = None
+if "influxdb" in LIST_SINK:
+    obj_spool = spool.Spool(
+        directory=os.getenv("SPOOL-DIRECTORY", os.path.join(os.getcwd(), "spool")),
+        max_total_bytes=int(os.getenv("SPOOL-MAX_BYTES", 1024 * 1024 * 1024)),
+    )
+
+def write_influxdb(data: bytes) -> None:
+    from influxdb_client import WritePrecision
+    res = get_write_api().write(bucket=os.getenv("INFLUXDB-BUCKET"), record=data, write_precision=WritePrecision.NS)
+    logging.info("Data written to InfluxDB")
+
+# Batches are coalesced by the writer and flushed to the spool by count, size
+# or age, the spool drainer then writes each flush to InfluxDB in one request.
+obj_batch_writer = None
+if obj_spool is not None:
+    obj_batch_writer = writer.BatchWriter(
+        write_function=obj_spool.append,
+        max_points=int(os.getenv("WRITER-MAX_POINTS", 5000)),
+        max_bytes=int(os.getenv("WRITER-MAX_BYTES", 1024 * 1024)),
+        max_age_second=float(os.getenv("WRITER-MAX_AGE_SECOND", 5.0)),
+        queue_full_policy=os.getenv("WRITER-QUEUE_FULL_POLICY", "spill"),
+        spill_function=obj_spool.append,
+    )
+
+# Local sinks buffer far more points than the InfluxDB writer, so each file
+# gets few, large row groups or transactions.
+dict_sink = {}
+if "parquet" in LIST_SINK:
+    dict_sink["parquet"] = sinks.ParquetSink(
+        directory=os.getenv("PARQUET-DIRECTORY", os.path.join(os.getcwd(), "parquet")),
+        rotation=os.getenv("PARQUET-ROTATION", "hour"),
+        compression=os.getenv("PARQUET-COMPRESSION", "zstd"),
+    )
+if "sqlite" in LIST_SINK:
+    dict_sink["sqlite"] = sinks.SqliteSink(
+        path=os.getenv("SQLITE-PATH", os.path.join(os.getcwd(), "data.sqlite")),
+    )
+obj_sink_fanout = None
+if dict_sink:
+    obj_sink_fanout = sinks.SinkFanout(
+        dict_sink,
+        max_points=int(os.getenv("SINKS-MAX_POINTS", 100_000)),
+        max_age_second=float(os.getenv("SINKS-MAX_AGE_SECOND", 60.0)),
+    )
+
+def put_batch(batch: points.PointBatch) -> None:
+    if obj_batch_writer is not None:
+        obj_batch_writer.put(batch)
+    if obj_sink_fanout is not None:
+        obj_sink_fanout.put(batch)
+
+obj_deadband_filter = None
+if os.getenv("DEADBAND-ENABLED", "false").lower() == "true":
+    obj_deadband_filter = deadband.DeadbandFilter(DICT_DEADBAND)
+
+obj_rollup = None
+if os.getenv("ROLLUP-ENABLED", "false").lower() == "true":
+    import rollup
+    obj_rollup = rollup.RollupAggregator(
+        DICT_ROLLUP_INTERVAL_SECOND,
+        state_path=os.getenv("ROLLUP-STATE_PATH", os.path.join(os.getcwd(), "rollup_state.npz")),
+    )
+ROLLUP_RAW = os.getenv("ROLLUP-RAW", "true").lower() == "true"
+
+def flush_rollup() -> points.PointBatch:
+    batch = obj_rollup.flush()
+    obj_rollup.save_state()
+    return batch
+
+obj_derived = None
+if os.getenv("DERIVED-ENABLED", "false").lower() == "true":
+    import derived
+    obj_derived = derived.DerivedMetrics(
+        LIST_DERIVED,
+        state_path=os.getenv("DERIVED-STATE_PATH", os.path.join(os.getcwd(), "derived_state.npz")),
+    )
+
+obj_cache = None
+if os.getenv("CACHE-ENABLED", "false").lower() == "true":
+    import cache
+    obj_cache = cache.RecentCache(samples_per_series=int(os.getenv("CACHE-SAMPLES_PER_SERIES", 600)))
+
+def collect_metrics() -> list:
+    list_metric = []
+    dict_source = obj_source_registry.get_loaded()
+    list_http = []
+    if "co2signal" in dict_source:
+        list_http.append(("co2signal", dict_source["co2signal"].http))
+    if "shelly" in dict_source:
+        list_http.extend((("shelly", dict_source["shelly"].http), ("shelly_local", dict_source["shelly"].http_local)))
+    for source, http in list_http:
+        for key, value in http.get_stats().items():
+            list_metric.append((f"http_{key}", {'source': source}, value))
+    if obj_batch_writer is not None:
+        for key, value in obj_batch_writer.get_stats().items():
+            list_metric.append((f"writer_{key}", {}, value))
+        for key, value in obj_spool.get_stats().items():
+            list_metric.append((f"spool_{key}", {}, value))
+    return list_metric
+
+metrics.REGISTRY.register_collector(collect_metrics)
+if obj_sink_fanout is not None:
+    metrics.REGISTRY.register_collector(obj_sink_fanout.collect_metrics)
+
+def run_shard(
+    send: callable,
+    dict_source_frequency_second: dict,
+    shard_index: int,
+    shard_count: int,
+) -> None:
+    global SHARD_INDEX, SHARD_COUNT
+    SHARD_INDEX, SHARD_COUNT = shard_index, shard_count
+    
+    obj_scheduler = scheduler.Scheduler()
+    for key, value in dict_source_frequency_second.items():
+        obj_scheduler.add_job(key, get_guarded_function(key, value), value, callback=send, align=ACQUISITION_ALIGNED, diagnostics=ACQUISITION_DIAGNOSTICS)
+    obj_scheduler.run()
+
+def write_points(batch: points.PointBatch) -> None:
+    # Derived points go through the same stages as the raw ones
+    if obj_derived is not None:
+        batch.extend(obj_derived.process(batch))
+    
+    if obj_cache is not None:
+        obj_cache.add(batch)
+    
+    # Rollups see every raw sample, the deadband only applies to raw output
+    batch_rollup = None
+    if obj_rollup is not None:
+        batch_rollup = obj_rollup.add(batch)
+        if not ROLLUP_RAW:
+            batch = points.PointBatch()
+    
+    if obj_deadband_filter is not None:
+        batch = obj_deadband_filter.filter(batch)
+    batch.extend(batch_rollup)
+    
+    if logging.getLogger().isEnabledFor(logging.DEBUG):
+        logging.debug(f"List point: {pformat(batch.to_points())}")
+    
+    try:
+        put_batch(batch)
+    except Exception as e:
+        logging.error(f"Couldn't queue data for writing: {e}")
 
 if __name__ == "__main__":
     logging.info("Starting main script...")
     
-    now = {}
-    for key, value in DICT_DATA_LOGGING_FREQUENCY_SECOND.items():
-        now[key] = datetime.datetime.now()
-
-    while True:
-        list_point = []
-        
-        try:
-            delta_time = datetime.datetime.now() - now["co2signal"]
-            if delta_time.seconds >= DICT_DATA_LOGGING_FREQUENCY_SECOND["co2signal"]:
-                for zone_code in LIST_CO2SIGNAL_ZONE_CODES:
-                    point = obj_co2signal.get_point_influxdb(zone_code)
-                    list_point.extend(point)
-                    logging.debug(f"Point: {pformat(point)}")
-                    now["co2signal"] = datetime.datetime.now()
-        except Exception as e:
-            logging.error(f"Coulnd't get CO2Signal data: {e}")
-            
-        try:
-            delta_time = datetime.datetime.now() - now["shelly"]
-            if delta_time.seconds >= DICT_DATA_LOGGING_FREQUENCY_SECOND["shelly"]:
-                for location, id in DICT_SHELLY_LOCATION_ID.items():
-                    point = obj_shelly.get_point_influxdb(id, location)
-                    list_point.extend(point)
-                    logging.debug(f"Point: {pformat(point)}")
-                    now["shelly"] = datetime.datetime.now()
-        except Exception as e:
-            logging.error(f"Coulnd't get Shelly data: {e}")
-                
-        try:
-            delta_time = datetime.datetime.now() - now["huawei_pv"]
-            if delta_time.seconds >= DICT_DATA_LOGGING_FREQUENCY_SECOND["huawei_pv"]:
-                point = obj_huawei_pv.get_point_influxdb()
-                list_point.extend(point)
-                logging.debug(f"Point: {pformat(point)}")
-                now["huawei_pv"] = datetime.datetime.now()
-        except Exception as e:
-            logging.error(f"Coulnd't get Huawei PV data: {e}")
-            
-        try:
-            delta_time = datetime.datetime.now() - now["modbusrtuf4n200"]
-            if delta_time.seconds >= DICT_DATA_LOGGING_FREQUENCY_SECOND["modbusrtuf4n200"]:
-                point = obj_modbusrtuf4n200.get_all_points_influxdb()
-                list_point.extend(point)
-                logging.debug(f"Point: {pformat(point)}")
-                now["modbusrtuf4n200"] = datetime.datetime.now()
-        except Exception as e:
-            logging.error(f"Coulnd't get Modbus RTU F4N200 data: {e}")
-        
-        if len(list_point) > 0:
-            logging.debug(f"List point: {pformat(list_point)}")
-            
-            try:
-                res = write_api.write(bucket=os.getenv("INFLUXDB-BUCKET"), record=list_point)
-                logging.info("Data written to InfluxDB")
-            except Exception as e:
-                logging.error(f"Couldn't write data to InfluxDB: {e}")
\ No newline at end of file
+    dict_source_frequency_second = obj_source_registry.get_enabled()
+    logging.info(f"Sources enabled: {', '.join(dict_source_frequency_second) or 'none'}")
+    
+    # Workers are forked before this process starts its own threads
+    obj_supervisor = None
+    number_of_workers = int(os.getenv("ACQUISITION-WORKERS", 0))
+    if number_of_workers > 0:
+        list_cpu = [int(cpu) for cpu in os.getenv("ACQUISITION-CPUS", "").split(",") if cpu]
+        obj_supervisor = sharding.ShardSupervisor(write_points)
+        list_unsharded = [key for key in dict_source_frequency_second if key not in LIST_SHARDED_SOURCE]
+        for shard_index in range(number_of_workers):
+            dict_shard = {key: dict_source_frequency_second[key] for key in list_unsharded[shard_index::number_of_workers]}
+            dict_shard.update({key: value for key, value in dict_source_frequency_second.items() if key in LIST_SHARDED_SOURCE})
+            if dict_shard:
+                obj_supervisor.add_worker(
+                    f"shard{shard_index}",
+                    run_shard,
+                    (dict_shard, shard_index, number_of_workers),
+                    [list_cpu[shard_index % len(list_cpu)]] if list_cpu else None,
+                )
+        metrics.REGISTRY.register_collector(obj_supervisor.collect_metrics)
+        obj_supervisor.start()
+    
+    obj_spool_drainer = None
+    if obj_batch_writer is not None:
+        obj_spool_drainer = spool.SpoolDrainer(obj_spool, write_influxdb)
+        obj_spool_drainer.start()
+        obj_batch_writer.start()
+    if obj_sink_fanout is not None:
+        obj_sink_fanout.start()
+    
+    if obj_cache is not None:
+        obj_cache_server = cache.CacheServer(
+            obj_cache,
+            host=os.getenv("CACHE-HOST", "127.0.0.1"),
+            port=int(os.getenv("CACHE-PORT", 8080)),
+        )
+        obj_cache_server.start()
+    
+    if os.getenv("METRICS-ENABLED", "true").lower() == "true":
+        obj_metrics_server = metrics.MetricsServer(
+            host=os.getenv("METRICS-HOST", "127.0.0.1"),
+            port=int(os.getenv("METRICS-PORT", 9108)),
+        )
+        obj_metrics_server.start()
+    
+    obj_scheduler = scheduler.Scheduler()
+    if obj_supervisor is None:
+        for key, value in dict_source_frequency_second.items():
+            obj_scheduler.add_job(key, get_guarded_function(key, value), value, callback=write_points, align=ACQUISITION_ALIGNED, diagnostics=ACQUISITION_DIAGNOSTICS)
+    if obj_rollup is not None:
+        obj_scheduler.add_job("rollup", flush_rollup, min(DICT_ROLLUP_INTERVAL_SECOND.values()), callback=put_batch)
+    if os.getenv("METRICS-INFLUXDB", "false").lower() == "true":
+        obj_scheduler.add_job("metrics", metrics.REGISTRY.to_batch, METRICS_INFLUXDB_FREQUENCY_SECOND, callback=put_batch, delay_second=METRICS_INFLUXDB_FREQUENCY_SECOND)
+    if obj_derived is not None:
+        obj_scheduler.add_job("derived_state", obj_derived.save_state, DERIVED_STATE_FREQUENCY_SECOND, delay_second=DERIVED_STATE_FREQUENCY_SECOND)
+    if obj_deadband_filter is not None:
+        obj_scheduler.add_job("deadband_report", obj_deadband_filter.log_report, DEADBAND_REPORT_FREQUENCY_SECOND, delay_second=DEADBAND_REPORT_FREQUENCY_SECOND)
+    
+    try:
+        obj_scheduler.run()
+    except KeyboardInterrupt:
+        logging.info("Stopping main script...")
+    finally:
+        if obj_supervisor is not None:
+            obj_supervisor.stop()
+        if obj_rollup is not None:
+            obj_rollup.save_state()
+        if obj_derived is not None:
+            obj_derived.save_state()
+        if obj_batch_writer is not None:
+            obj_batch_writer.stop()
+            obj_spool_drainer.stop()
+            obj_spool.close()
+        if obj_sink_fanout is not None:
+            obj_sink_fanout.stop()
+        if "modbustcp" in obj_source_registry.get_loaded():
+            obj_source_registry.get("modbustcp").gateway.close()
+        if write_api is not None:
+            write_api.close()
+            client_influxdb.close()
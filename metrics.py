@@ -0,0 +1,269 @@
+import bisect
+import logging
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import points
+
+LIST_BUCKET_SECOND = [0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0]
+LIST_BUCKET_POINT = [1, 10, 50, 100, 500, 1000, 5000, 10000, 50000]
+
+INFLUXDB_MEASUREMENT = "data_logging_metrics"
+
+def _escape_label(value) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+class Histogram:
+
+    __slots__ = ('list_bucket', 'list_count', 'sum', 'count')
+
+    def __init__(self,
+        list_bucket: list,
+    ) -> None:
+        self.list_bucket = list_bucket
+        self.list_count = [0] * (len(list_bucket) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self,
+        value: float,
+    ) -> None:
+        self.list_count[bisect.bisect_left(self.list_bucket, value)] += 1
+        self.sum += value
+        self.count += 1
+
+class Registry:
+
+    def __init__(self) -> None:
+
+        self._lock = threading.Lock()
+        self._dict_counter = {}
+        self._dict_gauge = {}
+        self._dict_histogram = {}
+        self._dict_help = {}
+        self._list_collector = []
+        self._dict_imported = {}
+
+        return None
+
+    def inc(self,
+        name: str,
+        value: float = 1.0,
+        **labels,
+    ) -> None:
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._dict_counter[key] = self._dict_counter.get(key, 0.0) + value
+        return None
+
+    def set(self,
+        name: str,
+        value: float,
+        **labels,
+    ) -> None:
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._dict_gauge[key] = value
+        return None
+
+    def observe(self,
+        name: str,
+        value: float,
+        list_bucket: list = LIST_BUCKET_SECOND,
+        **labels,
+    ) -> None:
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            histogram = self._dict_histogram.get(key)
+            if histogram is None:
+                histogram = self._dict_histogram[key] = Histogram(list_bucket)
+            histogram.observe(value)
+        return None
+
+    def describe(self,
+        name: str,
+        help: str,
+    ) -> None:
+        self._dict_help[name] = help
+        return None
+
+    def register_collector(self,
+        collector: callable,
+    ) -> None:
+        # A collector returns [(name, labels, value)] gauges read at scrape time,
+        # so stats a component already keeps aren't counted twice.
+        self._list_collector.append(collector)
+        return None
+
+    def _collect(self) -> tuple:
+        with self._lock:
+            dict_counter = dict(self._dict_counter)
+            dict_gauge = dict(self._dict_gauge)
+            dict_histogram = {
+                key: (histogram.list_bucket, list(histogram.list_count), histogram.sum, histogram.count)
+                for key, histogram in self._dict_histogram.items()
+            }
+            for imported_counter, imported_gauge, imported_histogram in self._dict_imported.values():
+                dict_counter.update(imported_counter)
+                dict_gauge.update(imported_gauge)
+                dict_histogram.update(imported_histogram)
+        for collector in self._list_collector:
+            try:
+                for name, labels, value in collector():
+                    dict_gauge[(name, tuple(sorted(labels.items())))] = value
+            except Exception as e:
+                logging.error(f"Metrics collector {collector} failed: {e}")
+        return dict_counter, dict_gauge, dict_histogram
+
+    def snapshot(self) -> dict:
+        # Everything this registry exports, in a JSON serializable form
+        dict_counter, dict_gauge, dict_histogram = self._collect()
+        return {
+            'counter': [[name, list(labels), value] for (name, labels), value in dict_counter.items()],
+            'gauge': [[name, list(labels), value] for (name, labels), value in dict_gauge.items()],
+            'histogram': [[name, list(labels), *value] for (name, labels), value in dict_histogram.items()],
+        }
+
+    def set_imported(self,
+        source: str,
+        snapshot: dict,
+        **labels,
+    ) -> None:
+        # Metrics of another process (a shard worker), exported with its labels
+        # added and replaced by each newer snapshot from the same source.
+        def get_key(name: str, list_label: list) -> tuple:
+            return (name, tuple(sorted({**{key: value for key, value in list_label}, **labels}.items())))
+
+        imported = (
+            {get_key(name, list_label): value for name, list_label, value in snapshot['counter']},
+            {get_key(name, list_label): value for name, list_label, value in snapshot['gauge']},
+            {get_key(name, list_label): tuple(value) for name, list_label, *value in snapshot['histogram']},
+        )
+        with self._lock:
+            self._dict_imported[source] = imported
+        return None
+
+    def render_prometheus(self) -> str:
+
+        def format_labels(labels: tuple, extra: tuple = ()) -> str:
+            labels = labels + extra
+            if not labels:
+                return ""
+            return "{" + ",".join(f'{key}="{_escape_label(value)}"' for key, value in labels) + "}"
+
+        dict_counter, dict_gauge, dict_histogram = self._collect()
+
+        list_line = []
+        for type, dict_metric in (("counter", dict_counter), ("gauge", dict_gauge), ("histogram", dict_histogram)):
+            list_name = []
+            for name, _ in sorted(dict_metric):
+                if name not in list_name:
+                    list_name.append(name)
+            for name in list_name:
+                if name in self._dict_help:
+                    list_line.append(f"# HELP {name} {self._dict_help[name]}")
+                list_line.append(f"# TYPE {name} {type}")
+                for (metric_name, labels), value in sorted(dict_metric.items()):
+                    if metric_name != name:
+                        continue
+                    if type != "histogram":
+                        list_line.append(f"{name}{format_labels(labels)} {value}")
+                        continue
+                    list_bucket, list_count, total, count = value
+                    cumulative = 0
+                    for bucket, bucket_count in zip(list_bucket + [float("inf")], list_count):
+                        cumulative += bucket_count
+                        le = "+Inf" if bucket == float("inf") else repr(bucket)
+                        list_line.append(f"{name}_bucket{format_labels(labels, (('le', le),))} {cumulative}")
+                    list_line.append(f"{name}_sum{format_labels(labels)} {total}")
+                    list_line.append(f"{name}_count{format_labels(labels)} {count}")
+
+        return "\n".join(list_line) + "\n"
+
+    def to_batch(self) -> points.PointBatch:
+
+        dict_counter, dict_gauge, dict_histogram = self._collect()
+
+        time_ns = points.now_ns()
+        batch = points.PointBatch()
+        for dict_metric in (dict_counter, dict_gauge):
+            for (name, labels), value in dict_metric.items():
+                batch.append(INFLUXDB_MEASUREMENT, points.tag_set({'metric': name, **dict(labels)}), float(value), time_ns)
+        for (name, labels), (_, _, total, count) in dict_histogram.items():
+            batch.append(INFLUXDB_MEASUREMENT, points.tag_set({'metric': f"{name}_sum", **dict(labels)}), float(total), time_ns)
+            batch.append(INFLUXDB_MEASUREMENT, points.tag_set({'metric': f"{name}_count", **dict(labels)}), float(count), time_ns)
+
+        return batch
+
+REGISTRY = Registry()
+
+REGISTRY.describe("source_request_duration_seconds", "Duration of one request to a source, per source and device")
+REGISTRY.describe("source_requests_total", "Requests to a source by result, per source and device")
+REGISTRY.describe("scheduler_lag_seconds", "Delay between a job deadline and its submission")
+REGISTRY.describe("scheduler_job_duration_seconds", "Duration of one scheduled job run")
+REGISTRY.describe("scheduler_job_points", "Points produced by one scheduled job run")
+REGISTRY.describe("scheduler_skipped_total", "Job slots skipped, by reason")
+REGISTRY.describe("writer_flush_duration_seconds", "Duration of one batch writer flush")
+REGISTRY.describe("writer_flush_points", "Points per batch writer flush")
+REGISTRY.describe("influxdb_write_duration_seconds", "Duration of one InfluxDB write request")
+REGISTRY.describe("influxdb_writes_total", "InfluxDB write requests by result")
+
+def observe_request(
+    source: str,
+    device: str,
+    start: float,
+    success: bool,
+) -> None:
+    REGISTRY.observe("source_request_duration_seconds", time.perf_counter() - start, source=source, device=device)
+    REGISTRY.inc("source_requests_total", source=source, device=device, result="success" if success else "error")
+    return None
+
+class _MetricsRequestHandler(BaseHTTPRequestHandler):
+
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self) -> None:
+        if self.path.split("?")[0] == "/metrics":
+            status = 200
+            body = self.server.registry.render_prometheus().encode()
+        else:
+            status = 404
+            body = b"Use /metrics\n"
+        self.send_response(status)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+        return None
+
+    def log_message(self, format, *args) -> None:
+        logging.debug(f"Metrics endpoint | {self.address_string()} | {format % args}")
+
+class MetricsServer:
+
+    def __init__(self,
+        registry: Registry = REGISTRY,
+        host: str = "127.0.0.1",
+        port: int = 9108,
+    ) -> None:
+
+        logging.info(f"Initializing {self.__class__.__name__} class...")
+
+        self.server = ThreadingHTTPServer((host, port), _MetricsRequestHandler)
+        self.server.daemon_threads = True
+        self.server.registry = registry
+        self._thread = None
+
+        return None
+
+    def start(self) -> None:
+        self._thread = threading.Thread(target=self.server.serve_forever, name="metrics-server", daemon=True)
+        self._thread.start()
+        logging.info(f"Metrics endpoint listening on http://{self.server.server_address[0]}:{self.server.server_address[1]}/metrics")
+        return None
+
+    def stop(self) -> None:
+        self.server.shutdown()
+        self.server.server_close()
+        return None
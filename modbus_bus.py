@@ -0,0 +1,195 @@
+import logging
+import threading
+import time
+
+import device_map
+import metrics
+import modbus_device
+import points
+
+# Serial settings of a bus whose device maps don't give any
+DEFAULT_BAUDRATE = 19200
+DEFAULT_PARITY = 'E'
+
+class ModbusRtuBus:
+
+    def __init__(self,
+        port: str,
+        baudrate: int = None,
+        parity: str = None,
+        timeout_second: float = 0.1,
+        cycle_budget_second: float = 0.9,
+        backoff_initial_second: float = 2.0,
+        backoff_max_second: float = 300.0,
+    ) -> None:
+
+        logging.info(f"Initializing {self.__class__.__name__} class...")
+
+        # Slaves on one port share its serial settings. Left as None they are
+        # taken from the first device map that gives them, every other device
+        # map must agree.
+        self.port = port
+        self.baudrate = baudrate
+        self.parity = parity
+        self.timeout_second = timeout_second
+        self.cycle_budget_second = cycle_budget_second
+        self.backoff_initial_second = backoff_initial_second
+        self.backoff_max_second = backoff_max_second
+
+        self.list_device = []
+
+        self._lock = threading.Lock()
+        self._start = time.monotonic()
+        self._busy_second = 0.0
+        self._cycles = 0
+        self._deferred = 0
+
+        return None
+
+    def add_device(self,
+        slave_address: int,
+        location: str,
+        device_map_path: str = "f4n200.json",
+        interval_second: float = 1.0,
+        instrument: "minimalmodbus.Instrument" = None,
+    ) -> modbus_device.ModbusRtuF4N200:
+
+        dict_device_map = device_map.load_device_map(device_map_path)
+        for key in ('baudrate', 'parity'):
+            value = dict_device_map.get(key)
+            if value is None:
+                continue
+            if getattr(self, key) is None:
+                setattr(self, key, value)
+            assert getattr(self, key) == value, f"Device map {device_map_path} of slave {slave_address} needs {key} {value}, bus {self.port} runs at {getattr(self, key)}"
+        if self.baudrate is None:
+            self.baudrate = DEFAULT_BAUDRATE
+        if self.parity is None:
+            self.parity = DEFAULT_PARITY
+
+        if instrument is None:
+            import minimalmodbus
+            # All instruments on a port share minimalmodbus' serial object, which
+            # also enforces the minimum 3.5 character silent interval between frames.
+            instrument = minimalmodbus.Instrument(self.port, slave_address, mode=minimalmodbus.MODE_RTU, close_port_after_each_call=False)
+            instrument.serial.baudrate = self.baudrate
+            instrument.serial.parity = self.parity
+            instrument.serial.timeout = self.timeout_second
+
+        device = modbus_device.ModbusRtuF4N200(
+            self.port,
+            instrument=instrument,
+            device_map_path=device_map_path,
+            slave_address=slave_address,
+            location=location,
+        )
+
+        self.list_device.append({
+            'device': device,
+            'slave_address': slave_address,
+            'interval_second': interval_second,
+            'next_due': time.monotonic(),
+            'cost_second': 0.0,
+            'backoff_second': 0.0,
+            'polls': 0,
+            'failures': 0,
+        })
+
+        logging.info(f"Slave {slave_address} ({device.decode_plan.model}, {location}) added to bus {self.port}, polled every {interval_second} s")
+
+        return device
+
+    def poll(self) -> points.PointBatch:
+
+        # Devices are polled most overdue first until the cycle budget is used up,
+        # the ones that don't fit stay due and go first in the next cycle.
+        cycle_start = time.monotonic()
+        cycle_deadline = cycle_start + self.cycle_budget_second
+
+        batch = points.PointBatch()
+        list_due = sorted(
+            (slave for slave in self.list_device if slave['next_due'] <= cycle_start),
+            key=lambda slave: slave['next_due'],
+        )
+
+        deferred = 0
+        busy_second = 0.0
+        for slave in list_due:
+            if time.monotonic() + slave['cost_second'] > cycle_deadline:
+                deferred += 1
+                continue
+
+            time_ns = points.now_ns()
+            start = time.monotonic()
+            list_value = slave['device'].read_all_data(abort_on_error=True)
+            elapsed = time.monotonic() - start
+            busy_second += elapsed
+            slave['polls'] += 1
+
+            if all(value is None for value in list_value):
+                slave['failures'] += 1
+                slave['backoff_second'] = min(max(slave['backoff_second'] * 2, self.backoff_initial_second), self.backoff_max_second)
+                slave['next_due'] = start + slave['backoff_second']
+                if slave['backoff_second'] == self.backoff_initial_second:
+                    logging.warning(f"Slave {slave['slave_address']} on {self.port} not responding, backing off")
+                continue
+
+            if slave['backoff_second']:
+                logging.info(f"Slave {slave['slave_address']} on {self.port} responding again")
+            slave['backoff_second'] = 0.0
+            # Exponential moving average of the slave cycle time, used for budgeting
+            slave['cost_second'] = elapsed if not slave['cost_second'] else 0.8 * slave['cost_second'] + 0.2 * elapsed
+
+            slave['next_due'] += slave['interval_second']
+            if slave['next_due'] <= start:
+                slave['next_due'] = start + slave['interval_second']
+
+            slave['device'].decode_plan.execute(list_value, time_ns, batch)
+
+        with self._lock:
+            self._busy_second += busy_second
+            self._cycles += 1
+            self._deferred += deferred
+
+        if deferred:
+            metrics.REGISTRY.inc("modbus_bus_deferred_total", deferred, port=self.port)
+            logging.debug(f"Bus {self.port} cycle budget used up, {deferred} slave(s) deferred")
+
+        return batch
+
+    def get_stats(self) -> dict:
+
+        with self._lock:
+            elapsed = time.monotonic() - self._start
+            dict_stats = {
+                'utilization': self._busy_second / elapsed if elapsed > 0 else 0.0,
+                'busy_second': self._busy_second,
+                'cycles': self._cycles,
+                'deferred': self._deferred,
+            }
+
+        dict_stats['slaves'] = {
+            slave['slave_address']: {
+                'polls': slave['polls'],
+                'failures': slave['failures'],
+                'backoff_second': slave['backoff_second'],
+                'cost_second': slave['cost_second'],
+            }
+            for slave in self.list_device
+        }
+
+        return dict_stats
+
+    def collect_metrics(self) -> list:
+
+        dict_stats = self.get_stats()
+
+        list_metric = [
+            ("modbus_bus_utilization", {'port': self.port}, dict_stats['utilization']),
+            ("modbus_bus_cycles", {'port': self.port}, dict_stats['cycles']),
+        ]
+        for slave_address, dict_slave in dict_stats['slaves'].items():
+            for key, value in dict_slave.items():
+                list_metric.append((f"modbus_slave_{key}", {'port': self.port, 'slave': slave_address}, value))
+
+        return list_metric
@@ -0,0 +1,130 @@
+import logging
+import time
+
+import device_map
+import metrics
+import points
+
+class ModbusRtuF4N200:
+    
+    def __init__(self,
+        port: str,
+        instrument: "minimalmodbus.Instrument" = None,
+        device_map_path: str = "f4n200.json",
+        slave_address: int = None,
+        location: str = "Laboratory",
+    ) -> None:
+              
+        logging.info(f"Initializing {self.__class__.__name__} class...")
+        
+        dict_device_map = device_map.load_device_map(device_map_path)
+        
+        if slave_address is None:
+            slave_address = getattr(instrument, 'address', dict_device_map.get('slave_address', 1))
+        if instrument is None:
+            import minimalmodbus
+            instrument = minimalmodbus.Instrument(port, slave_address, mode=minimalmodbus.MODE_RTU)
+            instrument.serial.baudrate = dict_device_map.get('baudrate', 19200)
+            instrument.serial.parity = dict_device_map.get('parity', 'E')
+        self.instrument = instrument
+        self.port = port
+        self.slave_address = slave_address
+        
+        self.location = location
+        
+        self.dict_modbus_data = dict_device_map['registers']
+        self.decode_plan = device_map.DecodePlan(dict_device_map, {'location': self.location})
+        self.list_block_read = self.decode_plan.list_block_read
+        self.dict_tag_set = {
+            measurement: points.tag_set({'location': self.location, **data.get('tags', {})})
+            for measurement, data in self.dict_modbus_data.items()
+        }
+        
+        logging.info(f"Register map of {self.decode_plan.model} planned into {len(self.list_block_read)} block reads: {[(block['start_address'], block['number_of_registers']) for block in self.list_block_read]}")
+        
+        return None
+    
+    def read_all_data(self,
+        abort_on_error: bool = False,
+    ) -> list:
+        
+        list_list_word = []
+        for block in self.list_block_read:
+            if abort_on_error and list_list_word and list_list_word[-1] is None:
+                list_list_word.append(None)
+                continue
+            
+            # Slaves on one bus share port and register map, the address tells them apart
+            endpoint = f"{self.port}:{self.slave_address}:{block['start_address']}"
+            start = time.perf_counter()
+            try:
+                list_list_word.append(self.instrument.read_registers(block['start_address'], block['number_of_registers']))
+                metrics.observe_request("modbusrtuf4n200", endpoint, start, True)
+            except Exception as e:
+                list_list_word.append(None)
+                metrics.observe_request("modbusrtuf4n200", endpoint, start, False)
+                logging.error(f"Coudn't read block of {block['number_of_registers']} registers at {block['start_address']}: {e}")
+                
+        return self.decode_plan.decode(list_list_word)
+    
+    def add_point(self,
+        batch: points.PointBatch,
+        measurement: str,
+        value: float,
+        time_ns: int,
+    ) -> None:
+        
+        batch.append(
+            self.dict_modbus_data[measurement].get('measurement', measurement),
+            self.dict_tag_set[measurement],
+            float(value),
+            time_ns,
+        )
+        
+        return None
+    
+    def read_data(self,
+        type: str,
+        register_address: int,
+        scale: float = 1.0,
+        signed: bool = True,
+    ) -> float:
+        
+        if type == 'long':
+            data = self.instrument.read_long(register_address) * scale
+        elif type == 'register':
+            data = self.instrument.read_register(register_address, signed=signed) * scale
+        else:
+            logging.error(f"Type {type} not recognized")
+            return None
+        
+        logging.debug(f"Register {register_address} | Type {type} | Scale {scale} | Signed {signed} | Data = {data}")
+        return data
+    
+    def get_point_influxdb(self,
+        measurement: str = None
+    ) -> points.PointBatch:
+        
+        assert measurement in self.dict_modbus_data.keys(), f"Measurement {measurement} not recognized among {self.dict_modbus_data.keys()}"
+        
+        type = self.dict_modbus_data[measurement]['type']
+        register_address = self.dict_modbus_data[measurement]['register_address']
+        scale = self.dict_modbus_data[measurement].get('scale', 1.0)
+        signed = self.dict_modbus_data[measurement].get('signed', False)
+            
+        data = self.read_data(type, register_address, scale, signed)
+        
+        if data is not None:
+            batch = points.PointBatch()
+            self.add_point(batch, measurement, data, points.now_ns())
+            return batch
+        else:
+            logging.error(f"Coudn't get data for register {register_address}")
+            return None
+        
+    def get_all_points_influxdb(self) -> points.PointBatch:
+        
+        time_ns = points.now_ns()
+        list_value = self.read_all_data()
+        
+        return self.decode_plan.execute(list_value, time_ns, points.PointBatch())
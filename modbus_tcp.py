@@ -0,0 +1,342 @@
+import logging
+import socket
+import struct
+import threading
+import time
+from concurrent.futures import Future, InvalidStateError, TimeoutError
+
+import metrics
+import modbus_device
+import points
+
+MBAP_HEADER = struct.Struct(">HHHB")
+READ_REQUEST = struct.Struct(">BHH")
+
+class ModbusTcpError(IOError):
+    pass
+
+def _settle(
+    future: Future,
+    result: object = None,
+    exception: BaseException = None,
+) -> None:
+    # The reader, a timed out caller and a disconnect can all race to settle
+    # the same future, whoever comes second is ignored
+    try:
+        if exception is not None:
+            future.set_exception(exception)
+        else:
+            future.set_result(result)
+    except InvalidStateError:
+        pass
+    return None
+
+class ModbusTcpGateway:
+
+    def __init__(self,
+        host: str,
+        port: int = 502,
+        max_outstanding: int = 8,
+        timeout_second: float = 1.0,
+        reconnect_initial_second: float = 1.0,
+        reconnect_max_second: float = 60.0,
+    ) -> None:
+
+        logging.info(f"Initializing {self.__class__.__name__} class...")
+
+        self.host = host
+        self.port = port
+        self.max_outstanding = max_outstanding
+        self.timeout_second = timeout_second
+        self.reconnect_initial_second = reconnect_initial_second
+        self.reconnect_max_second = reconnect_max_second
+
+        self._lock = threading.Lock()
+        self._semaphore = threading.BoundedSemaphore(max_outstanding)
+        self._socket = None
+        self._reader = None
+        self._dict_pending = {}
+        self._transaction_id = 0
+        self._reconnect_second = 0.0
+        self._reconnect_at = 0.0
+
+        return None
+
+    def _connect(self) -> socket.socket:
+
+        # Called with the lock held
+        if self._socket is not None:
+            return self._socket
+
+        if time.monotonic() < self._reconnect_at:
+            raise ModbusTcpError(f"Gateway {self.host}:{self.port} unreachable, next reconnect in {self._reconnect_at - time.monotonic():.1f} s")
+
+        try:
+            sock = socket.create_connection((self.host, self.port), timeout=self.timeout_second)
+        except OSError as e:
+            self._reconnect_second = min(max(self._reconnect_second * 2, self.reconnect_initial_second), self.reconnect_max_second)
+            self._reconnect_at = time.monotonic() + self._reconnect_second
+            raise ModbusTcpError(f"Couldn't connect to gateway {self.host}:{self.port}: {e}")
+
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        sock.settimeout(None)
+        self._socket = sock
+        self._reconnect_second = 0.0
+        self._reader = threading.Thread(target=self._read_loop, args=(sock,), name=f"modbus-tcp-{self.host}", daemon=True)
+        self._reader.start()
+        logging.info(f"Connected to Modbus TCP gateway {self.host}:{self.port}")
+
+        return sock
+
+    def _disconnect(self,
+        sock: socket.socket,
+        reason: str,
+    ) -> None:
+
+        with self._lock:
+            if self._socket is not sock:
+                return None
+            self._socket = None
+            dict_pending = self._dict_pending
+            self._dict_pending = {}
+
+        try:
+            sock.close()
+        except OSError:
+            pass
+
+        logging.warning(f"Connection to Modbus TCP gateway {self.host}:{self.port} lost: {reason}")
+        for future, _ in dict_pending.values():
+            _settle(future, exception=ModbusTcpError(f"Connection lost: {reason}"))
+
+        return None
+
+    def _read_exactly(self,
+        sock: socket.socket,
+        size: int,
+    ) -> bytes:
+        data = b""
+        while len(data) < size:
+            chunk = sock.recv(size - len(data))
+            if not chunk:
+                raise ConnectionError("closed by gateway")
+            data += chunk
+        return data
+
+    def _read_loop(self,
+        sock: socket.socket,
+    ) -> None:
+
+        # Responses may arrive in any order, they are matched by transaction id
+        # and must then answer the request: same unit, function and length
+        future = None
+        try:
+            while True:
+                transaction_id, _, length, unit_id = MBAP_HEADER.unpack(self._read_exactly(sock, MBAP_HEADER.size))
+                pdu = self._read_exactly(sock, length - 1)
+
+                with self._lock:
+                    future, request = self._dict_pending.pop(transaction_id, (None, None))
+                if future is None or future.done():
+                    continue
+
+                request_unit_id, function_code, number_of_registers = request
+                if unit_id != request_unit_id:
+                    error = f"answer from unit {unit_id} to a request to unit {request_unit_id}"
+                elif pdu[0] == function_code | 0x80:
+                    _settle(future, exception=ModbusTcpError(f"Modbus exception code {pdu[1]} for function {function_code}"))
+                    continue
+                elif pdu[0] != function_code:
+                    error = f"function {pdu[0]} in the answer to function {function_code}"
+                elif pdu[1] != 2 * number_of_registers or len(pdu) != 2 + pdu[1]:
+                    error = f"{len(pdu) - 2} bytes ({pdu[1]} announced) in the answer to a read of {number_of_registers} registers"
+                else:
+                    _settle(future, list(struct.unpack(f">{number_of_registers}H", pdu[2:])))
+                    continue
+                # The MBAP length keeps the stream in step, only this request fails
+                metrics.REGISTRY.inc("modbus_tcp_responses_rejected_total", gateway=f"{self.host}:{self.port}")
+                _settle(future, exception=ModbusTcpError(f"Mismatched response from {self.host}:{self.port}: {error}"))
+        except Exception as e:
+            # A malformed frame (e.g. an empty PDU) leaves the stream out of
+            # step, so any error drops the connection and fails what's pending
+            reason = f"{e.__class__.__name__}: {e}"
+            if future is not None:
+                _settle(future, exception=ModbusTcpError(f"Malformed response: {reason}"))
+            self._disconnect(sock, reason)
+
+        return None
+
+    def read_registers_async(self,
+        unit_id: int,
+        register_address: int,
+        number_of_registers: int,
+        function_code: int = 3,
+    ) -> Future:
+
+        # At most max_outstanding requests are in flight per gateway
+        if not self._semaphore.acquire(timeout=self.timeout_second):
+            raise ModbusTcpError(f"Gateway {self.host}:{self.port} has {self.max_outstanding} requests outstanding")
+
+        future = Future()
+        future.add_done_callback(lambda _: self._semaphore.release())
+
+        try:
+            with self._lock:
+                sock = self._connect()
+                self._transaction_id = (self._transaction_id + 1) & 0xFFFF
+                transaction_id = self._transaction_id
+                self._dict_pending[transaction_id] = (future, (unit_id, function_code, number_of_registers))
+                pdu = READ_REQUEST.pack(function_code, register_address, number_of_registers)
+                sock.sendall(MBAP_HEADER.pack(transaction_id, 0, len(pdu) + 1, unit_id) + pdu)
+        except ModbusTcpError as e:
+            future.set_exception(e)
+        except OSError as e:
+            self._disconnect(sock, str(e))
+            _settle(future, exception=ModbusTcpError(str(e)))
+
+        return future
+
+    def read_registers(self,
+        unit_id: int,
+        register_address: int,
+        number_of_registers: int,
+        function_code: int = 3,
+    ) -> list:
+
+        future = self.read_registers_async(unit_id, register_address, number_of_registers, function_code)
+        try:
+            return future.result(timeout=self.timeout_second)
+        except TimeoutError:
+            self._expire(future)
+            raise ModbusTcpError(f"No answer from unit {unit_id} at {self.host}:{self.port} within {self.timeout_second} s")
+
+    def _expire(self,
+        future: Future,
+    ) -> None:
+        with self._lock:
+            for transaction_id, (pending, _) in list(self._dict_pending.items()):
+                if pending is future:
+                    del self._dict_pending[transaction_id]
+        _settle(future, exception=ModbusTcpError("Request timed out"))
+        return None
+
+    def close(self) -> None:
+        with self._lock:
+            sock = self._socket
+        if sock is not None:
+            self._disconnect(sock, "closed")
+        return None
+
+class ModbusTcpInstrument:
+
+    def __init__(self,
+        gateway: ModbusTcpGateway,
+        unit_id: int,
+    ) -> None:
+
+        # Same read interface as minimalmodbus.Instrument, so ModbusRtuF4N200
+        # and its device maps work unchanged behind a TCP gateway.
+        self.gateway = gateway
+        self.unit_id = unit_id
+
+        return None
+
+    def read_registers(self,
+        registeraddress: int,
+        number_of_registers: int,
+        functioncode: int = 3,
+    ) -> list:
+        return self.gateway.read_registers(self.unit_id, registeraddress, number_of_registers, functioncode)
+
+    def read_long(self,
+        registeraddress: int,
+        functioncode: int = 3,
+        signed: bool = False,
+        byteorder: int = 0,
+        number_of_registers: int = 2,
+    ) -> int:
+        list_word = self.read_registers(registeraddress, 2, functioncode)
+        value = (list_word[0] << 16) | list_word[1]
+        if signed and value >= 0x80000000:
+            value -= 0x100000000
+        return value
+
+    def read_register(self,
+        registeraddress: int,
+        number_of_decimals: int = 0,
+        functioncode: int = 3,
+        signed: bool = False,
+    ) -> int:
+        value = self.read_registers(registeraddress, 1, functioncode)[0]
+        if signed and value >= 0x8000:
+            value -= 0x10000
+        return value
+
+class ModbusTcpPanel:
+
+    def __init__(self,
+        gateway: ModbusTcpGateway,
+    ) -> None:
+
+        logging.info(f"Initializing {self.__class__.__name__} class...")
+
+        self.gateway = gateway
+        self.list_device = []
+
+        return None
+
+    def add_device(self,
+        unit_id: int,
+        location: str,
+        device_map_path: str = "f4n200.json",
+    ) -> modbus_device.ModbusRtuF4N200:
+
+        device = modbus_device.ModbusRtuF4N200(
+            f"{self.gateway.host}:{self.gateway.port}",
+            instrument=ModbusTcpInstrument(self.gateway, unit_id),
+            device_map_path=device_map_path,
+            slave_address=unit_id,
+            location=location,
+        )
+        self.list_device.append(device)
+
+        return device
+
+    def poll(self) -> points.PointBatch:
+
+        # Every block of every meter is requested up front, the gateway keeps up
+        # to max_outstanding of them in flight instead of one round trip each.
+        time_ns = points.now_ns()
+        start = time.perf_counter()
+
+        list_list_future = []
+        for device in self.list_device:
+            list_future = []
+            for block in device.list_block_read:
+                try:
+                    list_future.append(self.gateway.read_registers_async(device.instrument.unit_id, block['start_address'], block['number_of_registers']))
+                except ModbusTcpError as e:
+                    future = Future()
+                    future.set_exception(e)
+                    list_future.append(future)
+            list_list_future.append(list_future)
+
+        batch = points.PointBatch()
+        deadline = time.monotonic() + self.gateway.timeout_second
+        for device, list_future in zip(self.list_device, list_list_future):
+            list_list_word = []
+            error = None
+            for future in list_future:
+                try:
+                    list_list_word.append(future.result(timeout=max(deadline - time.monotonic(), 0.0)))
+                except Exception as e:
+                    self.gateway._expire(future)
+                    list_list_word.append(None)
+                    error = e
+            if error is not None:
+                logging.error(f"Couldn't read {list_list_word.count(None)} of {len(list_list_word)} blocks from unit {device.instrument.unit_id} at {device.port}: {str(error) or 'timed out'}")
+            device.decode_plan.execute(device.decode_plan.decode(list_list_word), time_ns, batch)
+
+        metrics.REGISTRY.observe("modbus_tcp_panel_poll_seconds", time.perf_counter() - start, gateway=f"{self.gateway.host}:{self.gateway.port}")
+
+        return batch
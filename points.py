@@ -0,0 +1,141 @@
+import datetime
+import time
+from array import array
+from math import isfinite
+
+_DICT_TAG_SET = {}
+_DICT_SERIES_KEY = {}
+
+def _escape_measurement(value: str) -> str:
+    return value.replace(",", "\\,").replace(" ", "\\ ")
+
+def _escape_tag(value: str) -> str:
+    return value.replace(",", "\\,").replace("=", "\\=").replace(" ", "\\ ")
+
+def tag_set(
+    tags: dict,
+) -> tuple:
+    # Tag sets are interned: equal tag sets are the same tuple object, sorted by
+    # key as line protocol expects, so they can be compared and hashed cheaply.
+    key = tuple(sorted((str(k), str(v)) for k, v in tags.items()))
+    return _DICT_TAG_SET.setdefault(key, key)
+
+def series_key(
+    measurement: str,
+    tag_set: tuple,
+) -> bytes:
+    key = (measurement, tag_set)
+    encoded = _DICT_SERIES_KEY.get(key)
+    if encoded is None:
+        encoded = "".join(
+            [_escape_measurement(measurement)]
+            + [f",{_escape_tag(k)}={_escape_tag(v)}" for k, v in tag_set if v != ""]
+            + [" value="]
+        ).encode()
+        _DICT_SERIES_KEY[key] = encoded
+    return encoded
+
+def now_ns() -> int:
+    return time.time_ns()
+
+class PointBatch:
+
+    __slots__ = ('measurements', 'tag_sets', 'values', 'times')
+
+    def __init__(self) -> None:
+        self.measurements = []
+        self.tag_sets = []
+        self.values = array('d')
+        self.times = array('q')
+
+    def __len__(self) -> int:
+        return len(self.values)
+
+    def __bool__(self) -> bool:
+        return len(self.values) > 0
+
+    def __iter__(self):
+        return zip(self.measurements, self.tag_sets, self.values, self.times)
+
+    def __repr__(self) -> str:
+        return f"{self.__class__.__name__}({len(self)} points)"
+
+    def append(self,
+        measurement: str,
+        tag_set: tuple,
+        value: float,
+        time_ns: int,
+    ) -> None:
+        self.measurements.append(measurement)
+        self.tag_sets.append(tag_set)
+        self.values.append(value)
+        self.times.append(time_ns)
+
+    def extend(self,
+        other: 'PointBatch',
+    ) -> None:
+        if other is None:
+            return None
+        self.measurements.extend(other.measurements)
+        self.tag_sets.extend(other.tag_sets)
+        self.values.extend(other.values)
+        self.times.extend(other.times)
+
+    def clear(self) -> None:
+        self.measurements.clear()
+        self.tag_sets.clear()
+        del self.values[:]
+        del self.times[:]
+
+    def encode(self,
+        buffer: bytearray = None,
+    ) -> bytearray:
+        # Line protocol, one "measurement,tags value=<float> <ns>" line per point.
+        # Pass the same buffer every cycle to reuse its allocation.
+        if buffer is None:
+            buffer = bytearray()
+        else:
+            del buffer[:]
+
+        for measurement, tag_set, value, time_ns in zip(self.measurements, self.tag_sets, self.values, self.times):
+            # InfluxDB rejects the whole request over one nan or inf field
+            if not isfinite(value):
+                continue
+            buffer += series_key(measurement, tag_set)
+            buffer += repr(value).encode()
+            buffer += b" %d\n" % time_ns
+
+        return buffer
+
+    def to_points(self) -> list:
+        return [
+            {
+                'measurement': measurement,
+                'tags': dict(tag_set),
+                'fields': {
+                    'value': value,
+                },
+                'time': datetime.datetime.fromtimestamp(time_ns / 1e9, tz=datetime.timezone.utc).isoformat(),
+            }
+            for measurement, tag_set, value, time_ns in self
+        ]
+
+    @classmethod
+    def from_points(cls,
+        list_point: list,
+    ) -> 'PointBatch':
+        batch = cls()
+        for point in list_point:
+            time_value = point.get('time')
+            if time_value is None:
+                time_ns = now_ns()
+            elif isinstance(time_value, int):
+                time_ns = time_value
+            else:
+                if isinstance(time_value, str):
+                    time_value = datetime.datetime.fromisoformat(time_value)
+                if time_value.tzinfo is None:
+                    time_value = time_value.replace(tzinfo=datetime.timezone.utc)
+                time_ns = int(time_value.timestamp() * 1e6) * 1000
+            batch.append(point['measurement'], tag_set(point.get('tags', {})), float(point['fields']['value']), time_ns)
+        return batch
@@ -0,0 +1,136 @@
+import json
+import logging
+import os
+import threading
+import time
+
+import metrics
+
+NOT_MODIFIED = object()
+
+class ResponseCache:
+
+    def __init__(self,
+        name: str,
+        snapshot_path: str = None,
+        max_stale_second: float = 0.0,
+        wait_timeout_second: float = 10.0,
+    ) -> None:
+
+        logging.info(f"Initializing {self.__class__.__name__} class...")
+
+        # Entries carry wall clock fetch times, so a snapshot loaded after a
+        # restart still knows how old each response is.
+        self.name = name
+        self.snapshot_path = snapshot_path
+        self.max_stale_second = max_stale_second
+        self.wait_timeout_second = wait_timeout_second
+
+        self._lock = threading.Lock()
+        self._dict_entry = {}
+        self._dict_inflight = {}
+
+        if snapshot_path is not None:
+            self.load_snapshot()
+
+        return None
+
+    def get(self,
+        key: str,
+        fetch: callable,
+        ttl_second: float,
+    ) -> object:
+
+        # fetch(validator) returns (value, validator), NOT_MODIFIED when the
+        # upstream confirms the cached value, or None when it fails.
+        with self._lock:
+            entry = self._dict_entry.get(key)
+            if entry is not None and time.time() - entry['fetched_at'] < ttl_second:
+                metrics.REGISTRY.inc("response_cache_requests_total", cache=self.name, result="hit")
+                return entry['value']
+
+            # Concurrent callers for the same key wait for the one fetch in flight
+            event = self._dict_inflight.get(key)
+            if event is None:
+                event = threading.Event()
+                self._dict_inflight[key] = event
+                owner = True
+            else:
+                owner = False
+
+        if not owner:
+            # A hung fetch holds its waiters at most wait_timeout_second, they
+            # then fall back to what is cached, stale within max_stale_second
+            shared = event.wait(timeout=self.wait_timeout_second)
+            metrics.REGISTRY.inc("response_cache_requests_total", cache=self.name, result="shared" if shared else "wait_timeout")
+            with self._lock:
+                entry = self._dict_entry.get(key)
+            return entry['value'] if entry is not None and time.time() - entry['fetched_at'] < max(ttl_second, self.max_stale_second) else None
+
+        # Ages count from when the fetch started, a poll one TTL after the
+        # previous one then refetches however long the upstream took to answer
+        fetched_at = time.time()
+        try:
+            result = fetch(entry['validator'] if entry is not None else None)
+        except Exception as e:
+            logging.error(f"Fetch of {key} for cache {self.name} failed: {e}")
+            result = None
+
+        with self._lock:
+            if result is NOT_MODIFIED and entry is not None:
+                entry['fetched_at'] = fetched_at
+                outcome = "revalidated"
+            elif result is not None and result is not NOT_MODIFIED:
+                value, validator = result
+                entry = {'value': value, 'validator': validator, 'fetched_at': fetched_at}
+                self._dict_entry[key] = entry
+                outcome = "miss"
+            elif entry is not None and time.time() - entry['fetched_at'] < self.max_stale_second:
+                # Upstream failed, a stale value is still better than none
+                outcome = "stale"
+            else:
+                entry = None
+                outcome = "error"
+            del self._dict_inflight[key]
+        event.set()
+
+        metrics.REGISTRY.inc("response_cache_requests_total", cache=self.name, result=outcome)
+        if outcome in ("miss", "revalidated") and self.snapshot_path is not None:
+            self.save_snapshot()
+
+        return entry['value'] if entry is not None else None
+
+    def save_snapshot(self) -> None:
+
+        with self._lock:
+            data = json.dumps(self._dict_entry)
+
+        try:
+            os.makedirs(os.path.dirname(self.snapshot_path) or ".", exist_ok=True)
+            path_tmp = f"{self.snapshot_path}.tmp"
+            with open(path_tmp, "w") as file:
+                file.write(data)
+            os.replace(path_tmp, self.snapshot_path)
+        except OSError as e:
+            logging.error(f"Couldn't save cache {self.name} to {self.snapshot_path}: {e}")
+
+        return None
+
+    def load_snapshot(self) -> None:
+
+        if not os.path.exists(self.snapshot_path):
+            return None
+
+        try:
+            with open(self.snapshot_path) as file:
+                dict_entry = json.load(file)
+        except Exception as e:
+            logging.error(f"Couldn't load cache {self.name} from {self.snapshot_path}, starting empty: {e}")
+            return None
+
+        with self._lock:
+            self._dict_entry = dict_entry
+
+        logging.info(f"Cache {self.name} loaded {len(dict_entry)} entries from {self.snapshot_path}")
+
+        return None
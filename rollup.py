@@ -0,0 +1,235 @@
+import ast
+import logging
+import os
+import threading
+
+import numpy as np
+
+import points
+
+DICT_ROLLUP_INTERVAL_SECOND = {
+    "10s": 10,
+    "1m": 60,
+    "15m": 900,
+}
+
+LIST_STATISTIC = [
+    "min",
+    "max",
+    "mean",
+    "last",
+    "count",
+]
+
+class RollupAggregator:
+
+    def __init__(self,
+        dict_interval_second: dict = DICT_ROLLUP_INTERVAL_SECOND,
+        state_path: str = None,
+        capacity: int = 256,
+    ) -> None:
+
+        logging.info(f"Initializing {self.__class__.__name__} class...")
+
+        self.dict_interval_second = dict_interval_second
+        self.state_path = state_path
+
+        self._lock = threading.Lock()
+        self._dict_series_index = {}
+        self._list_series = []
+        self._capacity = 0
+        self._dict_state = {label: {} for label in dict_interval_second}
+        self._grow(capacity)
+
+        if self.state_path is not None and os.path.exists(self.state_path):
+            self.load_state()
+
+        return None
+
+    def _grow(self,
+        capacity: int,
+    ) -> None:
+
+        # One slot per series in flat arrays per interval, windows are aligned to
+        # the epoch so they are defined by sample timestamps, not by sample counts.
+        for label, dict_array in self._dict_state.items():
+            dict_new = {
+                'window_start': np.full(capacity, -1, dtype=np.int64),
+                'count': np.zeros(capacity, dtype=np.int64),
+                'sum': np.zeros(capacity, dtype=np.float64),
+                'min': np.full(capacity, np.inf, dtype=np.float64),
+                'max': np.full(capacity, -np.inf, dtype=np.float64),
+                'last': np.zeros(capacity, dtype=np.float64),
+                'last_time': np.zeros(capacity, dtype=np.int64),
+                # End of the last window closed, samples before it are too late
+                'closed_end': np.zeros(capacity, dtype=np.int64),
+            }
+            for key, array in dict_array.items():
+                dict_new[key][:self._capacity] = array[:self._capacity]
+            self._dict_state[label] = dict_new
+        self._capacity = capacity
+
+        return None
+
+    def _get_index(self,
+        measurement: str,
+        tag_set: tuple,
+    ) -> int:
+        key = (measurement, tag_set)
+        index = self._dict_series_index.get(key)
+        if index is None:
+            index = len(self._list_series)
+            if index >= self._capacity:
+                self._grow(self._capacity * 2)
+            self._dict_series_index[key] = index
+            self._list_series.append(key)
+        return index
+
+    def _close(self,
+        label: str,
+        array_index: np.ndarray,
+        output: points.PointBatch,
+    ) -> None:
+
+        state = self._dict_state[label]
+        array_index = array_index[state['count'][array_index] > 0]
+
+        for index, window_start, count, total, minimum, maximum, last in zip(
+            array_index.tolist(),
+            state['window_start'][array_index].tolist(),
+            state['count'][array_index].tolist(),
+            state['sum'][array_index].tolist(),
+            state['min'][array_index].tolist(),
+            state['max'][array_index].tolist(),
+            state['last'][array_index].tolist(),
+        ):
+            measurement, tag_set = self._list_series[index]
+            measurement = f"{measurement}_{label}"
+            # Rollup points are stamped with their window start
+            for statistic, value in zip(LIST_STATISTIC, (minimum, maximum, total / count, last, float(count))):
+                output.append(measurement, points.tag_set({**dict(tag_set), 'statistic': statistic}), value, window_start)
+
+        state['closed_end'][array_index] = state['window_start'][array_index] + self.dict_interval_second[label] * 1_000_000_000
+        state['window_start'][array_index] = -1
+        state['count'][array_index] = 0
+        state['sum'][array_index] = 0.0
+        state['min'][array_index] = np.inf
+        state['max'][array_index] = -np.inf
+
+        return None
+
+    def add(self,
+        batch: points.PointBatch,
+    ) -> points.PointBatch:
+
+        output = points.PointBatch()
+        if not batch:
+            return output
+
+        with self._lock:
+            array_index = np.fromiter(
+                (self._get_index(measurement, tag_set) for measurement, tag_set in zip(batch.measurements, batch.tag_sets)),
+                dtype=np.int64,
+                count=len(batch),
+            )
+            array_value = np.frombuffer(batch.values, dtype=np.float64)
+            array_time = np.frombuffer(batch.times, dtype=np.int64)
+
+            order = np.argsort(array_time, kind='stable')
+            array_index, array_value, array_time = array_index[order], array_value[order], array_time[order]
+
+            for label, interval_second in self.dict_interval_second.items():
+                state = self._dict_state[label]
+                interval_ns = interval_second * 1_000_000_000
+                array_window = array_time - array_time % interval_ns
+
+                for window_start in np.unique(array_window):
+                    mask = array_window == window_start
+                    index, value, time_ns = array_index[mask], array_value[mask], array_time[mask]
+
+                    # Close windows that are older than the incoming one (also after
+                    # gaps and restarts), then drop late samples of closed windows,
+                    # including those closed by flush(), so no window is written twice.
+                    current = state['window_start'][index]
+                    self._close(label, np.unique(index[(current >= 0) & (current < window_start)]), output)
+                    keep = (state['window_start'][index] <= window_start) & (state['closed_end'][index] <= window_start)
+                    index, value, time_ns = index[keep], value[keep], time_ns[keep]
+                    if not len(index):
+                        continue
+
+                    state['window_start'][index] = window_start
+                    np.add.at(state['count'], index, 1)
+                    np.add.at(state['sum'], index, value)
+                    np.minimum.at(state['min'], index, value)
+                    np.maximum.at(state['max'], index, value)
+
+                    # Last value per series is its last occurrence in time order
+                    unique_index, position = np.unique(index[::-1], return_index=True)
+                    position = len(index) - 1 - position
+                    state['last'][unique_index] = value[position]
+                    state['last_time'][unique_index] = time_ns[position]
+
+        return output
+
+    def flush(self,
+        time_ns: int = None,
+    ) -> points.PointBatch:
+
+        # Close windows that have ended, including those of series that stopped reporting
+        if time_ns is None:
+            time_ns = points.now_ns()
+
+        output = points.PointBatch()
+        with self._lock:
+            for label, interval_second in self.dict_interval_second.items():
+                state = self._dict_state[label]
+                window_start = state['window_start'][:len(self._list_series)]
+                array_index = np.flatnonzero((window_start >= 0) & (window_start + interval_second * 1_000_000_000 <= time_ns))
+                self._close(label, array_index, output)
+
+        return output
+
+    def save_state(self) -> None:
+
+        if self.state_path is None:
+            return None
+
+        with self._lock:
+            number_of_series = len(self._list_series)
+            dict_array = {
+                f"{label}-{key}": array[:number_of_series].copy()
+                for label, state in self._dict_state.items()
+                for key, array in state.items()
+            }
+            list_series = [repr(series) for series in self._list_series]
+
+        path_tmp = f"{self.state_path}.tmp.npz"
+        np.savez(path_tmp, series=np.array(list_series, dtype=str), **dict_array)
+        os.replace(path_tmp, self.state_path)
+
+        logging.debug(f"Rollup state of {number_of_series} series saved to {self.state_path}")
+
+        return None
+
+    def load_state(self) -> None:
+
+        try:
+            with np.load(self.state_path) as data:
+                list_series = [ast.literal_eval(series) for series in data['series'].tolist()]
+                dict_array = {key: data[key] for key in data.files if key != 'series'}
+        except Exception as e:
+            logging.error(f"Couldn't load rollup state from {self.state_path}, starting empty: {e}")
+            return None
+
+        with self._lock:
+            for measurement, tag_set in list_series:
+                self._get_index(measurement, points.tag_set(dict(tag_set)))
+            for label, state in self._dict_state.items():
+                for key, array in state.items():
+                    saved = dict_array.get(f"{label}-{key}")
+                    if saved is not None and len(saved) == len(list_series):
+                        array[:len(list_series)] = saved
+
+        logging.info(f"Rollup state of {len(list_series)} series loaded from {self.state_path}")
+
+        return None
@@ -0,0 +1,217 @@
+import collections.abc
+import heapq
+import logging
+import threading
+import time
+from array import array
+from concurrent.futures import ThreadPoolExecutor
+
+import metrics
+import points
+
+def align_batch(
+    batch: points.PointBatch,
+    start_ns: int,
+    end_ns: int,
+    slot_ns: int,
+    source: str,
+    diagnostics: bool = False,
+) -> None:
+
+    # Samples taken by this acquisition (stamped at or after its start) get the
+    # slot's timestamp, so sources polled in the same slot share it exactly.
+    list_time = [time_ns for time_ns in batch.times if time_ns >= start_ns]
+    if not list_time:
+        return None
+    batch.times = array('q', (slot_ns if time_ns >= start_ns else time_ns for time_ns in batch.times))
+
+    start_offset_second = (start_ns - slot_ns) / 1e9
+    duration_second = (end_ns - start_ns) / 1e9
+    skew_second = (max(list_time) - min(list_time)) / 1e9
+    metrics.REGISTRY.observe("acquisition_start_offset_seconds", start_offset_second, source=source)
+    metrics.REGISTRY.observe("acquisition_skew_seconds", skew_second, source=source)
+
+    if diagnostics:
+        tag_set = points.tag_set({'source': source})
+        batch.append("acquisition_start_offset", tag_set, start_offset_second, slot_ns)
+        batch.append("acquisition_duration", tag_set, duration_second, slot_ns)
+        batch.append("acquisition_skew", tag_set, skew_second, slot_ns)
+
+    return None
+
+class Scheduler:
+
+    def __init__(self,
+        max_workers: int = None,
+        resync_threshold_second: float = 0.1,
+    ) -> None:
+
+        logging.info(f"Initializing {self.__class__.__name__} class...")
+
+        self.max_workers = max_workers
+        self.resync_threshold_second = resync_threshold_second
+
+        # Aligned jobs run on a grid of wall clock multiples of their interval,
+        # triggered from the monotonic clock through this offset. It is only
+        # moved when the wall clock is stepped, not on every slot.
+        self._offset_ns = time.time_ns() - time.monotonic_ns()
+
+        self._heap = []
+        self._dict_job = {}
+        self._condition = threading.Condition()
+        self._stop = False
+        self._executor = None
+
+        return None
+
+    def add_job(self,
+        name: str,
+        function: callable,
+        interval_second: float,
+        callback: callable = None,
+        delay_second: float = 0.0,
+        align: bool = False,
+        diagnostics: bool = False,
+    ) -> None:
+
+        assert name not in self._dict_job, f"Job {name} already scheduled"
+        assert interval_second > 0, f"Interval of job {name} must be positive, got {interval_second}"
+
+        with self._condition:
+            deadline = time.monotonic() + delay_second
+            slot_ns = None
+            if align:
+                # First slot is the next whole multiple of the interval
+                interval_ns = round(interval_second * 1e9)
+                slot_ns = -(-(time.monotonic_ns() + self._offset_ns + round(delay_second * 1e9)) // interval_ns) * interval_ns
+                deadline = (slot_ns - self._offset_ns) / 1e9
+            self._dict_job[name] = {
+                'function': function,
+                'interval_second': interval_second,
+                'callback': callback,
+                'future': None,
+                'slot_ns': slot_ns,
+                'diagnostics': diagnostics,
+            }
+            heapq.heappush(self._heap, (deadline, name))
+            self._condition.notify()
+
+        return None
+
+    def _run_job(self,
+        name: str,
+        slot_ns: int = None,
+    ) -> None:
+
+        job = self._dict_job[name]
+        start = time.perf_counter()
+        start_ns = time.time_ns()
+        try:
+            result = job['function']()
+            metrics.REGISTRY.observe("scheduler_job_duration_seconds", time.perf_counter() - start, job=name)
+            if slot_ns is not None and isinstance(result, points.PointBatch):
+                align_batch(result, start_ns, time.time_ns(), slot_ns, name, job['diagnostics'])
+            if isinstance(result, collections.abc.Sized):
+                metrics.REGISTRY.observe("scheduler_job_points", len(result), metrics.LIST_BUCKET_POINT, job=name)
+            if job['callback'] is not None and result:
+                job['callback'](result)
+        except Exception as e:
+            metrics.REGISTRY.inc("scheduler_job_errors_total", job=name)
+            logging.error(f"Job {name} failed: {e}")
+
+        return None
+
+    def _resync(self) -> bool:
+
+        offset_ns = time.time_ns() - time.monotonic_ns()
+        if abs(offset_ns - self._offset_ns) <= self.resync_threshold_second * 1e9:
+            return False
+
+        logging.warning(f"Wall clock moved {(offset_ns - self._offset_ns) / 1e9:+.3f} s against the monotonic clock, re-anchoring the sampling grid")
+        self._offset_ns = offset_ns
+
+        # Queued aligned jobs move to their next slot after the new wall time,
+        # otherwise a backward step would hold them until the old slot came round
+        wall_ns = time.monotonic_ns() + self._offset_ns
+        list_heap = []
+        for deadline, name in self._heap:
+            job = self._dict_job[name]
+            if job['slot_ns'] is not None:
+                interval_ns = round(job['interval_second'] * 1e9)
+                job['slot_ns'] = (wall_ns // interval_ns + 1) * interval_ns
+                deadline = (job['slot_ns'] - self._offset_ns) / 1e9
+            list_heap.append((deadline, name))
+        heapq.heapify(list_heap)
+        self._heap = list_heap
+
+        return True
+
+    def run(self) -> None:
+
+        max_workers = self.max_workers or max(len(self._dict_job), 1)
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="scheduler")
+
+        logging.info(f"Scheduler started with {len(self._dict_job)} jobs on {max_workers} workers")
+
+        try:
+            while True:
+                with self._condition:
+                    while not self._stop:
+                        if self._heap:
+                            timeout = self._heap[0][0] - time.monotonic()
+                            if timeout <= 0:
+                                break
+                        else:
+                            timeout = None
+                        self._condition.wait(timeout)
+
+                    if self._stop:
+                        break
+
+                    deadline, name = heapq.heappop(self._heap)
+                    job = self._dict_job[name]
+
+                    # Next deadline is derived from the previous one, not from now, so the
+                    # schedule doesn't drift. Slots already missed are skipped, not queued.
+                    now = time.monotonic()
+                    missed = 0
+                    next_deadline = deadline + job['interval_second']
+                    if next_deadline <= now:
+                        missed = int((now - deadline) // job['interval_second'])
+                        next_deadline = deadline + (missed + 1) * job['interval_second']
+                        metrics.REGISTRY.inc("scheduler_skipped_total", missed, job=name, reason="behind_schedule")
+                        logging.warning(f"Job {name} is {now - deadline:.3f} s behind schedule, skipping {missed} slot(s)")
+
+                    # Aligned jobs step through their grid in integer nanoseconds
+                    slot_ns = job['slot_ns']
+                    if slot_ns is not None:
+                        interval_ns = round(job['interval_second'] * 1e9)
+                        if self._resync():
+                            # This run is stamped with the slot it falls in on the new grid
+                            slot_ns = (time.monotonic_ns() + self._offset_ns) // interval_ns * interval_ns
+                            job['slot_ns'] = slot_ns + interval_ns
+                        else:
+                            job['slot_ns'] = slot_ns + (missed + 1) * interval_ns
+                        next_deadline = (job['slot_ns'] - self._offset_ns) / 1e9
+                    heapq.heappush(self._heap, (next_deadline, name))
+
+                metrics.REGISTRY.observe("scheduler_lag_seconds", now - deadline, job=name)
+                if job['future'] is not None and not job['future'].done():
+                    metrics.REGISTRY.inc("scheduler_skipped_total", job=name, reason="still_running")
+                    logging.warning(f"Job {name} still running from previous slot, skipping")
+                    continue
+
+                job['future'] = self._executor.submit(self._run_job, name, slot_ns)
+        finally:
+            self._executor.shutdown(wait=True, cancel_futures=True)
+            logging.info("Scheduler stopped")
+
+        return None
+
+    def stop(self) -> None:
+
+        with self._condition:
+            self._stop = True
+            self._condition.notify()
+
+        return None
@@ -0,0 +1,383 @@
+import json
+import logging
+import multiprocessing
+import multiprocessing.connection
+import os
+import signal
+import struct
+import threading
+import time
+from array import array
+
+import metrics
+import points
+
+# Frame: number of new series, number of points, then the new series
+# definitions (length prefixed JSON, sent once per series and connection),
+# then series ids, values and timestamps as raw little-endian arrays.
+FRAME_HEADER = struct.Struct("<II")
+SERIES_HEADER = struct.Struct("<I")
+
+# A frame whose number of new series is this value carries the worker's
+# metrics snapshot as JSON instead of points.
+METRICS_FRAME_MARKER = 0xFFFFFFFF
+
+class BatchEncoder:
+
+    def __init__(self) -> None:
+        self._dict_series_id = {}
+
+    def encode(self,
+        batch: points.PointBatch,
+    ) -> bytes:
+
+        list_new = []
+        ids = array('I')
+        for measurement, tag_set in zip(batch.measurements, batch.tag_sets):
+            key = (measurement, tag_set)
+            series_id = self._dict_series_id.get(key)
+            if series_id is None:
+                series_id = len(self._dict_series_id)
+                self._dict_series_id[key] = series_id
+                list_new.append(json.dumps([measurement, tag_set]).encode())
+            ids.append(series_id)
+
+        values = batch.values
+        times = batch.times
+        if values.itemsize != 8 or times.itemsize != 8 or ids.itemsize != 4:
+            raise RuntimeError("Unexpected array item sizes on this platform")
+
+        list_part = [FRAME_HEADER.pack(len(list_new), len(batch))]
+        for series in list_new:
+            list_part.append(SERIES_HEADER.pack(len(series)))
+            list_part.append(series)
+        list_part.extend((ids.tobytes(), values.tobytes(), times.tobytes()))
+
+        return b"".join(list_part)
+
+class BatchDecoder:
+
+    def __init__(self) -> None:
+        self._list_series = []
+
+    def decode(self,
+        data: bytes,
+    ) -> points.PointBatch:
+
+        view = memoryview(data)
+        number_of_new_series, number_of_points = FRAME_HEADER.unpack_from(view, 0)
+        offset = FRAME_HEADER.size
+
+        for _ in range(number_of_new_series):
+            (size,) = SERIES_HEADER.unpack_from(view, offset)
+            offset += SERIES_HEADER.size
+            measurement, list_tag = json.loads(bytes(view[offset:offset + size]))
+            offset += size
+            # Tag sets are interned again on this side of the channel
+            self._list_series.append((measurement, points.tag_set(dict(list_tag))))
+
+        ids = array('I')
+        ids.frombytes(view[offset:offset + 4 * number_of_points])
+        offset += 4 * number_of_points
+
+        batch = points.PointBatch()
+        batch.values.frombytes(view[offset:offset + 8 * number_of_points])
+        offset += 8 * number_of_points
+        batch.times.frombytes(view[offset:offset + 8 * number_of_points])
+
+        list_series = self._list_series
+        for series_id in ids:
+            measurement, tag_set = list_series[series_id]
+            batch.measurements.append(measurement)
+            batch.tag_sets.append(tag_set)
+
+        return batch
+
+def _worker_main(
+    name: str,
+    target: callable,
+    args: tuple,
+    connection: multiprocessing.connection.Connection,
+    list_cpu: list,
+    metrics_interval_second: float,
+) -> None:
+
+    # Locks held by the parent's threads at fork time would never be released
+    # here, so the worker gets its own metrics registry.
+    metrics.REGISTRY = metrics.Registry()
+
+    if list_cpu:
+        try:
+            os.sched_setaffinity(0, list_cpu)
+        except (AttributeError, OSError) as e:
+            logging.warning(f"Couldn't pin worker {name} to CPUs {list_cpu}: {e}")
+
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+    encoder = BatchEncoder()
+    lock = threading.Lock()
+    parent_pid = os.getppid()
+
+    def exit_orphan(reason: str) -> None:
+        # Without the supervisor nothing reads the batches, a worker left behind
+        # by a killed parent must not keep polling the devices
+        logging.error(f"Worker {name} lost its supervisor ({reason}), exiting")
+        os._exit(1)
+
+    def send(batch: points.PointBatch) -> None:
+        if not batch:
+            return None
+        # The encoder's series table and the pipe are shared by the worker's
+        # threads, a frame must be sent before any frame using its new series.
+        try:
+            with lock:
+                connection.send_bytes(encoder.encode(batch))
+        except OSError as e:
+            exit_orphan(str(e))
+        return None
+
+    def send_metrics() -> None:
+        # Also the orphan check: the worker inherits the read end of its own
+        # pipe, so a dead parent doesn't always show up as a broken pipe
+        while True:
+            time.sleep(metrics_interval_second)
+            if os.getppid() != parent_pid:
+                exit_orphan(f"parent pid {parent_pid} gone")
+            data = FRAME_HEADER.pack(METRICS_FRAME_MARKER, 0) + json.dumps(metrics.REGISTRY.snapshot()).encode()
+            try:
+                with lock:
+                    connection.send_bytes(data)
+            except OSError as e:
+                exit_orphan(str(e))
+
+    threading.Thread(target=send_metrics, name="worker-metrics", daemon=True).start()
+
+    logging.info(f"Worker {name} started (pid {os.getpid()}{f', CPUs {list_cpu}' if list_cpu else ''})")
+    target(send, *args)
+
+    return None
+
+class ShardSupervisor:
+
+    def __init__(self,
+        callback: callable,
+        restart_backoff_initial_second: float = 1.0,
+        restart_backoff_max_second: float = 60.0,
+        stable_second: float = 60.0,
+        metrics_interval_second: float = 5.0,
+    ) -> None:
+
+        logging.info(f"Initializing {self.__class__.__name__} class...")
+
+        # callback receives every decoded batch in this process, which owns the
+        # writer, so its buffer survives any worker crashing.
+        self.callback = callback
+        self.restart_backoff_initial_second = restart_backoff_initial_second
+        self.restart_backoff_max_second = restart_backoff_max_second
+        self.stable_second = stable_second
+        self.metrics_interval_second = metrics_interval_second
+
+        # Workers are forked so they inherit the configuration without
+        # re-importing the entry point. The fork happens on the supervisor
+        # thread while others run: a worker starts a new metrics registry and
+        # the source registry re-creates its locks after fork.
+        self._context = multiprocessing.get_context("fork")
+        self._dict_worker = {}
+        self._stop = threading.Event()
+        self._thread = None
+
+        return None
+
+    def add_worker(self,
+        name: str,
+        target: callable,
+        args: tuple = (),
+        list_cpu: list = None,
+    ) -> None:
+
+        # target(send, *args) runs in the worker and calls send(batch) per batch
+        assert name not in self._dict_worker, f"Worker {name} already added"
+
+        self._dict_worker[name] = {
+            'target': target,
+            'args': args,
+            'list_cpu': list_cpu,
+            'process': None,
+            'connection': None,
+            'decoder': None,
+            'started_at': 0.0,
+            'restart_at': 0.0,
+            'backoff_second': 0.0,
+            'restarts': 0,
+            'batches': 0,
+            'points': 0,
+        }
+
+        return None
+
+    def _start_worker(self,
+        name: str,
+    ) -> None:
+
+        worker = self._dict_worker[name]
+        reader, writer = self._context.Pipe(duplex=False)
+        process = self._context.Process(
+            target=_worker_main,
+            args=(name, worker['target'], worker['args'], writer, worker['list_cpu'], self.metrics_interval_second),
+            name=f"worker-{name}",
+            daemon=True,
+        )
+        process.start()
+        writer.close()
+
+        # A new process has a new series table, so the decoder starts over too
+        worker['process'] = process
+        worker['connection'] = reader
+        worker['decoder'] = BatchDecoder()
+        worker['started_at'] = time.monotonic()
+
+        return None
+
+    def _handle_exit(self,
+        name: str,
+    ) -> None:
+
+        worker = self._dict_worker[name]
+        process = worker['process']
+        process.join()
+        if worker['connection'] is not None:
+            worker['connection'].close()
+        worker['process'] = None
+        worker['connection'] = None
+
+        if self._stop.is_set():
+            return None
+
+        # A worker that ran for stable_second before dying restarts right away,
+        # one that keeps crashing is restarted with exponential backoff.
+        if time.monotonic() - worker['started_at'] >= self.stable_second:
+            worker['backoff_second'] = 0.0
+        else:
+            worker['backoff_second'] = min(max(worker['backoff_second'] * 2, self.restart_backoff_initial_second), self.restart_backoff_max_second)
+        worker['restart_at'] = time.monotonic() + worker['backoff_second']
+        worker['restarts'] += 1
+
+        metrics.REGISTRY.inc("shard_worker_restarts_total", worker=name)
+        logging.error(f"Worker {name} exited with code {process.exitcode}, restarting in {worker['backoff_second']:.1f} s")
+
+        return None
+
+    def _receive(self,
+        name: str,
+    ) -> None:
+
+        worker = self._dict_worker[name]
+        try:
+            data = worker['connection'].recv_bytes()
+        except (EOFError, OSError):
+            # Pipe closed, the process sentinel reports the exit
+            worker['connection'].close()
+            worker['connection'] = None
+            return None
+
+        # A bad frame is dropped, it must not end the supervisor loop
+        try:
+            if FRAME_HEADER.unpack_from(data, 0)[0] == METRICS_FRAME_MARKER:
+                metrics.REGISTRY.set_imported(name, json.loads(data[FRAME_HEADER.size:]), worker=name)
+                return None
+            batch = worker['decoder'].decode(data)
+        except Exception as e:
+            metrics.REGISTRY.inc("shard_frames_dropped_total", worker=name)
+            logging.error(f"Couldn't decode frame of {len(data)} bytes from worker {name}, dropped: {e}")
+            return None
+
+        worker['batches'] += 1
+        worker['points'] += len(batch)
+
+        try:
+            self.callback(batch)
+        except Exception as e:
+            logging.error(f"Couldn't handle batch from worker {name}: {e}")
+
+        return None
+
+    def run(self) -> None:
+
+        for name in self._dict_worker:
+            self._start_worker(name)
+
+        while not self._stop.is_set():
+            now = time.monotonic()
+            timeout = 1.0
+            dict_wait = {}
+            for name, worker in self._dict_worker.items():
+                if worker['process'] is None:
+                    if now >= worker['restart_at']:
+                        self._start_worker(name)
+                    else:
+                        timeout = min(timeout, worker['restart_at'] - now)
+                        continue
+                if worker['connection'] is not None:
+                    dict_wait[worker['connection']] = (name, self._receive)
+                dict_wait[worker['process'].sentinel] = (name, None)
+
+            for ready in multiprocessing.connection.wait(list(dict_wait), timeout=timeout):
+                name, handler = dict_wait[ready]
+                if handler is not None:
+                    handler(name)
+
+            # Batches a worker sent before exiting are read before its exit is handled
+            for name, worker in self._dict_worker.items():
+                if worker['process'] is None or worker['process'].is_alive():
+                    continue
+                while worker['connection'] is not None and worker['connection'].poll():
+                    self._receive(name)
+                self._handle_exit(name)
+
+        return None
+
+    def start(self) -> None:
+        self._thread = threading.Thread(target=self.run, name="supervisor", daemon=True)
+        self._thread.start()
+        return None
+
+    def stop(self,
+        timeout_second: float = 5.0,
+    ) -> None:
+
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout_second)
+
+        for name, worker in self._dict_worker.items():
+            process = worker['process']
+            if process is None:
+                continue
+            process.terminate()
+            process.join(timeout_second)
+            if process.is_alive():
+                process.kill()
+                process.join()
+            if worker['connection'] is not None:
+                worker['connection'].close()
+            logging.info(f"Worker {name} stopped")
+
+        return None
+
+    def get_stats(self) -> dict:
+        return {
+            name: {
+                'alive': worker['process'] is not None and worker['process'].is_alive(),
+                'restarts': worker['restarts'],
+                'batches': worker['batches'],
+                'points': worker['points'],
+            }
+            for name, worker in self._dict_worker.items()
+        }
+
+    def collect_metrics(self) -> list:
+        list_metric = []
+        for name, dict_worker in self.get_stats().items():
+            for key, value in dict_worker.items():
+                list_metric.append((f"shard_worker_{key}", {'worker': name}, float(value)))
+        return list_metric
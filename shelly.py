@@ -1,10 +1,13 @@
 import classes
+import points
+import scheduler
+import sinks
+import spool
+import writer
 import os
 import logging
 from pprint import pformat
 import time
-from influxdb_client import InfluxDBClient
-from influxdb_client.client.write_api import SYNCHRONOUS
 
 FORMAT = '[%(levelname)s | %(asctime)-15s | %(filename)s | %(funcName)s | %(module)s] %(message)s'
 logging.basicConfig(level=logging.INFO, format=FORMAT)
@@ -25,37 +28,144 @@ DICT_SHELLY_LOCATION_ID = {
     "Wagner": "c45bbe78ad66"
 }
 
+# Shelly devices reachable on the LAN, as "<id>=<host>,<id>=<host>"
+DICT_SHELLY_ID_HOST = dict(
+    item.split("=", 1) for item in os.getenv("SHELLY-LOCAL_HOSTS", "").split(",") if item
+)
+
 obj_shelly = classes.Shelly3Em(
     url=os.getenv("SHELLY-URL"),
-    token=os.getenv("SHELLY-TOKEN")
+    token=os.getenv("SHELLY-TOKEN"),
+    dict_id_host=DICT_SHELLY_ID_HOST,
+    local_auth=(os.getenv("SHELLY-LOCAL_USERNAME"), os.getenv("SHELLY-LOCAL_PASSWORD")) if os.getenv("SHELLY-LOCAL_USERNAME") else None,
 )
 
-client_influxdb = InfluxDBClient(
-    url=os.getenv("INFLUXDB-URL"),
-    token=os.getenv("INFLUXDB-TOKEN"),
-    org=os.getenv("INFLUXDB-ORG")
-)
-write_api = client_influxdb.write_api(write_options=SYNCHRONOUS)
+# Created on the drainer's first write, off the path to the first sample
+client_influxdb = None
+write_api = None
+
+def get_write_api() -> object:
+    global client_influxdb, write_api
+    if write_api is None:
+        from influxdb_client import InfluxDBClient
+        from influxdb_client.client.write_api import SYNCHRONOUS
+        client_influxdb = InfluxDBClient(
+            url=os.getenv("INFLUXDB-URL"),
+            token=os.getenv("INFLUXDB-TOKEN"),
+            org=os.getenv("INFLUXDB-ORG"),
+            enable_gzip=os.getenv("INFLUXDB-GZIP", "true").lower() == "true",
+        )
+        write_api = client_influxdb.write_api(write_options=SYNCHRONOUS)
+    return write_api
+
+# Outputs every batch is written to, "influxdb", "parquet" and/or "sqlite"
+LIST_SINK = [sink for sink in os.getenv("SINKS", "influxdb").split(",") if sink]
+
+obj_spool = None
+if "influxdb" in LIST_SINK:
+    obj_spool = spool.Spool(
+        directory=os.getenv("SPOOL-DIRECTORY", os.path.join(os.getcwd(), "spool")),
+        max_total_bytes=int(os.getenv("SPOOL-MAX_BYTES", 1024 * 1024 * 1024)),
+    )
+
+def write_influxdb(data: bytes) -> None:
+    from influxdb_client import WritePrecision
+    res = get_write_api().write(bucket=os.getenv("INFLUXDB-BUCKET"), record=data, write_precision=WritePrecision.NS)
+    logging.info("Data written to InfluxDB")
+
+# Batches are coalesced by the writer and flushed to the spool by count, size
+# or age, the spool drainer then writes each flush to InfluxDB in one request.
+obj_batch_writer = None
+if obj_spool is not None:
+    obj_batch_writer = writer.BatchWriter(
+        write_function=obj_spool.append,
+        max_points=int(os.getenv("WRITER-MAX_POINTS", 5000)),
+        max_bytes=int(os.getenv("WRITER-MAX_BYTES", 1024 * 1024)),
+        max_age_second=float(os.getenv("WRITER-MAX_AGE_SECOND", 5.0)),
+        queue_full_policy=os.getenv("WRITER-QUEUE_FULL_POLICY", "spill"),
+        spill_function=obj_spool.append,
+    )
+
+dict_sink = {}
+if "parquet" in LIST_SINK:
+    dict_sink["parquet"] = sinks.ParquetSink(
+        directory=os.getenv("PARQUET-DIRECTORY", os.path.join(os.getcwd(), "parquet")),
+        rotation=os.getenv("PARQUET-ROTATION", "hour"),
+        compression=os.getenv("PARQUET-COMPRESSION", "zstd"),
+    )
+if "sqlite" in LIST_SINK:
+    dict_sink["sqlite"] = sinks.SqliteSink(
+        path=os.getenv("SQLITE-PATH", os.path.join(os.getcwd(), "data.sqlite")),
+    )
+obj_sink_fanout = None
+if dict_sink:
+    obj_sink_fanout = sinks.SinkFanout(
+        dict_sink,
+        max_points=int(os.getenv("SINKS-MAX_POINTS", 100_000)),
+        max_age_second=float(os.getenv("SINKS-MAX_AGE_SECOND", 60.0)),
+    )
+
+# Aligned acquisition polls on whole multiples of the interval and stamps the
+# samples with their slot, see main.py
+ACQUISITION_ALIGNED = os.getenv("ACQUISITION-ALIGNED", "false").lower() == "true"
+ACQUISITION_DIAGNOSTICS = os.getenv("ACQUISITION-DIAGNOSTICS", "false").lower() == "true"
+
+def get_points() -> points.PointBatch:
+    batch = points.PointBatch()
+    try:
+        point = obj_shelly.get_points_influxdb(DICT_SHELLY_LOCATION_ID)
+        batch.extend(point)
+        logging.debug(f"Point: {point}")
+    except Exception as e:
+        logging.error(f"Coulnd't get Shelly data: {e}")
+    return batch
+
+def put_batch(batch: points.PointBatch) -> None:
+    if logging.getLogger().isEnabledFor(logging.DEBUG):
+        logging.debug(f"List point: {pformat(batch.to_points())}")
+    
+    try:
+        if obj_batch_writer is not None:
+            obj_batch_writer.put(batch)
+        if obj_sink_fanout is not None:
+            obj_sink_fanout.put(batch)
+    except Exception as e:
+        logging.error(f"Couldn't queue data for writing: {e}")
 
 if __name__ == "__main__":
     logging.info("Starting main script...")
     
-    while True:
-        list_point = []
-        
-        try:
-            for location, id in DICT_SHELLY_LOCATION_ID.items():
-                point = obj_shelly.get_point_influxdb(id, location)
-                list_point.extend(point)
-                logging.debug(f"Point: {pformat(point)}")
-        except Exception as e:
-            logging.error(f"Coulnd't get Shelly data: {e}")
-            
-        if len(list_point) > 0:
-            logging.debug(f"List point: {pformat(list_point)}")
-            
-            try:
-                res = write_api.write(bucket=os.getenv("INFLUXDB-BUCKET"), record=list_point)
-                logging.info("Data written to InfluxDB")
-            except Exception as e:
-                logging.error(f"Couldn't write data to InfluxDB: {e}")
\ No newline at end of file
+    if obj_batch_writer is not None:
+        obj_spool_drainer = spool.SpoolDrainer(obj_spool, write_influxdb)
+        obj_spool_drainer.start()
+        obj_batch_writer.start()
+    if obj_sink_fanout is not None:
+        obj_sink_fanout.start()
+    
+    try:
+        if ACQUISITION_ALIGNED:
+            obj_scheduler = scheduler.Scheduler()
+            obj_scheduler.add_job("shelly", get_points, DATA_LOGGING_FREQUENCY_SECOND, callback=put_batch, align=True, diagnostics=ACQUISITION_DIAGNOSTICS)
+            obj_scheduler.run()
+        else:
+            while True:
+                start = time.monotonic()
+                batch = get_points()
+                if len(batch) > 0:
+                    put_batch(batch)
+                time.sleep(max(DATA_LOGGING_FREQUENCY_SECOND - (time.monotonic() - start), 0.0))
+    except KeyboardInterrupt:
+        logging.info("Stopping Shelly script...")
+    finally:
+        # Flush the writer into the spool and let the drainer send what it can
+        # before the spool is closed, so nothing buffered is lost on exit
+        if obj_batch_writer is not None:
+            obj_batch_writer.stop()
+            obj_spool_drainer.stop()
+            obj_spool.close()
+        # Parquet files only become readable once their footer is written
+        if obj_sink_fanout is not None:
+            obj_sink_fanout.stop()
+        if write_api is not None:
+            write_api.close()
+            client_influxdb.close()
@@ -0,0 +1,474 @@
+import datetime
+import logging
+import math
+import os
+import queue
+import sqlite3
+import threading
+import time
+from array import array
+
+import metrics
+import points
+
+DICT_ROTATION_SECOND = {
+    "hour": 3600,
+    "day": 86400,
+}
+
+DICT_ROTATION_FORMAT = {
+    "hour": "%Y%m%dT%H",
+    "day": "%Y%m%d",
+}
+
+# Tag keys stored as their own columns, any other tag goes to the tags column
+LIST_TAG_COLUMN = [
+    "location",
+    "phase",
+    "category",
+    "zone_code",
+]
+
+class Sink:
+
+    # Sinks accumulate batches with write() and persist them with flush(), the
+    # fan-out decides when to flush from buffered_points and buffered_since.
+    def __init__(self) -> None:
+        self.buffered_points = 0
+        self.buffered_since = None
+
+    def write(self,
+        batch: points.PointBatch,
+    ) -> None:
+        raise NotImplementedError
+
+    def flush(self) -> None:
+        raise NotImplementedError
+
+    def close(self) -> None:
+        self.flush()
+
+    def get_stats(self) -> dict:
+        return {}
+
+class ParquetSink(Sink):
+
+    def __init__(self,
+        directory: str,
+        rotation: str = "hour",
+        list_tag_column: list = LIST_TAG_COLUMN,
+        compression: str = "zstd",
+    ) -> None:
+
+        assert rotation in DICT_ROTATION_SECOND, f"Rotation {rotation} not recognized among {list(DICT_ROTATION_SECOND)}"
+
+        try:
+            import pyarrow
+            import pyarrow.parquet
+        except ModuleNotFoundError:
+            logging.error("pyarrow module not found, can't write Parquet files")
+            raise
+
+        super().__init__()
+
+        logging.info(f"Initializing {self.__class__.__name__} class...")
+
+        self.directory = directory
+        self.rotation = rotation
+        self.list_tag_column = list_tag_column
+        self.compression = compression
+
+        self._pa = pyarrow
+        self._pq = pyarrow.parquet
+        self._period_ns = DICT_ROTATION_SECOND[rotation] * 1_000_000_000
+        self._schema = pyarrow.schema(
+            [
+                ("time", pyarrow.timestamp("ns", tz="UTC")),
+                ("measurement", pyarrow.dictionary(pyarrow.int32(), pyarrow.string())),
+            ]
+            + [(key, pyarrow.dictionary(pyarrow.int32(), pyarrow.string())) for key in list_tag_column]
+            + [
+                ("tags", pyarrow.dictionary(pyarrow.int32(), pyarrow.string())),
+                ("value", pyarrow.float64()),
+            ]
+        )
+
+        # Series are interned to an id, a row is just (id, time, value) until the
+        # row group is built. Each string column keeps a dictionary of its values
+        # and the code of every series in it (None when the series lacks it).
+        self._dict_series_id = {}
+        self._list_column_dictionary = [{} for _ in range(len(list_tag_column) + 2)]
+        self._list_column_series_code = [[] for _ in range(len(list_tag_column) + 2)]
+        self._series_ids = array('i')
+        self._values = array('d')
+        self._times = array('q')
+
+        self._period = None
+        self._writer = None
+        self._path = None
+        self._dict_stats = {
+            'files': 0,
+            'row_groups': 0,
+            'points_written': 0,
+            'points_late': 0,
+        }
+
+        os.makedirs(directory, exist_ok=True)
+
+        return None
+
+    def _get_series_id(self,
+        measurement: str,
+        tag_set: tuple,
+    ) -> int:
+        key = (measurement, tag_set)
+        series_id = self._dict_series_id.get(key)
+        if series_id is None:
+            dict_tag = dict(tag_set)
+            list_value = [measurement] + [dict_tag.pop(tag_key, None) for tag_key in self.list_tag_column]
+            list_value.append(",".join(f"{k}={v}" for k, v in dict_tag.items()) or None)
+            for value, dictionary, list_series_code in zip(list_value, self._list_column_dictionary, self._list_column_series_code):
+                list_series_code.append(None if value is None else dictionary.setdefault(value, len(dictionary)))
+            series_id = len(self._dict_series_id)
+            self._dict_series_id[key] = series_id
+        return series_id
+
+    def write(self,
+        batch: points.PointBatch,
+    ) -> None:
+
+        if not batch:
+            return None
+
+        # A file is named after its rotation period, points of a newer period
+        # first close the current file. Rotation only moves forward: late points
+        # of an earlier period (a backfill, a slow source) go into the current
+        # file with their own timestamps instead of reopening an old period.
+        # Batches not reaching a newer period, nearly all of them, are appended
+        # column by column.
+        times = batch.times
+        if self._period is not None and max(times) // self._period_ns <= self._period:
+            if min(times) // self._period_ns < self._period:
+                self._dict_stats['points_late'] += sum(1 for time_ns in times if time_ns // self._period_ns < self._period)
+            self._series_ids.extend([self._get_series_id(measurement, tag_set) for measurement, tag_set in zip(batch.measurements, batch.tag_sets)])
+            self._values.extend(batch.values)
+            self._times.extend(times)
+        else:
+            for measurement, tag_set, value, time_ns in batch:
+                period = time_ns // self._period_ns
+                if self._period is None or period > self._period:
+                    self._rotate(period)
+                elif period < self._period:
+                    self._dict_stats['points_late'] += 1
+                self._series_ids.append(self._get_series_id(measurement, tag_set))
+                self._values.append(value)
+                self._times.append(time_ns)
+
+        if self.buffered_since is None:
+            self.buffered_since = time.monotonic()
+        self.buffered_points = len(self._values)
+
+        return None
+
+    def _rotate(self,
+        period: int,
+    ) -> None:
+        self.flush()
+        self._close_file()
+        self._period = period
+        return None
+
+    def _open_file(self) -> None:
+
+        # Written under an .inprogress name and renamed once complete, so readers
+        # never open a file without its footer. A restart within the same period
+        # starts a new part instead of overwriting.
+        start = datetime.datetime.fromtimestamp(self._period * self._period_ns / 1e9, tz=datetime.timezone.utc)
+        name = start.strftime(DICT_ROTATION_FORMAT[self.rotation])
+        directory = os.path.join(self.directory, start.strftime("%Y"), start.strftime("%m"))
+        os.makedirs(directory, exist_ok=True)
+
+        part = 0
+        while True:
+            path = os.path.join(directory, f"data_{name}{f'-{part}' if part else ''}.parquet")
+            if not os.path.exists(path) and not os.path.exists(f"{path}.inprogress"):
+                break
+            part += 1
+
+        self._path = path
+        self._writer = self._pq.ParquetWriter(f"{path}.inprogress", self._schema, compression=self.compression)
+
+        return None
+
+    def _close_file(self) -> None:
+
+        if self._writer is None:
+            return None
+
+        self._writer.close()
+        os.replace(f"{self._path}.inprogress", self._path)
+        logging.info(f"Parquet file {self._path} closed")
+
+        self._writer = None
+        self._path = None
+        self._dict_stats['files'] += 1
+
+        return None
+
+    def flush(self) -> None:
+
+        if not self._values:
+            return None
+
+        pa = self._pa
+        series_ids = pa.array(self._series_ids, type=pa.int32())
+        list_array = [pa.array(self._times, type=pa.int64()).cast(self._schema.field("time").type)]
+        for dictionary, list_series_code in zip(self._list_column_dictionary, self._list_column_series_code):
+            indices = pa.array(list_series_code, type=pa.int32()).take(series_ids)
+            list_array.append(pa.DictionaryArray.from_arrays(indices, pa.array(list(dictionary), type=pa.string())))
+        list_array.append(pa.array(self._values, type=pa.float64()))
+        table = pa.Table.from_arrays(list_array, schema=self._schema)
+
+        if self._writer is None:
+            self._open_file()
+        # One flush is one row group
+        self._writer.write_table(table, row_group_size=len(table))
+
+        self._dict_stats['row_groups'] += 1
+        self._dict_stats['points_written'] += len(table)
+
+        self._series_ids = array('i')
+        self._values = array('d')
+        self._times = array('q')
+        self.buffered_points = 0
+        self.buffered_since = None
+
+        return None
+
+    def close(self) -> None:
+        self.flush()
+        self._close_file()
+        return None
+
+    def get_stats(self) -> dict:
+        return dict(self._dict_stats)
+
+class SqliteSink(Sink):
+
+    def __init__(self,
+        path: str,
+    ) -> None:
+
+        super().__init__()
+
+        logging.info(f"Initializing {self.__class__.__name__} class...")
+
+        self.path = path
+
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        # Only the fan-out thread uses the connection once it's running
+        self._connection = sqlite3.connect(path, check_same_thread=False)
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.execute("PRAGMA synchronous=NORMAL")
+        self._connection.executescript("""
+            CREATE TABLE IF NOT EXISTS series (
+                id INTEGER PRIMARY KEY,
+                measurement TEXT NOT NULL,
+                tags TEXT NOT NULL,
+                UNIQUE (measurement, tags)
+            );
+            CREATE TABLE IF NOT EXISTS samples (
+                series_id INTEGER NOT NULL REFERENCES series (id),
+                time INTEGER NOT NULL,
+                value REAL NOT NULL,
+                PRIMARY KEY (series_id, time)
+            ) WITHOUT ROWID;
+            CREATE VIEW IF NOT EXISTS points AS
+                SELECT samples.time, series.measurement, series.tags, samples.value
+                FROM samples JOIN series ON series.id = samples.series_id;
+        """)
+
+        self._dict_series_id = {
+            (measurement, tags): id
+            for id, measurement, tags in self._connection.execute("SELECT id, measurement, tags FROM series")
+        }
+        self._list_row = []
+        self._dict_stats = {
+            'transactions': 0,
+            'points_written': 0,
+            'points_skipped': 0,
+            'points_dropped': 0,
+        }
+
+        return None
+
+    def _get_series_id(self,
+        measurement: str,
+        tag_set: tuple,
+    ) -> int:
+        key = (measurement, ",".join(f"{k}={v}" for k, v in tag_set))
+        series_id = self._dict_series_id.get(key)
+        if series_id is None:
+            series_id = self._connection.execute("INSERT INTO series (measurement, tags) VALUES (?, ?)", key).lastrowid
+            self._dict_series_id[key] = series_id
+        return series_id
+
+    def write(self,
+        batch: points.PointBatch,
+    ) -> None:
+
+        if not batch:
+            return None
+
+        dict_series_id = {}
+        for measurement, tag_set, value, time_ns in batch:
+            # SQLite stores NaN as NULL, which the NOT NULL value column rejects
+            if not math.isfinite(value):
+                self._dict_stats['points_skipped'] += 1
+                continue
+            key = (measurement, tag_set)
+            series_id = dict_series_id.get(key)
+            if series_id is None:
+                series_id = dict_series_id[key] = self._get_series_id(measurement, tag_set)
+            self._list_row.append((series_id, time_ns, value))
+
+        if self.buffered_since is None:
+            self.buffered_since = time.monotonic()
+        self.buffered_points = len(self._list_row)
+
+        return None
+
+    def flush(self) -> None:
+
+        if not self._list_row:
+            self._connection.commit()
+            return None
+
+        # One transaction per flush, a duplicate (series, time) replaces the old row
+        query = "INSERT OR REPLACE INTO samples (series_id, time, value) VALUES (?, ?, ?)"
+        points_written = len(self._list_row)
+        try:
+            with self._connection:
+                self._connection.executemany(query, self._list_row)
+        except sqlite3.OperationalError:
+            # Locked or full database, the rows stay buffered for the next flush
+            raise
+        except sqlite3.Error as e:
+            # Rows the database rejects would fail every flush after this one,
+            # they are dropped one by one and the rest written
+            logging.error(f"SQLite rejected a flush of {len(self._list_row)} points, writing them one by one: {e}")
+            with self._connection:
+                for row in self._list_row:
+                    try:
+                        self._connection.execute(query, row)
+                    except sqlite3.OperationalError:
+                        raise
+                    except sqlite3.Error as e:
+                        points_written -= 1
+                        self._dict_stats['points_dropped'] += 1
+                        logging.error(f"Dropped point {row} rejected by SQLite: {e}")
+
+        self._dict_stats['transactions'] += 1
+        self._dict_stats['points_written'] += points_written
+        self._list_row = []
+        self.buffered_points = 0
+        self.buffered_since = None
+
+        return None
+
+    def close(self) -> None:
+        self.flush()
+        self._connection.close()
+        return None
+
+    def get_stats(self) -> dict:
+        return dict(self._dict_stats)
+
+class SinkFanout:
+
+    def __init__(self,
+        dict_sink: dict,
+        max_points: int = 100_000,
+        max_age_second: float = 60.0,
+        queue_max_batches: int = 1000,
+    ) -> None:
+
+        logging.info(f"Initializing {self.__class__.__name__} class...")
+
+        # Every sink gets every batch, a failing sink doesn't hold up the others
+        self.dict_sink = dict_sink
+        self.max_points = max_points
+        self.max_age_second = max_age_second
+
+        self._queue = queue.Queue(maxsize=queue_max_batches)
+        self._stop = threading.Event()
+        self._thread = None
+
+        return None
+
+    def put(self,
+        batch: points.PointBatch,
+    ) -> bool:
+        if not batch:
+            return True
+        try:
+            self._queue.put_nowait(batch)
+            return True
+        except queue.Full:
+            metrics.REGISTRY.inc("sink_batches_dropped_total")
+            logging.warning("Sink queue full, dropped batch")
+            return False
+
+    def _call(self,
+        name: str,
+        function: callable,
+        *args,
+    ) -> None:
+        start = time.perf_counter()
+        try:
+            function(*args)
+        except Exception as e:
+            metrics.REGISTRY.inc("sink_errors_total", sink=name)
+            logging.error(f"Sink {name} failed: {e}")
+        metrics.REGISTRY.observe("sink_duration_seconds", time.perf_counter() - start, sink=name, operation=function.__name__)
+        return None
+
+    def run(self) -> None:
+
+        while not self._stop.is_set() or not self._queue.empty():
+            try:
+                batch = self._queue.get(timeout=1.0)
+            except queue.Empty:
+                batch = None
+
+            for name, sink in self.dict_sink.items():
+                if batch is not None:
+                    self._call(name, sink.write, batch)
+                if sink.buffered_points >= self.max_points or (sink.buffered_since is not None and time.monotonic() - sink.buffered_since >= self.max_age_second):
+                    self._call(name, sink.flush)
+
+        for name, sink in self.dict_sink.items():
+            self._call(name, sink.close)
+
+        return None
+
+    def start(self) -> None:
+        self._thread = threading.Thread(target=self.run, name="sink-fanout", daemon=True)
+        self._thread.start()
+        return None
+
+    def stop(self,
+        timeout: float = None,
+    ) -> None:
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+        return None
+
+    def collect_metrics(self) -> list:
+        list_metric = []
+        for name, sink in self.dict_sink.items():
+            list_metric.append(("sink_buffered_points", {'sink': name}, float(sink.buffered_points)))
+            for key, value in sink.get_stats().items():
+                list_metric.append((f"sink_{key}", {'sink': name}, float(value)))
+        return list_metric
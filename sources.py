@@ -0,0 +1,120 @@
+import logging
+import os
+import threading
+import time
+
+import metrics
+
+class SourceRegistry:
+
+    def __init__(self,
+        list_enabled: list = None,
+    ) -> None:
+
+        logging.info(f"Initializing {self.__class__.__name__} class...")
+
+        # None enables every registered source whose environment variables are set
+        self.list_enabled = list_enabled
+
+        self._lock = threading.Lock()
+        self._dict_source = {}
+
+        # Acquisition workers are forked from a threaded process, a lock held
+        # by another thread at that moment would never be released in the child
+        os.register_at_fork(after_in_child=self._after_fork)
+
+        return None
+
+    def _after_fork(self) -> None:
+        # Sources loaded in the parent share its sockets and locks, a worker
+        # loads its own on first use
+        self._lock = threading.Lock()
+        for source in self._dict_source.values():
+            source['lock'] = threading.Lock()
+            source['object'] = None
+            source['function'] = None
+        return None
+
+    def register(self,
+        name: str,
+        factory: callable,
+        frequency_second: float,
+        list_env: list = [],
+    ) -> None:
+
+        # factory is only called on first use and returns (object, poll function),
+        # so the modules a source needs are imported by the factory, not up front.
+        assert name not in self._dict_source, f"Source {name} already registered"
+
+        self._dict_source[name] = {
+            'factory': factory,
+            'frequency_second': frequency_second,
+            'list_env': list_env,
+            'object': None,
+            'function': None,
+            'lock': threading.Lock(),
+        }
+
+        return None
+
+    def is_configured(self,
+        name: str,
+    ) -> bool:
+        return all(os.getenv(env) for env in self._dict_source[name]['list_env'])
+
+    def get_enabled(self) -> dict:
+
+        if self.list_enabled is None:
+            list_name = [name for name in self._dict_source if self.is_configured(name)]
+        else:
+            list_name = []
+            for name in self.list_enabled:
+                if name not in self._dict_source:
+                    logging.error(f"Source {name} is not registered, known sources are {list(self._dict_source)}")
+                elif not self.is_configured(name):
+                    list_missing = [env for env in self._dict_source[name]['list_env'] if not os.getenv(env)]
+                    logging.error(f"Source {name} is enabled but {', '.join(list_missing)} not set, skipping it")
+                else:
+                    list_name.append(name)
+
+        return {name: self._dict_source[name]['frequency_second'] for name in list_name}
+
+    def get(self,
+        name: str,
+    ) -> object:
+        return self._load(name)['object']
+
+    def get_loaded(self) -> dict:
+        with self._lock:
+            return {name: source['object'] for name, source in self._dict_source.items() if source['object'] is not None}
+
+    def _load(self,
+        name: str,
+    ) -> dict:
+
+        source = self._dict_source[name]
+        if source['function'] is not None:
+            return source
+
+        with source['lock']:
+            if source['function'] is None:
+                start = time.perf_counter()
+                obj, function = source['factory']()
+                elapsed = time.perf_counter() - start
+                metrics.REGISTRY.set("source_load_seconds", elapsed, source=name)
+                logging.info(f"Source {name} loaded in {elapsed * 1e3:.1f} ms")
+                with self._lock:
+                    source['object'] = obj
+                    source['function'] = function
+
+        return source
+
+    def get_function(self,
+        name: str,
+    ) -> callable:
+
+        # The returned function loads the source on its first call
+        def poll():
+            return self._load(name)['function']()
+
+        return poll
@@ -0,0 +1,355 @@
+import json
+import logging
+import os
+import random
+import threading
+import time
+
+import metrics
+
+SEGMENT_SUFFIX = ".lp"
+OFFSET_FILENAME = "offsets.json"
+# Not a segment suffix, so it is never replayed
+DEAD_LETTER_FILENAME = "dead_letter.txt"
+
+def get_status(
+    error: Exception,
+) -> int:
+    # HTTP status of a failed write, from influxdb_client (status) or requests (response)
+    status = getattr(error, "status", None)
+    if status is None:
+        status = getattr(getattr(error, "response", None), "status_code", None)
+    return status
+
+def is_retryable(
+    error: Exception,
+) -> bool:
+    # A 4xx other than timeout and rate limiting won't succeed on retry
+    status = get_status(error)
+    return not (isinstance(status, int) and 400 <= status < 500 and status not in (408, 429))
+
+class Spool:
+
+    def __init__(self,
+        directory: str,
+        segment_max_bytes: int = 16 * 1024 * 1024,
+        max_total_bytes: int = 1024 * 1024 * 1024,
+        fsync: bool = False,
+        buffer_bytes: int = 1024 * 1024,
+    ) -> None:
+
+        logging.info(f"Initializing {self.__class__.__name__} class...")
+
+        self.directory = directory
+        self.segment_max_bytes = segment_max_bytes
+        self.max_total_bytes = max_total_bytes
+        self.fsync = fsync
+        self.buffer_bytes = buffer_bytes
+
+        os.makedirs(self.directory, exist_ok=True)
+
+        self._lock = threading.Lock()
+        self._event_data = threading.Event()
+        self._dict_size = {}
+        self._dict_offset = {}
+        self._evicted_bytes = 0
+
+        for filename in os.listdir(self.directory):
+            if filename.endswith(SEGMENT_SUFFIX):
+                seq = int(filename[:-len(SEGMENT_SUFFIX)])
+                self._dict_size[seq] = os.path.getsize(self._get_path(seq))
+
+        path_offset = os.path.join(self.directory, OFFSET_FILENAME)
+        if os.path.exists(path_offset):
+            with open(path_offset) as file:
+                self._dict_offset = {int(seq): offset for seq, offset in json.load(file).items() if int(seq) in self._dict_size}
+
+        # Segments left over from a previous run are sealed, new data always
+        # goes to a fresh segment.
+        self._active_seq = max(self._dict_size, default=-1) + 1
+        self._open_segment(self._active_seq)
+
+        backlog = self.get_backlog_bytes()
+        if backlog:
+            logging.warning(f"Spool in {self.directory} holds {backlog} bytes not yet written to InfluxDB, they will be replayed")
+            self.notify()
+
+        return None
+
+    def _get_path(self,
+        seq: int,
+    ) -> str:
+        return os.path.join(self.directory, f"{seq:012d}{SEGMENT_SUFFIX}")
+
+    def _open_segment(self,
+        seq: int,
+    ) -> None:
+        self._file = open(self._get_path(seq), "ab", buffering=self.buffer_bytes)
+        self._dict_size[seq] = 0
+        self._dict_offset.setdefault(seq, 0)
+        return None
+
+    def _save_offsets(self) -> None:
+        path_offset = os.path.join(self.directory, OFFSET_FILENAME)
+        with open(path_offset + ".tmp", "w") as file:
+            json.dump(self._dict_offset, file)
+        os.replace(path_offset + ".tmp", path_offset)
+        return None
+
+    def _delete_segment(self,
+        seq: int,
+    ) -> None:
+        try:
+            os.remove(self._get_path(seq))
+        except FileNotFoundError:
+            pass
+        self._dict_size.pop(seq, None)
+        self._dict_offset.pop(seq, None)
+        return None
+
+    def _evict(self) -> None:
+        total = sum(self._dict_size.values())
+        for seq in sorted(self._dict_size):
+            if total <= self.max_total_bytes or seq == self._active_seq:
+                break
+            dropped = self._dict_size[seq] - self._dict_offset.get(seq, 0)
+            total -= self._dict_size[seq]
+            self._evicted_bytes += dropped
+            self._delete_segment(seq)
+            logging.error(f"Spool over its {self.max_total_bytes} bytes cap, evicted oldest segment {seq} with {dropped} unwritten bytes")
+        self._save_offsets()
+        return None
+
+    def append(self,
+        data: bytes,
+    ) -> None:
+
+        if not data:
+            return None
+        if not data.endswith(b"\n"):
+            data += b"\n"
+
+        with self._lock:
+            if self._dict_size[self._active_seq] and self._dict_size[self._active_seq] + len(data) > self.segment_max_bytes:
+                self._file.close()
+                self._active_seq += 1
+                self._open_segment(self._active_seq)
+
+            self._file.write(data)
+            self._file.flush()
+            if self.fsync:
+                os.fsync(self._file.fileno())
+            self._dict_size[self._active_seq] += len(data)
+
+            if sum(self._dict_size.values()) > self.max_total_bytes:
+                self._evict()
+
+        self.notify()
+
+        return None
+
+    def read(self,
+        seq: int,
+        max_bytes: int,
+    ) -> tuple:
+
+        with self._lock:
+            offset = self._dict_offset.get(seq, 0)
+            end = self._dict_size.get(seq, 0)
+            sealed = seq != self._active_seq
+
+        if offset >= end:
+            return b"", end if sealed else None
+
+        with open(self._get_path(seq), "rb") as file:
+            file.seek(offset)
+            data = file.read(min(max_bytes, end - offset))
+
+        # Only hand out whole lines. A single line longer than max_bytes is
+        # returned whole, a trailing fragment of a sealed segment (torn write
+        # on crash) is skipped.
+        cut = data.rfind(b"\n") + 1
+        if cut == 0:
+            if offset + len(data) < end:
+                with open(self._get_path(seq), "rb") as file:
+                    file.seek(offset)
+                    data = file.read(end - offset)
+                cut = data.find(b"\n") + 1
+            if cut == 0:
+                if sealed:
+                    logging.warning(f"Skipping {len(data)} bytes of incomplete line at the end of spool segment {seq}")
+                    return b"", end
+                return b"", None
+
+        return data[:cut], offset + cut
+
+    def ack(self,
+        seq: int,
+        offset: int,
+    ) -> None:
+
+        with self._lock:
+            if seq not in self._dict_size:
+                return None
+            self._dict_offset[seq] = offset
+            if seq != self._active_seq and offset >= self._dict_size[seq]:
+                self._delete_segment(seq)
+            self._save_offsets()
+
+        return None
+
+    def dead_letter(self,
+        data: bytes,
+    ) -> None:
+        # Kept for inspection and manual replay, it isn't read back
+        with self._lock:
+            with open(os.path.join(self.directory, DEAD_LETTER_FILENAME), "ab") as file:
+                file.write(data)
+        return None
+
+    def get_active_seq(self) -> int:
+        with self._lock:
+            return self._active_seq
+
+    def get_backlog_seqs(self) -> list:
+        with self._lock:
+            return [seq for seq in sorted(self._dict_size) if seq != self._active_seq]
+
+    def get_backlog_bytes(self) -> int:
+        with self._lock:
+            return sum(self._dict_size[seq] - self._dict_offset.get(seq, 0) for seq in self._dict_size)
+
+    def get_stats(self) -> dict:
+        with self._lock:
+            return {
+                'segments': len(self._dict_size),
+                'bytes_on_disk': sum(self._dict_size.values()),
+                'bytes_pending': sum(self._dict_size[seq] - self._dict_offset.get(seq, 0) for seq in self._dict_size),
+                'bytes_evicted': self._evicted_bytes,
+            }
+
+    def notify(self) -> None:
+        self._event_data.set()
+        return None
+
+    def wait(self,
+        timeout: float,
+    ) -> bool:
+        result = self._event_data.wait(timeout)
+        self._event_data.clear()
+        return result
+
+    def close(self) -> None:
+        with self._lock:
+            self._file.close()
+            self._save_offsets()
+        return None
+
+class SpoolDrainer:
+
+    def __init__(self,
+        spool: Spool,
+        write_function: callable,
+        max_bytes_per_chunk: int = 1024 * 1024,
+        backlog_max_bytes_per_second: float = 512 * 1024,
+        backoff_initial_second: float = 1.0,
+        backoff_max_second: float = 60.0,
+    ) -> None:
+
+        logging.info(f"Initializing {self.__class__.__name__} class...")
+
+        self.spool = spool
+        self.write_function = write_function
+        self.max_bytes_per_chunk = max_bytes_per_chunk
+        self.backlog_max_bytes_per_second = backlog_max_bytes_per_second
+        self.backoff_initial_second = backoff_initial_second
+        self.backoff_max_second = backoff_max_second
+
+        self._stop = threading.Event()
+        self._thread = None
+        self._backlog_allowed_at = 0.0
+
+        return None
+
+    def _write(self,
+        seq: int,
+        max_bytes: int,
+    ) -> int:
+        data, offset = self.spool.read(seq, max_bytes)
+        if data:
+            start = time.perf_counter()
+            try:
+                self.write_function(data)
+            except Exception as e:
+                if is_retryable(e):
+                    metrics.REGISTRY.inc("influxdb_writes_total", result="error")
+                    raise
+                # Rejected for good (bad line protocol, auth, too large): set
+                # aside so neither live data nor the backlog waits behind it
+                metrics.REGISTRY.inc("influxdb_writes_total", result="rejected")
+                metrics.REGISTRY.inc("spool_dead_letter_bytes_total", len(data))
+                logging.error(f"InfluxDB rejected {len(data)} bytes from spool segment {seq} with status {get_status(e)}, moved to {DEAD_LETTER_FILENAME}: {e}")
+                self.spool.dead_letter(data)
+                self.spool.ack(seq, offset)
+                return len(data)
+            metrics.REGISTRY.observe("influxdb_write_duration_seconds", time.perf_counter() - start)
+            metrics.REGISTRY.inc("influxdb_writes_total", result="success")
+            metrics.REGISTRY.inc("influxdb_written_bytes_total", len(data))
+        if offset is not None:
+            self.spool.ack(seq, offset)
+        return len(data)
+
+    def drain_once(self) -> int:
+
+        # Live data (active segment) is written first and is never throttled,
+        # backlog segments get at most one chunk per pass within their rate.
+        written = self._write(self.spool.get_active_seq(), self.max_bytes_per_chunk)
+
+        list_seq = self.spool.get_backlog_seqs()
+        if list_seq and time.monotonic() >= self._backlog_allowed_at:
+            backlog_written = self._write(list_seq[0], self.max_bytes_per_chunk)
+            if self.backlog_max_bytes_per_second:
+                self._backlog_allowed_at = time.monotonic() + backlog_written / self.backlog_max_bytes_per_second
+            written += backlog_written
+            if backlog_written:
+                logging.info(f"Replayed {backlog_written} bytes from spool, {self.spool.get_backlog_bytes()} bytes pending")
+
+        return written
+
+    def run(self) -> None:
+
+        backoff = 0.0
+        while not self._stop.is_set():
+            try:
+                written = self.drain_once()
+                if backoff:
+                    logging.info("InfluxDB reachable again, draining spool")
+                backoff = 0.0
+            except Exception as e:
+                if not backoff:
+                    logging.error(f"Couldn't write spooled data to InfluxDB, keeping it on disk: {e}")
+                backoff = min(max(backoff * 2, self.backoff_initial_second), self.backoff_max_second)
+                self._stop.wait(random.uniform(backoff / 2, backoff))
+                continue
+
+            if not written:
+                timeout = 1.0
+                if self.spool.get_backlog_seqs():
+                    timeout = max(min(self._backlog_allowed_at - time.monotonic(), 1.0), 0.0)
+                self.spool.wait(timeout)
+
+        return None
+
+    def start(self) -> None:
+        self._thread = threading.Thread(target=self.run, name="spool-drainer", daemon=True)
+        self._thread.start()
+        return None
+
+    def stop(self,
+        timeout: float = None,
+    ) -> None:
+        self._stop.set()
+        self.spool.notify()
+        if self._thread is not None:
+            self._thread.join(timeout)
+        return None
@@ -0,0 +1,210 @@
+import logging
+import queue
+import random
+import threading
+import time
+
+import metrics
+import points
+
+LIST_QUEUE_FULL_POLICY = [
+    "block",
+    "drop_oldest",
+    "spill",
+]
+
+class BatchWriter:
+
+    def __init__(self,
+        write_function: callable,
+        max_points: int = 5000,
+        max_bytes: int = 1024 * 1024,
+        max_age_second: float = 5.0,
+        queue_max_batches: int = 1000,
+        queue_full_policy: str = "block",
+        spill_function: callable = None,
+        max_retries: int = 3,
+        backoff_initial_second: float = 0.5,
+        backoff_max_second: float = 30.0,
+    ) -> None:
+
+        assert queue_full_policy in LIST_QUEUE_FULL_POLICY, f"Queue full policy {queue_full_policy} not recognized among {LIST_QUEUE_FULL_POLICY}"
+        assert queue_full_policy != "spill" or spill_function is not None, "Queue full policy spill needs a spill_function"
+
+        logging.info(f"Initializing {self.__class__.__name__} class...")
+
+        self.write_function = write_function
+        self.max_points = max_points
+        self.max_bytes = max_bytes
+        self.max_age_second = max_age_second
+        self.queue_full_policy = queue_full_policy
+        self.spill_function = spill_function
+        self.max_retries = max_retries
+        self.backoff_initial_second = backoff_initial_second
+        self.backoff_max_second = backoff_max_second
+
+        self._queue = queue.Queue(maxsize=queue_max_batches)
+        self._buffer = bytearray()
+        self._scratch = bytearray()
+        self._buffer_points = 0
+        self._buffer_since = None
+
+        self._stop = threading.Event()
+        self._thread = None
+
+        self._lock = threading.Lock()
+        self._dict_stats = {
+            'batches_dropped': 0,
+            'batches_spilled': 0,
+            'flushes': 0,
+            'flushes_failed': 0,
+            'points_written': 0,
+            'bytes_written': 0,
+            'flush_latency_total_second': 0.0,
+            'flush_latency_max_second': 0.0,
+            'flush_latency_last_second': 0.0,
+        }
+
+        return None
+
+    def put(self,
+        batch: points.PointBatch,
+    ) -> bool:
+
+        if not batch:
+            return True
+
+        if self.queue_full_policy == "block":
+            self._queue.put(batch)
+            return True
+
+        try:
+            self._queue.put_nowait(batch)
+            return True
+        except queue.Full:
+            pass
+
+        if self.queue_full_policy == "drop_oldest":
+            try:
+                self._queue.get_nowait()
+            except queue.Empty:
+                pass
+            with self._lock:
+                self._dict_stats['batches_dropped'] += 1
+            logging.warning("Writer queue full, dropped oldest batch")
+            self._queue.put_nowait(batch)
+        else:
+            with self._lock:
+                self._dict_stats['batches_spilled'] += 1
+            self.spill_function(bytes(batch.encode()))
+
+        return False
+
+    def _write_with_retry(self,
+        data: bytes,
+    ) -> None:
+
+        backoff = self.backoff_initial_second
+        for attempt in range(self.max_retries + 1):
+            try:
+                self.write_function(data)
+                return None
+            except Exception as e:
+                if attempt == self.max_retries or self._stop.is_set():
+                    raise
+                # Full jitter, so writers restarted together don't retry in lockstep
+                sleep = random.uniform(0, backoff)
+                logging.warning(f"Write failed (attempt {attempt + 1}/{self.max_retries + 1}), retrying in {sleep:.2f} s: {e}")
+                time.sleep(sleep)
+                backoff = min(backoff * 2, self.backoff_max_second)
+
+    def flush(self) -> None:
+
+        if not self._buffer:
+            return None
+
+        data = bytes(self._buffer)
+        number_of_points = self._buffer_points
+        self._buffer.clear()
+        self._buffer_points = 0
+        self._buffer_since = None
+
+        start = time.perf_counter()
+        try:
+            self._write_with_retry(data)
+        except Exception as e:
+            logging.error(f"Couldn't write {number_of_points} points: {e}")
+            with self._lock:
+                self._dict_stats['flushes_failed'] += 1
+            if self.spill_function is not None and self.spill_function is not self.write_function:
+                self.spill_function(data)
+            return None
+
+        latency = time.perf_counter() - start
+        metrics.REGISTRY.observe("writer_flush_duration_seconds", latency)
+        metrics.REGISTRY.observe("writer_flush_points", number_of_points, metrics.LIST_BUCKET_POINT)
+        with self._lock:
+            self._dict_stats['flushes'] += 1
+            self._dict_stats['points_written'] += number_of_points
+            self._dict_stats['bytes_written'] += len(data)
+            self._dict_stats['flush_latency_total_second'] += latency
+            self._dict_stats['flush_latency_last_second'] = latency
+            self._dict_stats['flush_latency_max_second'] = max(self._dict_stats['flush_latency_max_second'], latency)
+
+        logging.debug(f"Flushed {number_of_points} points ({len(data)} bytes) in {latency * 1e3:.1f} ms")
+
+        return None
+
+    def _add(self,
+        batch: points.PointBatch,
+    ) -> None:
+        if self._buffer_since is None:
+            self._buffer_since = time.monotonic()
+        self._buffer += batch.encode(self._scratch)
+        self._buffer_points += len(batch)
+        return None
+
+    def run(self) -> None:
+
+        while not self._stop.is_set() or not self._queue.empty():
+            if self._buffer_since is None:
+                timeout = self.max_age_second
+            else:
+                timeout = max(self._buffer_since + self.max_age_second - time.monotonic(), 0.0)
+
+            try:
+                self._add(self._queue.get(timeout=min(timeout, 1.0)))
+            except queue.Empty:
+                pass
+
+            if (
+                self._buffer_points >= self.max_points
+                or len(self._buffer) >= self.max_bytes
+                or (self._buffer_since is not None and time.monotonic() - self._buffer_since >= self.max_age_second)
+            ):
+                self.flush()
+
+        self.flush()
+
+        return None
+
+    def start(self) -> None:
+        self._thread = threading.Thread(target=self.run, name="batch-writer", daemon=True)
+        self._thread.start()
+        return None
+
+    def stop(self,
+        timeout: float = None,
+    ) -> None:
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+        return None
+
+    def get_stats(self) -> dict:
+        with self._lock:
+            dict_stats = dict(self._dict_stats)
+        dict_stats['queue_depth'] = self._queue.qsize()
+        dict_stats['queue_max'] = self._queue.maxsize
+        dict_stats['flush_latency_mean_second'] = dict_stats['flush_latency_total_second'] / dict_stats['flushes'] if dict_stats['flushes'] else 0.0
+        return dict_stats